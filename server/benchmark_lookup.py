@@ -0,0 +1,301 @@
+#!/usr/bin/python
+import logging
+import optparse
+import os
+import random
+import sys
+import time
+import traceback
+
+USAGE = """%prog [options] SDK_PATH
+Benchmark LookupHandler end to end on synthetic fleets, against the App
+Engine testbed stubs. For each fleet size and policy, print the throughput
+and the latency percentiles of the lookups and, optionally, the stage
+timings (see mlabns.util.stage_timer).
+
+SDK_PATH    Path to the SDK installation"""
+
+FLEET_SIZES = [100, 1000, 10000]
+TOOL_ID = 'ndt'
+SLICE_ID = 'iupui_ndt'
+SERVERS_PER_SITE = 3
+SITES_PER_METRO = 4
+COUNTRIES = ['AU', 'BR', 'DE', 'FR', 'GB', 'IN', 'JP', 'US', 'ZA']
+# With the geo policies, clients are geolocated from their coordinates, from
+# an explicit IP address, or from their source address, in these proportions.
+# Other policies only use the source address (explicit coordinates or IP
+# addresses turn them into the geo policy, see LookupQuery._resolve_policy).
+CLIENT_MIX = [('lat_lon', 0.4), ('ip', 0.3), ('remote_addr', 0.3)]
+# Each /16 of the synthetic IPv4 range table is a city.
+CLIENT_NETWORKS = 4096
+
+
+def _random_location(rand):
+    """Returns a (latitude, longitude) pair roughly spread over land."""
+    return (round(rand.uniform(-40, 60), 4),
+            round(rand.uniform(-125, 150), 4))
+
+
+def make_fleet(size, rand):
+    """Returns the Site and SliverTool entities of a synthetic fleet.
+
+    Sites host SERVERS_PER_SITE sliver tools each, and are grouped in metros
+    of SITES_PER_METRO sites. All the sliver tools are online over IPv4, and
+    one in two over IPv6.
+    """
+    from mlabns.db import model
+    from mlabns.util import message
+
+    sites = []
+    sliver_tools = []
+    for i in range(size):
+        site_index, server_index = divmod(i, SERVERS_PER_SITE)
+        if server_index == 0:
+            metro = 'x%03d' % (site_index // SITES_PER_METRO)
+            latitude, longitude = _random_location(rand)
+            site = model.Site(
+                site_id='%s%02d' % (metro, site_index % SITES_PER_METRO),
+                city='City %d' % site_index,
+                country=rand.choice(COUNTRIES), latitude=latitude,
+                longitude=longitude, metro=[metro, metro + '01'])
+            sites.append(site)
+
+        server_id = 'mlab%d' % (server_index + 1)
+        sliver_tool_id = model.get_sliver_tool_id(TOOL_ID, SLICE_ID,
+                                                  server_id, site.site_id)
+        sliver_tools.append(model.SliverTool(
+            key_name=sliver_tool_id, tool_id=TOOL_ID, slice_id=SLICE_ID,
+            site_id=site.site_id, server_id=server_id, server_port='3001',
+            http_port='7123', tool_extra=None,
+            fqdn=model.get_fqdn(SLICE_ID, server_id, site.site_id),
+            sliver_ipv4='10.%d.%d.%d' % (i >> 16, (i >> 8) & 255, i & 255),
+            sliver_ipv6='2001:db8::%x' % i,
+            status_ipv4=message.STATUS_ONLINE,
+            status_ipv6=(message.STATUS_ONLINE if i % 2 else
+                         message.STATUS_OFFLINE),
+            latitude=site.latitude, longitude=site.longitude,
+            city=site.city, country=site.country))
+    return sites, sliver_tools
+
+
+def publish_fleet(sites, sliver_tools):
+    """Stores a fleet the way the update handlers do."""
+    from google.appengine.ext import db
+    from mlabns.db import model
+    from mlabns.util import candidate_cache
+    from mlabns.util import sliver_store
+
+    tool = model.Tool(key_name=TOOL_ID, tool_id=TOOL_ID, slice_id=SLICE_ID,
+                      server_port='3001', http_port='7123',
+                      show_tool_extra=False)
+    tool.put()
+    db.put(sites)
+    db.put(sliver_tools)
+
+    candidate_cache.publish_metros(
+        (site.site_id, site.metro) for site in sites)
+    sliver_store.publish(TOOL_ID,
+                         model.get_sliver_tool_snapshots(sliver_tools))
+
+
+def install_range_table(rand):
+    """Geolocates the client IPv4 addresses with a synthetic range table."""
+    from mlabns.util import maxmind
+    from mlabns.util import message
+
+    ranges = []
+    for network in range(CLIENT_NETWORKS):
+        latitude, longitude = _random_location(rand)
+        start = (1 << 24) + (network << 16)
+        ranges.append((start, start + 0xffff, maxmind.GeoRecord(
+            city='Client city %d' % network,
+            country=rand.choice(COUNTRIES), latitude=latitude,
+            longitude=longitude)))
+    maxmind._range_tables[message.ADDRESS_FAMILY_IPv4] = maxmind.RangeTable(
+        maxmind.build_range_table(ranges))
+
+
+def _random_client_ip(rand):
+    network = rand.randrange(CLIENT_NETWORKS)
+    return '%d.%d.%d.%d' % (1 + (network >> 8), network & 255,
+                            rand.randrange(256), rand.randrange(1, 255))
+
+
+def make_requests(policy, count, sites, rand):
+    """Returns 'count' (url, remote_addr) pairs of lookups with 'policy'."""
+    from mlabns.util import message
+
+    metros = sorted(set(site.metro[0] for site in sites))
+    requests = []
+    for _ in range(count):
+        params = ['%s=%s' % (message.POLICY, policy),
+                  '%s=%s' % (message.RESPONSE_FORMAT, message.FORMAT_JSON)]
+        if policy == message.POLICY_METRO:
+            params.append('%s=%s' % (message.METRO, rand.choice(metros)))
+        elif policy == message.POLICY_COUNTRY:
+            params.append('%s=%s' % (message.COUNTRY,
+                                     rand.choice(COUNTRIES)))
+
+        remote_addr = _random_client_ip(rand)
+        geolocation = 'remote_addr'
+        if policy in [message.POLICY_GEO, message.POLICY_GEO_OPTIONS]:
+            client_type = rand.random()
+            for geolocation, share in CLIENT_MIX:
+                if client_type < share:
+                    break
+                client_type -= share
+        if geolocation == 'lat_lon':
+            latitude, longitude = _random_location(rand)
+            params.append('%s=%s' % (message.LATITUDE, latitude))
+            params.append('%s=%s' % (message.LONGITUDE, longitude))
+        elif geolocation == 'ip':
+            params.append('%s=%s' % (message.REMOTE_ADDRESS,
+                                     _random_client_ip(rand)))
+        requests.append(('/%s?%s' % (TOOL_ID, '&'.join(params)),
+                         remote_addr))
+    return requests
+
+
+def _percentile(sorted_values, percent):
+    if not sorted_values:
+        return float('nan')
+    index = int(round(percent / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+def benchmark(requests, flush_caches):
+    """Sends 'requests' to LookupHandler.
+
+    Returns:
+        A (elapsed, latencies, errors) tuple, where 'elapsed' is the total
+        time in seconds, 'latencies' the sorted latency of each lookup and
+        'errors' the number of lookups that failed.
+    """
+    from google.appengine.ext import webapp
+    from mlabns.handlers import lookup
+    from mlabns.util import response_cache
+
+    latencies = []
+    errors = 0
+    start = time.time()
+    for url, remote_addr in requests:
+        if flush_caches:
+            response_cache.response_cache.flush()
+        request_start = time.time()
+        handler = lookup.LookupHandler()
+        handler.initialize(webapp.Request.blank(url, remote_addr=remote_addr),
+                           webapp.Response())
+        try:
+            handler.get()
+            if handler.response.status_int != 200:
+                errors += 1
+        except Exception:
+            if not errors:
+                traceback.print_exc()
+            errors += 1
+        latencies.append(time.time() - request_start)
+    elapsed = time.time() - start
+    return elapsed, sorted(latencies), errors
+
+
+def run_fleet(size, options):
+    """Benchmarks each policy on a fleet of 'size' sliver tools.
+
+    Returns:
+        The number of lookups that failed.
+    """
+    from google.appengine.ext import testbed
+    from mlabns.db import model
+    from mlabns.util import resolver
+    from mlabns.util import response_cache
+    from mlabns.util import stage_timer
+
+    rand = random.Random(options.seed)
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.init_datastore_v3_stub()
+    bed.init_memcache_stub()
+    bed.init_taskqueue_stub(root_path=os.path.dirname(__file__) or '.')
+    try:
+        resolver.local_cache.flush()
+        response_cache.response_cache.flush()
+        model.invalidate_tool_cache()
+        stage_timer.timings.reset()
+
+        sites, sliver_tools = make_fleet(size, rand)
+        publish_fleet(sites, sliver_tools)
+        install_range_table(rand)
+
+        print '%d sliver tools, %d sites' % (size, len(sites))
+        print '%-12s %8s %7s %10s %9s %9s %9s' % (
+            'policy', 'requests', 'errors', 'req/s', 'p50 (ms)', 'p95 (ms)',
+            'p99 (ms)')
+        total_errors = 0
+        for policy in options.policies.split(','):
+            requests = make_requests(policy, options.requests, sites, rand)
+            elapsed, latencies, errors = benchmark(requests,
+                                                   options.flush_caches)
+            total_errors += errors
+            if errors:
+                # The latencies would time the failures, not the lookups.
+                print '%-12s %8d %7d %10s %9s %9s %9s' % (
+                    policy, len(requests), errors, '-', '-', '-', '-')
+                continue
+            print '%-12s %8d %7d %10.1f %9.3f %9.3f %9.3f' % (
+                policy, len(requests), errors, len(requests) / elapsed,
+                _percentile(latencies, 50) * 1e3,
+                _percentile(latencies, 95) * 1e3,
+                _percentile(latencies, 99) * 1e3)
+
+        if options.stages and not total_errors:
+            print
+            print ' '.join('%-14s' % header
+                           for header in stage_timer.SUMMARY_HEADERS)
+            for row in stage_timer.timings.get_summary():
+                print ' '.join('%-14s' % value for value in row)
+        print
+        return total_errors
+    finally:
+        bed.deactivate()
+
+
+def main(sdk_path, options):
+    sys.path.insert(0, sdk_path)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    if not options.verbose:
+        logging.getLogger().setLevel(logging.ERROR)
+
+    errors = 0
+    for size in [int(size) for size in options.sizes.split(',')]:
+        errors += run_fleet(size, options)
+    if errors:
+        print 'Error: %d lookups failed, no timings reported for them.' % (
+            errors)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(USAGE)
+    parser.add_option('--sizes', default=','.join(map(str, FLEET_SIZES)),
+                      help='Comma-separated numbers of sliver tools')
+    parser.add_option('--policies',
+                      default='geo,geo_options,metro,country,random,all',
+                      help='Comma-separated lookup policies')
+    parser.add_option('--requests', type='int', default=1000,
+                      help='Number of lookups per policy and fleet size')
+    parser.add_option('--seed', type='int', default=0,
+                      help='Seed of the synthetic fleets and clients')
+    parser.add_option('--flush_caches', action='store_true', default=False,
+                      help='Flush the response cache before every lookup')
+    parser.add_option('--stages', action='store_true', default=False,
+                      help='Also print the stage timings')
+    parser.add_option('--verbose', action='store_true', default=False,
+                      help='Do not hide the log messages below ERROR')
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        print 'Error: Exactly 1 argument required.'
+        parser.print_help()
+        sys.exit(1)
+    SDK_PATH = args[0]
+    main(SDK_PATH, options)
@@ -0,0 +1,99 @@
+#!/usr/bin/python
+import optparse
+import sys
+import timeit
+
+USAGE = """%prog [options] SDK_PATH
+Benchmark the bt and json lookup responses on synthetic fleets of sliver
+tools (policy=all), and print the cost per sliver tool.
+
+SDK_PATH    Path to the SDK installation"""
+
+FLEET_SIZES = [10, 100, 1000, 5000]
+
+
+def make_fleet(size):
+    """Returns 'size' sliver tool snapshots, three per site."""
+    from mlabns.db import model
+    from mlabns.util import json_fragments
+    from mlabns.util import message
+
+    fleet = []
+    for i in range(size):
+        site_id = 'x%02d%02d' % (i // 300, (i // 3) % 100)
+        server_id = 'mlab%d' % (i % 3 + 1)
+        snapshot = model.SliverToolSnapshot(
+            tool_id='ndt', slice_id='iupui_ndt', site_id=site_id,
+            server_id=server_id, server_port='3001', http_port='7123',
+            tool_extra=None,
+            fqdn='ndt.iupui.%s.%s.measurement-lab.org' % (server_id, site_id),
+            sliver_ipv4='10.%d.%d.%d' % (i >> 16, (i >> 8) & 255, i & 255),
+            sliver_ipv6=message.NO_IP_ADDRESS,
+            status_ipv4=message.STATUS_ONLINE,
+            status_ipv6=message.STATUS_OFFLINE,
+            latitude=0.0, longitude=0.0, city='City %d' % (i // 3),
+            country='ZZ', json_fragments=None)
+        fleet.append(snapshot._replace(
+            json_fragments=json_fragments.get_json_fragments(snapshot, False)))
+    return fleet
+
+
+def make_query(response_format):
+    from mlabns.util import lookup_query
+    from mlabns.util import message
+
+    query = lookup_query.LookupQuery()
+    query.tool_id = 'ndt'
+    # Not a cached policy, so that every response is built.
+    query.policy = message.POLICY_RANDOM
+    query.response_format = response_format
+    return query
+
+
+def benchmark(response_format, fleet, repeat):
+    """Returns the best time, in seconds, to send a response for 'fleet'."""
+    from google.appengine.ext import webapp
+    from mlabns.handlers import lookup
+    from mlabns.util import message
+
+    query = make_query(response_format)
+
+    def send_response():
+        handler = lookup.LookupHandler()
+        handler.initialize(webapp.Request.blank('/ndt'), webapp.Response())
+        if response_format == message.FORMAT_BT:
+            handler.send_bt_response(fleet, query)
+        else:
+            handler.send_json_response(fleet, query)
+
+    return min(timeit.repeat(send_response, number=1, repeat=repeat))
+
+
+def main(sdk_path, options):
+    sys.path.insert(0, sdk_path)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    from mlabns.util import message
+
+    print '%-6s %8s %12s %16s' % ('format', 'slivers', 'total (ms)',
+                                  'per sliver (us)')
+    for response_format in [message.FORMAT_BT, message.FORMAT_JSON]:
+        for size in FLEET_SIZES:
+            elapsed = benchmark(response_format, make_fleet(size),
+                                options.repeat)
+            print '%-6s %8d %12.3f %16.3f' % (response_format, size,
+                                              elapsed * 1e3,
+                                              elapsed * 1e6 / size)
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(USAGE)
+    parser.add_option('--repeat', type='int', default=20,
+                      help='Number of runs per fleet size (the best is kept)')
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        print 'Error: Exactly 1 argument required.'
+        parser.print_help()
+        sys.exit(1)
+    SDK_PATH = args[0]
+    main(SDK_PATH, options)
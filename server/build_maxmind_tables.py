@@ -0,0 +1,123 @@
+#!/usr/bin/python
+import csv
+import optparse
+import os
+import sys
+
+USAGE = """%prog [options] SDK_PATH
+Compile the Maxmind GeoLite City CSV files into the range tables read by
+mlabns.util.maxmind (see maxmind.RangeTable for the file format).
+
+SDK_PATH    Path to the SDK installation"""
+
+
+def _read_rows(path, numeric_column):
+    """Yields the CSV rows of 'path', skipping the copyright and header lines.
+
+    Data rows are recognized by having a number in 'numeric_column'.
+    """
+    with open(path, 'rb') as csv_file:
+        for row in csv.reader(csv_file, skipinitialspace=True):
+            if len(row) > numeric_column and row[numeric_column].isdigit():
+                yield row
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def read_ipv4_ranges(blocks_path, locations_path):
+    """Reads GeoLiteCity-Blocks.csv and GeoLiteCity-Location.csv.
+
+    Returns:
+        A list of (start_ip_num, end_ip_num, GeoRecord) tuples.
+    """
+    from mlabns.util import maxmind
+
+    # locId,country,region,city,postalCode,latitude,longitude,...
+    locations = {}
+    for row in _read_rows(locations_path, 0):
+        locations[row[0]] = maxmind.GeoRecord(
+            city=row[3].decode('latin-1'), country=row[1],
+            latitude=_to_float(row[5]), longitude=_to_float(row[6]))
+
+    # startIpNum,endIpNum,locId
+    ranges = []
+    for row in _read_rows(blocks_path, 0):
+        if row[2] not in locations:
+            print 'Skipping range %s-%s: unknown location %s.' % (
+                row[0], row[1], row[2])
+            continue
+        ranges.append((long(row[0]), long(row[1]), locations[row[2]]))
+    return ranges
+
+
+def read_ipv6_ranges(blocks_path):
+    """Reads GeoLiteCityv6.csv.
+
+    As in the MaxmindCityBlockv6 table, only /64 prefixes are kept.
+
+    Returns:
+        A list of (start_ip_num, end_ip_num, GeoRecord) tuples.
+    """
+    from mlabns.util import constants
+    from mlabns.util import maxmind
+
+    # startIp,endIp,startIpNum,endIpNum,country,region,city,postal,lat,lon,...
+    ranges = []
+    for row in _read_rows(blocks_path, 2):
+        ranges.append((long(row[2]) >> 64, long(row[3]) >> 64,
+                       maxmind.GeoRecord(
+                           city=constants.UNKNOWN_CITY, country=row[4],
+                           latitude=_to_float(row[8]),
+                           longitude=_to_float(row[9]))))
+    return ranges
+
+
+def write_range_table(ranges, path):
+    from mlabns.util import maxmind
+
+    with open(path, 'wb') as range_table_file:
+        range_table_file.write(maxmind.build_range_table(ranges))
+    print 'Wrote %d ranges to %s.' % (len(ranges), path)
+
+
+def main(sdk_path, options):
+    sys.path.insert(0, sdk_path)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    from mlabns.util import constants
+
+    mlabns_dir = os.path.join(os.path.dirname(__file__), 'mlabns')
+    data_dir = os.path.dirname(
+        os.path.join(mlabns_dir, constants.MAXMIND_IPV4_RANGE_TABLE))
+    if not os.path.isdir(data_dir):
+        os.makedirs(data_dir)
+    if options.blocks and options.locations:
+        write_range_table(
+            read_ipv4_ranges(options.blocks, options.locations),
+            os.path.join(mlabns_dir, constants.MAXMIND_IPV4_RANGE_TABLE))
+    if options.blocks_v6:
+        write_range_table(
+            read_ipv6_ranges(options.blocks_v6),
+            os.path.join(mlabns_dir, constants.MAXMIND_IPV6_RANGE_TABLE))
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(USAGE)
+    parser.add_option('--blocks', help='Path to GeoLiteCity-Blocks.csv')
+    parser.add_option('--locations', help='Path to GeoLiteCity-Location.csv')
+    parser.add_option('--blocks_v6', help='Path to GeoLiteCityv6.csv')
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        print 'Error: Exactly 1 argument required.'
+        parser.print_help()
+        sys.exit(1)
+    if bool(options.blocks) != bool(options.locations):
+        print 'Error: --blocks and --locations must be used together.'
+        sys.exit(1)
+    SDK_PATH = args[0]
+    main(SDK_PATH, options)
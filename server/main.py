@@ -14,9 +14,11 @@ app = webapp.WSGIApplication(
     (r'/cron/check_status', update.StatusUpdateHandler),
     (r'/cron/check_ip', update.IPUpdateHandler),
     (r'/cron/check_site', update.SiteRegistrationHandler),
+    (r'/cron/flush_lookup_log', lookup.LookupLogFlushHandler),
     (r'/privacy', privacy.PrivacyHandler),
     (r'/docs', docs.DocsHandler),
     # (r'/cron/process_logs', log2bq.Log2BigQueryHandler),
+    (r'/batch', lookup.BatchLookupHandler),
     (r'/.*', lookup.LookupHandler)],
     debug=True )
 
@@ -1,6 +1,11 @@
 from google.appengine.ext import db
+from mlabns.util import conditional_fetch
 from mlabns.util import constants
+from mlabns.util import json_fragments
+from mlabns.util import log_policy
+import collections
 import logging
+import time
 
 # The classes defined in this file are described in detail in
 # the design doc at http://goo.gl/48S22.
@@ -39,6 +44,29 @@ class SliverTool(db.Model):
     # Date representing the last modification time of this entity.
     when = db.DateTimeProperty(auto_now=True)
 
+# SliverTool fields copied into a SliverToolSnapshot.
+SNAPSHOT_FIELDS = [
+    'tool_id', 'slice_id', 'site_id', 'server_id', 'server_port',
+    'http_port', 'tool_extra', 'fqdn', 'sliver_ipv4', 'sliver_ipv6',
+    'status_ipv4', 'status_ipv6', 'latitude', 'longitude', 'city',
+    'country']
+
+class SliverToolSnapshot(collections.namedtuple(
+    'SliverToolSnapshot', SNAPSHOT_FIELDS + ['json_fragments'])):
+    """Immutable copy of the SliverTool fields used to answer lookups.
+
+    This is what the update handlers store in memcache instead of SliverTool
+    entities: it pickles as a plain tuple, without the datastore metadata.
+    'json_fragments' holds the pre-rendered JSON lookup responses (see
+    json_fragments.get_json_fragments), or None.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_sliver_tool(cls, sliver_tool, fragments=None):
+        return cls(*([getattr(sliver_tool, field) for field in SNAPSHOT_FIELDS]
+                     + [fragments]))
+
 class Site(db.Model):
     site_id = db.StringProperty()
     city = db.StringProperty()
@@ -115,6 +143,14 @@ class Tool(db.Model):
     http_port = db.StringProperty()
     show_tool_extra = db.BooleanProperty()
 
+    def put(self, **kwargs):
+        key = super(Tool, self).put(**kwargs)
+        invalidate_tool_cache()
+        # The unchanged IP list and Nagios inputs now apply to the sliver
+        # tools of this tool.
+        conditional_fetch.invalidate()
+        return key
+
 class Nagios(db.Model):
     key_id = db.StringProperty()
     username = db.StringProperty()
@@ -162,9 +198,77 @@ def get_slice_site_server_ids(fqdn):
     slice_id = '_'.join([ slice_id_part2, slice_id_part1])
     return slice_id, site_id, server_id
 
+# Cache of the Tool entities (key=tool_id), see get_tool_from_tool_id.
+_tool_cache = {'tools': {}, 'expiry': 0}
+
 def get_tool_from_tool_id(tool_id):
-    tools_gql = Tool.gql("WHERE tool_id = :tool_id", tool_id=tool_id)
-    for tool in tools_gql.run():
-        return tool
-    logging.info('Tool %s not found in data store.', tool_id)
+    """Returns the Tool entity of a tool id, or None if it does not exist.
+
+    All the Tool entities are loaded at once and cached for TOOL_CACHE_TTL
+    seconds, or until a Tool is written by this instance. The update
+    handlers invalidate the cache before publishing sliver tool snapshots.
+    """
+    now = time.time()
+    if now >= _tool_cache['expiry']:
+        tools = {}
+        for tool in Tool.all().run(batch_size=constants.GQL_BATCH_SIZE):
+            tools.setdefault(tool.tool_id, tool)
+        _tool_cache['tools'] = tools
+        _tool_cache['expiry'] = now + constants.TOOL_CACHE_TTL
+
+    if tool_id in _tool_cache['tools']:
+        return _tool_cache['tools'][tool_id]
+    log_policy.info('Tool %s not found in data store.', tool_id)
     return None
+
+def invalidate_tool_cache():
+    _tool_cache['expiry'] = 0
+
+def put_in_batches(entities, batch_size=constants.PUT_BATCH_SIZE,
+                   retries=constants.PUT_RETRIES):
+    """Writes entities to the datastore with batched db.put calls.
+
+    Each batch is retried up to 'retries' times, independently of the other
+    batches.
+
+    Args:
+        entities: A list of db.Model instances.
+        batch_size: An integer representing the maximum number of entities
+            written by a single db.put.
+        retries: An integer representing the number of times a failed batch
+            is retried.
+
+    Returns:
+        A list of the entities that could not be written.
+    """
+    failed_entities = []
+    for start in range(0, len(entities), batch_size):
+        batch = entities[start:start + batch_size]
+        for attempt in range(retries + 1):
+            if attempt:
+                time.sleep(constants.PUT_RETRY_DELAY * 2 ** (attempt - 1))
+            try:
+                db.put(batch)
+                break
+            except (db.Timeout, db.TransactionFailedError,
+                    db.InternalError) as e:
+                logging.warning('Failed to write %d entities (attempt %d): %s',
+                                len(batch), attempt + 1, e)
+        else:
+            failed_entities.extend(batch)
+    return failed_entities
+
+def get_sliver_tool_snapshots(sliver_tools):
+    """Returns a list of SliverToolSnapshot for a list of SliverTools.
+
+    The JSON lookup responses of each sliver tool are rendered here, once per
+    update, instead of on every lookup.
+    """
+    snapshots = []
+    for sliver_tool in sliver_tools:
+        tool = get_tool_from_tool_id(sliver_tool.tool_id)
+        show_tool_extra = tool is not None and tool.show_tool_extra
+        snapshots.append(SliverToolSnapshot.from_sliver_tool(
+            sliver_tool,
+            json_fragments.get_json_fragments(sliver_tool, show_tool_extra)))
+    return snapshots
@@ -3,11 +3,12 @@ from django.utils import simplejson
 from google.appengine.api import memcache
 from google.appengine.ext import db
 from google.appengine.ext import webapp
-from google.appengine.ext.webapp import template
 
 from mlabns.db import model
 from mlabns.util import constants
+from mlabns.util import maxmind
 from mlabns.util import message
+from mlabns.util import stage_timer
 from mlabns.util import util
 
 import gflags
@@ -26,6 +27,7 @@ class AdminHandler(webapp.RequestHandler):
             '/admin' : lambda : self.redirect('/admin/map/ipv4/all'),
             '/admin/sites' : lambda : self.site_view(),
             '/admin/sliver_tools' : lambda : self.sliver_tool_view(),
+            '/admin/timings' : lambda : self.timings_view(),
             '/admin/map' : lambda : self.redirect('/admin/map/ipv4/all'),
             '/admin/map/ipv4' : lambda : self.redirect(
                 '/admin/map/ipv4/all'),
@@ -87,7 +89,7 @@ class AdminHandler(webapp.RequestHandler):
                   'privacy_doc_url' : constants.PRIVACY_DOC_URL,
                   'design_doc_url' : constants.DESIGN_DOC_URL}
         self.response.out.write(
-            template.render('mlabns/templates/sliver_tool.html', values))
+            util.render_template('sliver_tool.html', values))
 
     def site_view(self):
         """Returns an HTML page containing sites information."""
@@ -117,7 +119,23 @@ class AdminHandler(webapp.RequestHandler):
                   'privacy_doc_url' : constants.PRIVACY_DOC_URL,
                   'design_doc_url' : constants.DESIGN_DOC_URL}
         self.response.out.write(
-            template.render('mlabns/templates/site.html', values))
+            util.render_template('site.html', values))
+
+    def timings_view(self):
+        """Returns an HTML page containing the lookup stage durations.
+
+        The durations, and the geolocation cache counters, only cover the
+        lookups served by the instance answering this request (see
+        stage_timer.StageTimings).
+        """
+        values = {'records' : stage_timer.timings.get_summary(),
+                  'headers': stage_timer.SUMMARY_HEADERS,
+                  'geolocation_cache_counts' : sorted(
+                      maxmind.geolocation_cache.get_counts().items()),
+                  'privacy_doc_url' : constants.PRIVACY_DOC_URL,
+                  'design_doc_url' : constants.DESIGN_DOC_URL}
+        self.response.out.write(
+            util.render_template('timings.html', values))
 
     def map_view(self, tool_id, address_family):
         """Displays a per tool map with the status of the slivers.
@@ -146,13 +164,12 @@ class AdminHandler(webapp.RequestHandler):
 
         data = self.get_sites_info(sliver_tools, address_family)
         json_data = simplejson.dumps(data)
-        file_name = '' . join(['mlabns/templates/map_view.html'])
         values = {'cities' : json_data,
                   'tool_id' : tool_id,
                   'address_family' : address_family,
                   'privacy_doc_url' : constants.PRIVACY_DOC_URL,
                   'design_doc_url' : constants.DESIGN_DOC_URL}
-        self.response.out.write(template.render(file_name, values))
+        self.response.out.write(util.render_template('map_view.html', values))
 
     def get_sites_info(self, sliver_tools, address_family):
         """Returns info about the sites.
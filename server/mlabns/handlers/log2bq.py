@@ -20,6 +20,7 @@ from mapreduce import base_handler, mapreduce_pipeline
 from mapreduce.lib import pipeline
 
 from mlabns import util
+from mlabns.util import lookup_log
 
 import config
 
@@ -65,6 +66,13 @@ def log2csv(request_log):
 
   row = None
   for app_log in request_log.app_logs:
+    # Batches of lookup records are already written as CSV lines in the
+    # order of the BigQuery schema.
+    if app_log.message.startswith(lookup_log.LOG_TAG):
+      yield app_log.message[len(lookup_log.LOG_TAG):]
+      continue
+
+    # Lookups logged one per request by older versions.
     words = app_log.message.split(',')
     if words[0] == '[lookup]':
       row = app_log.message.split(',')[1:]
@@ -102,6 +110,11 @@ class Gs2Bq(base_handler.PipelineBase):
                                    },
                                    'createDisposition':'CREATE_IF_NEEDED',
                                    'writeDisposition':'WRITE_APPEND',
+                                   # Lets the load relax the REQUIRED
+                                   # columns of tables created with an
+                                   # older schema.
+                                   'schemaUpdateOptions':[
+                                       'ALLOW_FIELD_RELAXATION'],
                                    'encoding':'UTF-8'
                               }}}).execute()
     yield BqCheck(result['jobReference']['jobId'])
@@ -3,22 +3,38 @@ from google.appengine.api import taskqueue
 from google.appengine.ext import db
 from google.appengine.ext import deferred
 from google.appengine.ext import webapp
-from google.appengine.ext.webapp import template
 
 from mlabns.db import model
 from mlabns.util import constants
+from mlabns.util import json_fragments
+from mlabns.util import log_policy
+from mlabns.util import lookup_log
 from mlabns.util import message
 from mlabns.util import lookup_query
 from mlabns.util import resolver
+from mlabns.util import response_cache
+from mlabns.util import stage_timer
 from mlabns.util import util
 
+import collections
 import json
 import logging
 import time
 
+class LookupLogFlushHandler(webapp.RequestHandler):
+    """Writes the queued lookup records to the app logs (cron job)."""
+
+    def get(self):
+        logging.info('Wrote the records of %d lookups.', lookup_log.flush())
+
+
 class LookupHandler(webapp.RequestHandler):
     """Routes GET requests to the appropriate SliverTools."""
 
+    def initialize(self, request, response):
+        webapp.RequestHandler.initialize(self, request, response)
+        self._start_time = time.time()
+
     def post(self):
         """Not implemented."""
         return util.send_not_found(self)
@@ -35,32 +51,39 @@ class LookupHandler(webapp.RequestHandler):
         query = lookup_query.LookupQuery()
         query.initialize_from_http_request(self.request)
 
-        logging.info('Policy is %s', query.policy)
+        log_policy.info('Policy is %s', query.policy)
+        if self.send_cached_response(query):
+            return self.record_timings(query)
+
         lookup_resolver = resolver.new_resolver(query.policy)
-        sliver_tools = lookup_resolver.answer_query(query)
+        with query.timer.time(stage_timer.STAGE_ANSWER_QUERY):
+            sliver_tools = lookup_resolver.answer_query(query)
 
         if sliver_tools is None:
+            self.record_timings(query)
             return util.send_not_found(self, query.response_format)
 
-        if query.response_format == message.FORMAT_JSON:
-            self.send_json_response(sliver_tools, query)
-        elif query.response_format == message.FORMAT_HTML:
-            self.send_html_response(sliver_tools, query)
-        elif query.response_format == message.FORMAT_REDIRECT:
-            self.send_redirect_response(sliver_tools, query)
-        elif query.response_format == message.FORMAT_BT:
-            self.send_bt_response(sliver_tools, query)
-        elif query.response_format == message.FORMAT_MAP:
-            candidates = lookup_resolver.get_candidates(query)
-            self.send_map_response(sliver_tool, query, candidates)
-        else:
-            # TODO (claudiu) Discuss what should be the default behaviour.
-            # I think json it's OK since is valid for all tools, while
-            # redirect only applies to web-based tools (e.g., npad)
-            self.send_json_response(sliver_tools, query)
+        with query.timer.time(stage_timer.STAGE_RENDER):
+            if query.response_format == message.FORMAT_JSON:
+                self.send_json_response(sliver_tools, query)
+            elif query.response_format == message.FORMAT_HTML:
+                self.send_html_response(sliver_tools, query)
+            elif query.response_format == message.FORMAT_REDIRECT:
+                self.send_redirect_response(sliver_tools, query)
+            elif query.response_format == message.FORMAT_BT:
+                self.send_bt_response(sliver_tools, query)
+            elif query.response_format == message.FORMAT_MAP:
+                candidates = lookup_resolver.get_candidates(query)
+                self.send_map_response(sliver_tool, query, candidates)
+            else:
+                # TODO (claudiu) Discuss what should be the default behaviour.
+                # I think json it's OK since is valid for all tools, while
+                # redirect only applies to web-based tools (e.g., npad)
+                self.send_json_response(sliver_tools, query)
 
         # TODO (claudiu) Add a FORMAT_TYPE column in the BigQuery schema.
         self.log_request(query, sliver_tools)
+        self.record_timings(query)
 
     def send_bt_response(self, sliver_tools, query):
         """Sends the response to the lookup request in bt format.
@@ -75,22 +98,14 @@ class LookupHandler(webapp.RequestHandler):
             logging.error("Problem: sliver_tools is not a list.")
             return
 
-        bt_data = "";
+        bt_fragments = []
         for sliver_tool in sliver_tools:
             fqdn = self._add_fqdn_annotation(query, sliver_tool.fqdn)
-
-            data = sliver_tool.city
-            data += ", "
-            data += sliver_tool.country
-
-            data += "|"
-            data += fqdn
-            data += "\n"
-
-            bt_data += data
-        self.response.headers['Access-Control-Allow-Origin'] = '*'
-        self.response.headers['Content-Type'] = 'text/html'
-        self.response.out.write(bt_data)
+            bt_fragments.append(''.join([sliver_tool.city, ', ',
+                                         sliver_tool.country, '|', fqdn,
+                                         '\n']))
+        self.send_cacheable_response(bt_fragments, 'text/html', sliver_tools,
+                                     query)
 
     def send_json_response(self, sliver_tools, query):
         """Sends the response to the lookup request in json format.
@@ -109,59 +124,114 @@ class LookupHandler(webapp.RequestHandler):
             logging.error("Problem: sliver_tools is not a list.")
             return
 
-        tool = None
-        json_data = "";
+        fragments = []
         for sliver_tool in sliver_tools:
-            data = {}
+            if fragments:
+                fragments.append(',')
+            fragments.append(self._get_json_fragment(sliver_tool, query))
 
-            ip = []
+        if array_response:
+            fragments.insert(0, '[')
+            fragments.append(']')
+        self.send_cacheable_response(fragments, 'application/json',
+                                     sliver_tools, query)
 
-            if tool == None:
-                tool = model.get_tool_from_tool_id(sliver_tool.tool_id)
+    def send_cached_response(self, query):
+        """Answers the lookup request from the response cache, if possible.
 
-            logging.info('user_defined_af = %s', query.user_defined_af)
-            if query.user_defined_af == message.ADDRESS_FAMILY_IPv4:
-                ip = [sliver_tool.sliver_ipv4]
-            elif query.user_defined_af == message.ADDRESS_FAMILY_IPv6:
-                ip = [sliver_tool.sliver_ipv6]
-            else:
-                # If 'address_family' is not specified, the default is to
-                # return both valid IP addresses (if both 'status_ipv4' and
-                # 'status_ipv6' are 'online').
-                # Although the update will only set the sliver as online if it
-                # has a valid IP address, the resolver still returns it as
-                # a candidate.
-                if (sliver_tool.sliver_ipv4 != message.NO_IP_ADDRESS and
-                    sliver_tool.status_ipv4 == message.STATUS_ONLINE):
-                    ip.append(sliver_tool.sliver_ipv4)
-                if (sliver_tool.sliver_ipv6 != message.NO_IP_ADDRESS and
-                    sliver_tool.status_ipv6 == message.STATUS_ONLINE):
-                    ip.append(sliver_tool.sliver_ipv6)
+        Args:
+            query: A LookupQuery instance representing the user lookup request.
 
-            fqdn = self._add_fqdn_annotation(query, sliver_tool.fqdn)
-            if sliver_tool.http_port:
-                data['url'] = ''.join([ 'http://', fqdn, ':', sliver_tool.http_port])
-            if sliver_tool.server_port:
-                data['port'] = sliver_tool.server_port
+        Returns:
+            True if the request was answered, False otherwise.
+        """
+        start = time.time()
+        cache_key = response_cache.get_key(query)
+        if cache_key is None:
+            return False
+
+        cached = None
+        # A client that already holds one of the cached responses keeps it.
+        if_none_match = self.request.headers.get('If-None-Match')
+        if if_none_match:
+            for variant in response_cache.response_cache.get_variants(
+                cache_key):
+                if variant.etag == if_none_match:
+                    cached = variant
+                    break
+        if cached is None:
+            cached = response_cache.response_cache.get(cache_key)
+        if cached is None:
+            return False
+
+        query.distance = cached.distance
+        self._write_cacheable_response([cached.body], cached.etag,
+                                       cached.content_type)
+        query.timer.add(stage_timer.STAGE_CACHED_RESPONSE, time.time() - start)
+        self.log_request(query, list(cached.sliver_tools))
+        return True
+
+    def send_cacheable_response(self, fragments, content_type, sliver_tools,
+                                query):
+        """Sends a response and adds it to the response cache.
 
-            data['fqdn'] = fqdn
-            data['ip'] = ip
-            data['site'] = sliver_tool.site_id
-            data['city'] = sliver_tool.city
-            data['country'] = sliver_tool.country
+        Args:
+            fragments: A list of strings whose concatenation is the response
+                body.
+            content_type: A string representing the Content-Type header.
+            sliver_tools: A list of SliverTool instances included in the
+                response.
+            query: A LookupQuery instance representing the user lookup request.
+        """
+        etag = response_cache.get_etag(fragments)
+        cache_key = response_cache.get_key(query)
+        if cache_key is not None:
+            body = ''.join(fragments)
+            fragments = [body]
+            response_cache.response_cache.add(
+                cache_key,
+                response_cache.CachedResponse(body, etag, content_type,
+                                              tuple(sliver_tools),
+                                              query.distance))
+        self._write_cacheable_response(fragments, etag, content_type)
+
+    def _write_cacheable_response(self, fragments, etag, content_type):
+        """Writes a response with validators, or 304 if the client has it."""
+        self.response.headers['Access-Control-Allow-Origin'] = '*'
+        self.response.headers['Content-Type'] = content_type
+        self.response.headers['ETag'] = etag
+        # Lookups are geolocated by client address, so shared caches must not
+        # serve them to other clients.
+        self.response.headers['Cache-Control'] = (
+            'private, max-age=%d' % constants.RESPONSE_MAX_AGE)
+        if self.request.headers.get('If-None-Match') == etag:
+            self.response.set_status(304)
+            return
+        for fragment in fragments:
+            self.response.out.write(fragment)
 
-            if sliver_tool.tool_extra and tool.show_tool_extra:
-                data['tool_extra'] = sliver_tool.tool_extra
+    def _get_json_fragment(self, sliver_tool, query):
+        """Returns the serialized JSON object of a sliver tool.
 
-            if json_data != "":
-                json_data += ","
-            json_data += json.dumps(data)
+        Sliver tools read from memcache carry their JSON already rendered by
+        the update handlers. Others (e.g., read from the datastore) are
+        rendered here.
 
-        if array_response:
-            json_data = "[" + json_data + "]"
-        self.response.headers['Access-Control-Allow-Origin'] = '*'
-        self.response.headers['Content-Type'] = 'application/json'
-        self.response.out.write(json_data)
+        Args:
+            sliver_tool: A SliverTool instance.
+            query: A LookupQuery instance representing the user lookup request.
+
+        Returns:
+            A string representing a JSON object.
+        """
+        fragments = getattr(sliver_tool, 'json_fragments', None)
+        if fragments is not None and query.user_defined_af in fragments:
+            return fragments[query.user_defined_af]
+
+        tool = model.get_tool_from_tool_id(sliver_tool.tool_id)
+        return json.dumps(json_fragments.get_json_data(
+            sliver_tool, query.user_defined_af,
+            tool is not None and tool.show_tool_extra))
 
     def send_html_response(self, sliver_tools, query):
         """Sends the response to the lookup request in html format.
@@ -183,8 +253,7 @@ class LookupHandler(webapp.RequestHandler):
         values = {'records' : records}
         self.response.headers['Access-Control-Allow-Origin'] = '*'
         self.response.out.write(
-            template.render(
-                'mlabns/templates/lookup_response.html', values))
+            util.render_template('lookup_response.html', values))
 
     def send_redirect_response(self, sliver_tools, query):
         """Sends an HTTP redirect (for web-based tools only).
@@ -271,7 +340,7 @@ class LookupHandler(webapp.RequestHandler):
         user_info_json = json.dumps(user_info)
 
         self.response.out.write(
-            template.render('mlabns/templates/lookup_map.html', {
+            util.render_template('lookup_map.html', {
                 'sites' : candidate_site_list_json,
                 'user' : user_info_json,
                 'destination' : destination_site_json }))
@@ -279,36 +348,25 @@ class LookupHandler(webapp.RequestHandler):
     def _add_fqdn_annotation(self, query, fqdn):
         """Adds the v4/v6 only annotation to the fqdn.
 
-        Example:
-            fqdn:       'npad.iupui.mlab3.ath01.measurement-lab.org'
-            ipv4 only:  'npad.iupui.mlab3v4.ath01.measurement-lab.org'
-            ipv6 only:  'npad.iupui.mlab3v6.ath01.measurement-lab.org'
-
         Args:
             query: A LookupQuery instance.
             fqdn: A string representing the fqdn.
 
         Returns:
-            A string representing the IPV4/IPV6 only annotated fqdn.
+            A string representing the IPV4/IPV6 only annotated fqdn (see
+            json_fragments.annotate_fqdn).
         """
-        fqdn_annotation = ''
-
-        if query.user_defined_af == message.ADDRESS_FAMILY_IPv4:
-            fqdn_annotation = 'v4'
-        elif query.user_defined_af == message.ADDRESS_FAMILY_IPv6:
-            fqdn_annotation = 'v6'
-
-        fqdn_parts = fqdn.split('.')
-        fqdn_parts[2] += fqdn_annotation
-
-        return '.'.join(fqdn_parts)
+        return json_fragments.annotate_fqdn(fqdn, query.user_defined_af)
 
     def log_request(self, query, sliver_tools):
         """Logs the request. Each entry in the log is uploaded to BigQuery.
 
+        The lookup records are queued, and written in batches off the
+        request path (see lookup_log.add_records).
+
         Args:
             query: A LookupQuery instance.
-            sliver_tool: SliverTool entity chosen in the server
+            sliver_tools: A list of SliverTool entities chosen in the server
                 selection phase.
         """
         if sliver_tools is None:
@@ -322,46 +380,73 @@ class LookupHandler(webapp.RequestHandler):
         if 'User-Agent' in self.request.headers:
             user_agent = self.request.headers['User-Agent']
 
-        sliver_tool_info = ""
-        for sliver_tool in sliver_tools:
-            fqdn = sliver_tool.fqdn
-            if query.user_defined_af:
-                fqdn = self._add_fqdn_annotation(query, sliver_tool.fqdn)
-            sliver_tool_info += "(%s %s %s %s %s %s %s %s %s %s %s) " % \
-                (sliver_tool.slice_id,
-                sliver_tool.server_id,
-                sliver_tool.sliver_ipv4,
-                sliver_tool.sliver_ipv6,
-                sliver_tool.fqdn,
-                fqdn,
-                sliver_tool.site_id,
-                sliver_tool.city,
-                sliver_tool.country,
-                sliver_tool.latitude,
-                sliver_tool.longitude)
-
         # See the privacy doc at http://mlab-ns.appspot.com/privacy.
-        # The list of these fields is consistent with the BigQuery schema,
-        # except for the request latency field, that is added in the log2bq.py
-        # since it's automatically computed by GAE for every request and
-        # included in the request_log object.
-        logging.info(
-            '[lookup]'
-            '%s,%s,%s,%s,'
-            '%s,'
-            '%s,%s,%s,%s,%s,%s,%s',
-            # Info about the user:
-            query.tool_address_family,
-            query.ip_address,
-            query.address_family,
-            user_agent,
-            sliver_tool_info,
-            # Info about the request:
-            query.tool_id,
-            query.policy,
-            query.response_format,
-            query._geolocation_type,
-            query.metro,
-            str(time.time()),
-            # Calculated information about the lookup:
-            str(query.distance))
+        lookup_log.add_records(lookup_log.get_records(
+            query, sliver_tools, user_agent, time.time() - self._start_time))
+
+    def record_timings(self, query):
+        """Records the stage durations of the request (see stage_timer).
+
+        Args:
+            query: A LookupQuery instance.
+        """
+        query.timer.add(stage_timer.STAGE_TOTAL, time.time() - self._start_time)
+        query.timer.finish(query.policy)
+
+
+class BatchLookupHandler(LookupHandler):
+    """Routes GET requests for several tools at once.
+
+    The URL must be in the following format:
+    'http://mlab-ns.appspot.com/batch?tool_id=ndt&tool_id=npad&query_string',
+    where query_string supports the same arguments as a single lookup. The
+    'policy' argument is either given once, for all the tools, or once per
+    tool, in the same order as the 'tool_id' arguments.
+
+    The response is a JSON object mapping each tool id to the (possibly
+    empty) list of sliver tools selected for it.
+    """
+
+    def get(self):
+        """Handles an HTTP GET request."""
+        tool_ids = self.request.get_all(message.TOOL_ID)
+        policies = self.request.get_all(message.POLICY)
+        if not tool_ids:
+            return util.send_not_found(self, message.FORMAT_JSON)
+        if len(policies) <= 1:
+            policies = (policies or [None]) * len(tool_ids)
+        elif len(policies) != len(tool_ids):
+            logging.error('Got %d policies for %d tools.', len(policies),
+                          len(tool_ids))
+            return util.send_not_found(self, message.FORMAT_JSON)
+
+        # The client is geolocated once, and its query is then copied for
+        # each tool.
+        query = lookup_query.LookupQuery()
+        query.initialize_from_http_request(self.request)
+
+        batch_data = collections.OrderedDict()
+        for tool_id, policy in zip(tool_ids, policies):
+            if tool_id in batch_data:
+                continue
+            tool_query = query.copy_for_tool(tool_id, policy)
+            lookup_resolver = resolver.new_resolver(tool_query.policy)
+            with tool_query.timer.time(stage_timer.STAGE_ANSWER_QUERY):
+                sliver_tools = lookup_resolver.answer_query(tool_query)
+
+            fragments = []
+            if sliver_tools:
+                with tool_query.timer.time(stage_timer.STAGE_RENDER):
+                    for sliver_tool in sliver_tools:
+                        fragments.append(
+                            self._get_json_fragment(sliver_tool, tool_query))
+                self.log_request(tool_query, sliver_tools)
+            tool_query.timer.finish(tool_query.policy)
+            batch_data[tool_id] = '%s:[%s]' % (json.dumps(tool_id),
+                                               ','.join(fragments))
+
+        self.response.headers['Access-Control-Allow-Origin'] = '*'
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.out.write('{' + ','.join(batch_data.values()) + '}')
+        # The shared query only holds the client parsing and geolocation.
+        self.record_timings(query)
@@ -6,12 +6,17 @@ from google.appengine.ext.webapp import template
 import json
 import logging
 import re
+import socket
 import time
 import urllib2
 
 from mlabns.db import model
+from mlabns.util import candidate_cache
+from mlabns.util import conditional_fetch
 from mlabns.util import constants
 from mlabns.util import message
+from mlabns.util import parallel
+from mlabns.util import sliver_store
 from mlabns.util import util
 
 
@@ -56,15 +61,20 @@ class SiteRegistrationHandler(webapp.RequestHandler):
     def get(self):
         """Triggers the registration handler.
 
-        Checks if new sites were added to ks and registers them.
+        Checks if new sites were added to ks and registers them. Nothing is
+        done if the site list did not change since it was last processed.
         """
         try:
-            ks_sites_json = json.loads(
-                urllib2.urlopen(self.SITE_LIST_URL).read())
+            site_list = conditional_fetch.fetch(self.SITE_LIST_URL)
         except urllib2.HTTPError:
             # TODO(claudiu) Notify(email) when this happens.
             logging.error('Cannot open %s.', self.SITE_LIST_URL)
             return util.send_not_found(self)
+        if not site_list.changed:
+            return util.send_success(self)
+
+        try:
+            ks_sites_json = json.loads(site_list.content)
         except (TypeError, ValueError) as e:
             logging.error('The json format of %s in not valid: %s',
                           self.SITE_LIST_URL, e)
@@ -81,9 +91,11 @@ class SiteRegistrationHandler(webapp.RequestHandler):
             ks_site_ids.add(ks_site[self.SITE_FIELD])
 
         mlab_site_ids = set()
+        site_metros = []
         mlab_sites = model.Site.all()
         for site in mlab_sites:
             mlab_site_ids.add(site.site_id)
+            site_metros.append((site.site_id, site.metro))
 
         unchanged_site_ids = ks_site_ids.intersection(mlab_site_ids)
         new_site_ids = ks_site_ids.difference(mlab_site_ids)
@@ -99,6 +111,7 @@ class SiteRegistrationHandler(webapp.RequestHandler):
             logging.info(
                 'Site %s unchanged in %s.', site_id, self.SITE_LIST_URL)
 
+        registration_failed = False
         for ks_site in valid_ks_sites_json:
             if (ks_site[self.SITE_FIELD] in new_site_ids):
                 logging.info('Registering site %s.', ks_site[self.SITE_FIELD])
@@ -106,8 +119,17 @@ class SiteRegistrationHandler(webapp.RequestHandler):
                 if not self.register_site(ks_site):
                     logging.error(
                         'Error registering site %s.', ks_site[self.SITE_FIELD])
+                    registration_failed = True
                     continue
-
+                site_metros.append(
+                    (ks_site[self.SITE_FIELD], ks_site[self.METRO_FIELD]))
+
+        candidate_cache.publish_metros(site_metros)
+        if new_site_ids:
+            # The IP list now applies to the sliver tools of the new sites.
+            conditional_fetch.invalidate()
+        if not registration_failed:
+            site_list.commit()
         return util.send_success(self)
 
 
@@ -177,19 +199,37 @@ class IPUpdateHandler(webapp.RequestHandler):
     def get(self):
         """Triggers the update handler.
 
-        Updates sliver tool IP addresses from ks.
+        Updates sliver tool IP addresses from ks. Nothing is done if the IP
+        list did not change since it was last processed.
         """
-        ip = {}
-        lines = []
+        # The sliver tool snapshots embed the Tool entities, which may have
+        # been written on another instance since they were cached.
+        model.invalidate_tool_cache()
         try:
-            lines = urllib2.urlopen(
-                self.IP_LIST_URL).read().strip('\n').split('\n')
+            ip_list = conditional_fetch.fetch(self.IP_LIST_URL)
         except urllib2.HTTPError:
             # TODO(claudiu) Notify(email) when this happens.
             logging.error('Cannot open %s.', self.IP_LIST_URL)
             return util.send_not_found(self)
-
-        sliver_tool_list = {}
+        if not ip_list.changed:
+            return util.send_success(self)
+        lines = ip_list.content.strip('\n').split('\n')
+
+        # Index the sliver tools, tools and sites once, instead of querying
+        # them for each line.
+        sliver_tools = {}
+        for sliver_tool in model.SliverTool.all().run(
+            batch_size=constants.GQL_BATCH_SIZE):
+            sliver_tools[sliver_tool.fqdn] = sliver_tool
+        tools = {}
+        for tool in model.Tool.all().run(batch_size=constants.GQL_BATCH_SIZE):
+            tools.setdefault(tool.slice_id, tool)
+        sites = {}
+        for site in model.Site.all().run(batch_size=constants.GQL_BATCH_SIZE):
+            sites.setdefault(site.site_id, site)
+
+        listed_sliver_tools = []
+        updated_sliver_tools = []
         for line in lines:
             # Expected format: "FQDN,IPv4,IPv6" (IPv6 can be an empty string).
             line_fields = line.split(',')
@@ -200,10 +240,8 @@ class IPUpdateHandler(webapp.RequestHandler):
             ipv4 = line_fields[1]
             ipv6 = line_fields[2]
 
-            sliver_tool_gql = model.SliverTool.gql('WHERE fqdn=:fqdn',
-                                                   fqdn=fqdn)
-            # FQDN is unique so get() should be enough.
-            sliver_tool = sliver_tool_gql.get()
+            # FQDN is unique.
+            sliver_tool = sliver_tools.get(fqdn)
 
             # case 1) Sliver tool has not changed. Nothing to do.
             if (sliver_tool != None and sliver_tool.sliver_ipv4 == ipv4 and
@@ -224,20 +262,19 @@ class IPUpdateHandler(webapp.RequestHandler):
                     if slice_id is None or site_id is None or server_id is None:
                         logging.info('Non valid sliver fqdn %s.', fqdn)
                         continue
-                    tool = model.Tool.gql('WHERE slice_id=:slice_id',
-                                          slice_id=slice_id).get()
+                    tool = tools.get(slice_id)
                     if tool == None:
                         logging.info('mlab-ns does not support slice %s.',
                                      slice_id)
                         continue
-                    site = model.Site.gql('WHERE site_id=:site_id',
-                                          site_id=site_id).get()
+                    site = sites.get(site_id)
                     if site == None:
                         logging.info('mlab-ns does not support site %s.',
                                      site_id)
                         continue
                     sliver_tool = self.initialize_sliver_tool(
                         tool, site, server_id, fqdn)
+                    sliver_tools[fqdn] = sliver_tool
 
                 # case 2.2) Sliver tool exists in datastore.
                 if ipv4 != None:
@@ -248,33 +285,37 @@ class IPUpdateHandler(webapp.RequestHandler):
                     sliver_tool.sliver_ipv6 = ipv6
                 else:
                     sliver_tool.sliver_ipv6 = message.NO_IP_ADDRESS
+                updated_sliver_tools.append(sliver_tool)
+
+            listed_sliver_tools.append(sliver_tool)
+
+        failed_sliver_tools = model.put_in_batches(updated_sliver_tools)
+        logging.info('Wrote IPs of %d sliver tools in datastore.',
+                     len(updated_sliver_tools) - len(failed_sliver_tools))
+        if failed_sliver_tools:
+            logging.error('Failed to write IPs of %s in datastore.',
+                          ', '.join(sliver_tool.fqdn
+                                    for sliver_tool in failed_sliver_tools))
+        failed_ids = set(id(sliver_tool)
+                         for sliver_tool in failed_sliver_tools)
+        if len(updated_sliver_tools) > len(failed_sliver_tools):
+            # The Nagios status now applies to the new IP addresses.
+            conditional_fetch.invalidate()
+        if not failed_sliver_tools:
+            ip_list.commit()
 
-                try:
-                    sliver_tool.put()
-                    logging.info(
-                        'Succeeded to write IPs of %s (%s, %s) in datastore.',
-                        fqdn, ipv4, ipv6)
-                except db.TransactionFailedError:
-                    logging.error(
-                        'Failed to write IPs of %s (%s, %s) in datastore.',
-                        fqdn, ipv4, ipv6)
-                    continue
-
+        sliver_tool_list = {}
+        for sliver_tool in listed_sliver_tools:
+            if id(sliver_tool) in failed_ids:
+                continue
             if sliver_tool.tool_id not in sliver_tool_list:
                 sliver_tool_list[sliver_tool.tool_id] = []
             sliver_tool_list[sliver_tool.tool_id].append(sliver_tool)
-            logging.info('sliver %s to be added to memcache', sliver_tool.fqdn)
 
-        # Update memcache
-        # Never set the memcache to an empty list since it's more likely that
-        # this is a Nagios failure.
-        if sliver_tool_list:
-            for tool_id in sliver_tool_list.keys():
-                if not memcache.set(
-                    tool_id, sliver_tool_list[tool_id],
-                    namespace=constants.MEMCACHE_NAMESPACE_TOOLS):
-                    logging.error(
-                        'Failed to update sliver IP addresses in memcache.')
+        # Update memcache. Only the sliver tools that changed are written.
+        for tool_id in sliver_tool_list.keys():
+            sliver_store.publish(tool_id, model.get_sliver_tool_snapshots(
+                sliver_tool_list[tool_id]))
 
         return util.send_success(self)
 
@@ -320,6 +361,9 @@ class StatusUpdateHandler(webapp.RequestHandler):
         containing the information is stored in the Nagios db along with
         the credentials necessary to access the data.
         """
+        # The sliver tool snapshots embed the Tool entities, which may have
+        # been written on another instance since they were cached.
+        model.invalidate_tool_cache()
         nagios = model.Nagios.get_by_key_name(
             constants.DEFAULT_NAGIOS_ENTRY)
         if nagios is None:
@@ -330,10 +374,7 @@ class StatusUpdateHandler(webapp.RequestHandler):
         password_manager.add_password(
             None, nagios.url, nagios.username, nagios.password)
 
-        authhandler = urllib2.HTTPDigestAuthHandler(password_manager)
-        opener = urllib2.build_opener(authhandler)
-        urllib2.install_opener(opener)
-
+        slices = []
         tools_gql = model.Tool.gql('ORDER by tool_id DESC')
         for item in tools_gql.run(batch_size=constants.GQL_BATCH_SIZE):
             logging.info('Pulling status of %s from Nagios.', item.tool_id)
@@ -341,25 +382,67 @@ class StatusUpdateHandler(webapp.RequestHandler):
               slice_url = nagios.url + '?show_state=1&service_name=' + \
                     item.tool_id + family + \
                     "&plugin_output=1"
-
-              slice_status = self.get_slice_status(slice_url)
-              self.update_sliver_tools_status(slice_status, item.tool_id,
-                                              family)
+              slices.append((item.tool_id, family, slice_url))
+
+        # The pages of the tools missing from memcache are processed even if
+        # they did not change, to publish the tools again.
+        unpublished_tool_ids = set(
+            tool_id for tool_id, _, _ in slices
+            if not sliver_store.is_published(tool_id))
+
+        def fetch_slice(slice_entry):
+            tool_id, _, slice_url = slice_entry
+            # Digest authentication handlers keep the state of the
+            # authentication, so concurrent fetches cannot share one.
+            opener = urllib2.build_opener(
+                urllib2.HTTPDigestAuthHandler(password_manager))
+            try:
+                return conditional_fetch.fetch(
+                    slice_url, opener,
+                    conditional=tool_id not in unpublished_tool_ids)
+            except (urllib2.URLError, socket.error):
+                # TODO(claudiu) Notify(email) when this happens.
+                logging.error('Cannot open %s.', slice_url)
+                return None
+
+        # The Nagios pages are fetched concurrently, then processed in order.
+        # The unchanged pages are skipped.
+        slice_pages = parallel.map_concurrently(
+            fetch_slice, slices, constants.NAGIOS_MAX_CONCURRENT_FETCHES)
+        for (tool_id, family, _), slice_page in zip(slices, slice_pages):
+            if slice_page is None or not slice_page.changed:
+                continue
+            slice_status = self.parse_slice_status(slice_page.content)
+            if self.update_sliver_tools_status(slice_status, tool_id, family):
+                slice_page.commit()
         return util.send_success(self)
 
     def update_sliver_tools_status(self, slice_status, tool_id, family):
         """Updates status of sliver tools in input slice.
 
+        Only the sliver tools whose status changed are written to the
+        datastore, in batches (see model.put_in_batches).
+
         Args:
             slice_status: A dict that contains the status of the
                 slivers in the slice {key=fqdn, status:online|offline}
             tool_id: A string representing the fqdn that resolves
                 to an IP address.
+            family: A string representing the Nagios address family suffix
+                (AF_IPV4 or AF_IPV6).
+
+        Returns:
+            True if all the changed sliver tools were written, False
+            otherwise.
         """
+        if family not in StatusUpdateHandler.NAGIOS_AF_SUFFIXES:
+            logging.error('Unexpected address family: %s.', family)
+            return False
 
         sliver_tools_gql = model.SliverTool.gql('WHERE tool_id=:tool_id',
                                                 tool_id=tool_id)
         sliver_tool_list = []
+        updated_sliver_tools = []
         for sliver_tool in sliver_tools_gql.run(
             batch_size=constants.GQL_BATCH_SIZE):
             if sliver_tool.fqdn not in slice_status:
@@ -367,93 +450,105 @@ class StatusUpdateHandler(webapp.RequestHandler):
                               sliver_tool.fqdn)
                 continue
 
-            if family == StatusUpdateHandler.AF_IPV4:
-                if sliver_tool.sliver_ipv4 == message.NO_IP_ADDRESS:
-                    if sliver_tool.status_ipv4 == message.STATUS_OFFLINE:
-                        logging.info('No updates for sliver %s.',
-                                     sliver_tool.fqdn)
-                    else:
-                        logging.warning('Setting IPv4 status of %s to offline '\
-                                        'due to missing IP.', sliver_tool.fqdn)
-                        sliver_tool.status_ipv4 = message.STATUS_OFFLINE
-                else:
-                    if (sliver_tool.status_ipv4 == slice_status[
-                        sliver_tool.fqdn]['status'] and
-                        sliver_tool.tool_extra == slice_status[
-                            sliver_tool.fqdn]['tool_extra']):
-                        logging.info('No updates for sliver %s.',
-                                      sliver_tool.fqdn)
-                    else:
-                        sliver_tool.status_ipv4 = \
-                          slice_status[sliver_tool.fqdn]['status']
-                        sliver_tool.tool_extra = \
-                          slice_status[sliver_tool.fqdn]['tool_extra']
-            elif family == StatusUpdateHandler.AF_IPV6:
-                if sliver_tool.sliver_ipv6 == message.NO_IP_ADDRESS:
-                    if sliver_tool.status_ipv6 == message.STATUS_OFFLINE:
-                        logging.info('No updates for sliver %s.',
-                                     sliver_tool.fqdn)
-                    else:
-                        logging.warning('Setting IPv6 status for %s to offline'\
-                                        ' due to missing IP.', sliver_fqdn)
-                        sliver_tool.status_ipv6 = message.STATUS_OFFLINE
-                else:
-                    if (sliver_tool.status_ipv6 == slice_status[
-                        sliver_tool.fqdn]['status'] and
-                        sliver_tool.tool_extra == slice_status[
-                            sliver_tool.fqdn]['tool_extra']):
-                        logging.info('No updates for sliver %s.',
-                                      sliver_tool.fqdn)
-                    else:
-                        sliver_tool.status_ipv6 = \
-                          slice_status[sliver_tool.fqdn]['status']
-                        sliver_tool.tool_extra = \
-                          slice_status[sliver_tool.fqdn]['tool_extra']
-            else:
-                logging.error('Unexpected address family: %s.', family)
-                continue
-
-            sliver_tool.update_request_timestamp = long(time.time())
-            try:
-                sliver_tool.put()
-                logging.info(
-                    'Succeeded to update status of %s to %s in datastore.',
-                    sliver_tool.fqdn, slice_status[sliver_tool.fqdn])
-            except db.TransactionFailedError:
-                # TODO(claudiu) Trigger an event/notification.
-                logging.error(
-                    'Failed to update status of %s to %s in datastore.',
-                    sliver_tool.fqdn, slice_status[sliver_tool.fqdn])
-                continue
             sliver_tool_list.append(sliver_tool)
-            logging.info('sliver %s to be added to memcache', sliver_tool.fqdn)
+            if self.update_sliver_tool_status(
+                sliver_tool, slice_status[sliver_tool.fqdn], family):
+                sliver_tool.update_request_timestamp = long(time.time())
+                updated_sliver_tools.append(sliver_tool)
+            else:
+                logging.info('No updates for sliver %s.', sliver_tool.fqdn)
 
-        # Never set the memcache to an empty list since it's more likely that
-        # this is a Nagios failure.
+        failed_sliver_tools = model.put_in_batches(updated_sliver_tools)
+        logging.info('Updated status of %d sliver tools of %s%s in datastore.',
+                     len(updated_sliver_tools) - len(failed_sliver_tools),
+                     tool_id, family)
+        if failed_sliver_tools:
+            # TODO(claudiu) Trigger an event/notification.
+            logging.error(
+                'Failed to update status of %s in datastore.',
+                ', '.join(sliver_tool.fqdn
+                          for sliver_tool in failed_sliver_tools))
+            failed_ids = set(id(sliver_tool)
+                             for sliver_tool in failed_sliver_tools)
+            sliver_tool_list = [sliver_tool for sliver_tool in sliver_tool_list
+                                if id(sliver_tool) not in failed_ids]
+
+        # Update memcache. Only the sliver tools that changed are written,
+        # and the sliver tools unknown to Nagios are kept as they are.
         if sliver_tool_list:
-            if not memcache.set(tool_id, sliver_tool_list,
-                                namespace=constants.MEMCACHE_NAMESPACE_TOOLS):
-                logging.error('Failed to update sliver status in memcache.')
+            sliver_store.publish(
+                tool_id, model.get_sliver_tool_snapshots(sliver_tool_list))
+        return not failed_sliver_tools
+
+    def update_sliver_tool_status(self, sliver_tool, sliver_status, family):
+        """Applies the Nagios status of a sliver to a sliver tool.
+
+        Args:
+            sliver_tool: A SliverTool entity.
+            sliver_status: A dict {status:online|offline, tool_extra} as
+                returned by get_slice_status.
+            family: A string representing the Nagios address family suffix
+                (AF_IPV4 or AF_IPV6).
+
+        Returns:
+            True if the sliver tool changed, False otherwise.
+        """
+        if family == StatusUpdateHandler.AF_IPV4:
+            sliver_ip = sliver_tool.sliver_ipv4
+            status_field = 'status_ipv4'
+        else:
+            sliver_ip = sliver_tool.sliver_ipv6
+            status_field = 'status_ipv6'
+
+        if sliver_ip == message.NO_IP_ADDRESS:
+            if getattr(sliver_tool, status_field) == message.STATUS_OFFLINE:
+                return False
+            logging.warning('Setting %s of %s to offline due to missing IP.',
+                            status_field, sliver_tool.fqdn)
+            setattr(sliver_tool, status_field, message.STATUS_OFFLINE)
+            return True
 
-    def get_slice_status(self, url):
+        if (getattr(sliver_tool, status_field) == sliver_status['status'] and
+            sliver_tool.tool_extra == sliver_status['tool_extra']):
+            return False
+        setattr(sliver_tool, status_field, sliver_status['status'])
+        sliver_tool.tool_extra = sliver_status['tool_extra']
+        return True
+
+    def get_slice_status(self, url, opener=None):
         """Read slice status from Nagios.
 
         Args:
             url: String representing the URL to Nagios for a single slice.
+            opener: A urllib2.OpenerDirector used to fetch 'url'. Defaults to
+                the installed opener.
 
         Returns:
             A dict that contains the status of the slivers in this
-            slice {key=fqdn, status:online|offline}
+            slice {key=fqdn, status:online|offline}, or None if the
+            status cannot be read.
         """
-        status = {}
         try:
-            lines = urllib2.urlopen(url).read().strip('\n').split('\n')
-        except urllib2.HTTPError:
+            slice_page = conditional_fetch.fetch(url, opener,
+                                                 conditional=False)
+        except (urllib2.URLError, socket.error):
             # TODO(claudiu) Notify(email) when this happens.
             logging.error('Cannot open %s.', url)
             return None
+        return self.parse_slice_status(slice_page.content)
 
-        for line in lines:
+    def parse_slice_status(self, content):
+        """Parses a slice status page from Nagios.
+
+        Args:
+            content: A string representing the page of a single slice.
+
+        Returns:
+            A dict that contains the status of the slivers in this
+            slice {key=fqdn, status:online|offline}.
+        """
+        status = {}
+        for line in content.strip('\n').split('\n'):
             if len(line) == 0:
                 continue
             # See the design doc for a description of the file format.
@@ -0,0 +1,103 @@
+from google.appengine.ext import testbed
+
+import unittest2
+
+from mlabns.util import candidate_cache
+from mlabns.util import message
+
+
+# Sliver tools are pickled into memcache, so they cannot be mock.Mock objects.
+class MockSliverTool():
+
+    def __init__(self, site_id=None, status_ipv4=None, status_ipv6=None):
+        self.site_id = site_id
+        self.status_ipv4 = status_ipv4
+        self.status_ipv6 = status_ipv6
+        self.latitude = 0.0
+        self.longitude = 0.0
+
+
+class CandidateCacheTestCase(unittest2.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_memcache_stub()
+        candidate_cache.publish_metros([('s1', ['m1', 'm12']),
+                                        ('s2', ['m2', 'm12']),
+                                        ('s3', ['m3'])])
+
+        self.sliver_tools = [
+            MockSliverTool('s1', message.STATUS_ONLINE, message.STATUS_OFFLINE),
+            MockSliverTool('s1', message.STATUS_OFFLINE, message.STATUS_ONLINE),
+            MockSliverTool('s1', message.STATUS_OFFLINE, message.STATUS_ONLINE),
+            MockSliverTool('s2', message.STATUS_ONLINE, message.STATUS_ONLINE),
+            MockSliverTool('s1', message.STATUS_OFFLINE,
+                           message.STATUS_OFFLINE)]
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def testGetCandidatesNotPublished(self):
+        self.assertIsNone(candidate_cache.get_candidates(
+            'valid_tool_id', message.ADDRESS_FAMILY_IPv4))
+        self.assertIsNone(candidate_cache.get_candidates_from_sites(
+            'valid_tool_id', message.ADDRESS_FAMILY_IPv4, ['s1']))
+
+    def testGetCandidates(self):
+        self.assertTrue(candidate_cache.publish_candidates(
+            'valid_tool_id', self.sliver_tools))
+        self.assertEqual(2, len(candidate_cache.get_candidates(
+            'valid_tool_id', message.ADDRESS_FAMILY_IPv4)))
+        self.assertEqual(3, len(candidate_cache.get_candidates(
+            'valid_tool_id', message.ADDRESS_FAMILY_IPv6)))
+        self.assertIsNone(candidate_cache.get_candidates(
+            'other_tool_id', message.ADDRESS_FAMILY_IPv4))
+
+    def testGetCandidatesFromSites(self):
+        self.assertTrue(candidate_cache.publish_candidates(
+            'valid_tool_id', self.sliver_tools))
+        self.assertEqual(1, len(candidate_cache.get_candidates_from_sites(
+            'valid_tool_id', message.ADDRESS_FAMILY_IPv4, ['s1'])))
+        self.assertEqual(2, len(candidate_cache.get_candidates_from_sites(
+            'valid_tool_id', message.ADDRESS_FAMILY_IPv6, ['s1'])))
+        self.assertEqual(3, len(candidate_cache.get_candidates_from_sites(
+            'valid_tool_id', message.ADDRESS_FAMILY_IPv6, ['s1', 's2'])))
+        self.assertEqual(0, len(candidate_cache.get_candidates_from_sites(
+            'valid_tool_id', message.ADDRESS_FAMILY_IPv4, ['s3'])))
+
+    def testGetGeoIndex(self):
+        self.assertIsNone(candidate_cache.get_geo_index(
+            'valid_tool_id', message.ADDRESS_FAMILY_IPv6))
+        self.assertTrue(candidate_cache.publish_candidates(
+            'valid_tool_id', self.sliver_tools))
+        geo_index = candidate_cache.get_geo_index(
+            'valid_tool_id', message.ADDRESS_FAMILY_IPv6)
+        self.assertEqual(3, len(geo_index.candidates))
+        self.assertEqual(2, len(geo_index.site_candidates['s1']))
+        self.assertEqual(1, len(geo_index.site_candidates['s2']))
+
+    def testPublishMetros(self):
+        metros = candidate_cache.get_metros()
+        self.assertEqual(frozenset(['s1']), metros['m1'])
+        self.assertEqual(frozenset(['s1', 's2']), metros['m12'])
+        self.assertNotIn('m4', metros)
+
+    def testGetMetroCandidatesNotPublished(self):
+        self.assertIsNone(candidate_cache.get_metro_candidates(
+            'valid_tool_id', message.ADDRESS_FAMILY_IPv4))
+
+    def testGetMetroCandidates(self):
+        self.assertTrue(candidate_cache.publish_candidates(
+            'valid_tool_id', self.sliver_tools))
+        metro_candidates = candidate_cache.get_metro_candidates(
+            'valid_tool_id', message.ADDRESS_FAMILY_IPv6)
+        self.assertEqual(2, len(metro_candidates['m1']))
+        self.assertEqual(1, len(metro_candidates['m2']))
+        self.assertEqual(3, len(metro_candidates['m12']))
+        self.assertEqual(0, len(metro_candidates['m3']))
+        self.assertNotIn('m4', metro_candidates)
+
+
+if __name__ == '__main__':
+    unittest2.main()
@@ -0,0 +1,100 @@
+from google.appengine.ext import testbed
+
+import mimetools
+import mock
+import StringIO
+import urllib2
+import unittest2
+
+from mlabns.util import conditional_fetch
+
+URL = 'http://ks.measurementlab.net/mlab-host-ips.txt'
+
+
+def _make_response(content, headers=''):
+    return urllib2.addinfourl(StringIO.StringIO(content),
+                              mimetools.Message(StringIO.StringIO(headers)),
+                              URL)
+
+
+def _not_modified(request, timeout):
+    raise urllib2.HTTPError(URL, 304, 'Not Modified', None, None)
+
+
+class ConditionalFetchTestCase(unittest2.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_memcache_stub()
+        self.addCleanup(self.testbed.deactivate)
+
+        urlopen_patch = mock.patch.object(urllib2, 'urlopen', autospec=True)
+        self.addCleanup(urlopen_patch.stop)
+        urlopen_patch.start()
+        urllib2.urlopen.return_value = _make_response(
+            'content', 'ETag: "v1"\nLast-Modified: Mon, 01 Jan 2024 00:00:00 '
+            'GMT\n\n')
+
+    def _get_request_headers(self):
+        request = urllib2.urlopen.call_args[0][0]
+        return dict((name.lower(), value)
+                    for name, value in request.header_items())
+
+    def testFirstFetch(self):
+        result = conditional_fetch.fetch(URL)
+        self.assertTrue(result.changed)
+        self.assertEqual('content', result.content)
+        self.assertEqual({}, self._get_request_headers())
+
+    def testNotModified(self):
+        conditional_fetch.fetch(URL).commit()
+        urllib2.urlopen.side_effect = _not_modified
+
+        result = conditional_fetch.fetch(URL)
+        self.assertFalse(result.changed)
+        self.assertIsNone(result.content)
+        self.assertEqual(
+            {'if-none-match': '"v1"',
+             'if-modified-since': 'Mon, 01 Jan 2024 00:00:00 GMT'},
+            self._get_request_headers())
+
+    def testSameContentWithoutValidators(self):
+        urllib2.urlopen.return_value = _make_response('content')
+        conditional_fetch.fetch(URL).commit()
+        urllib2.urlopen.return_value = _make_response('content')
+        self.assertFalse(conditional_fetch.fetch(URL).changed)
+
+        urllib2.urlopen.return_value = _make_response('new content')
+        result = conditional_fetch.fetch(URL)
+        self.assertTrue(result.changed)
+        self.assertEqual('new content', result.content)
+
+    def testNotCommitted(self):
+        conditional_fetch.fetch(URL)
+        urllib2.urlopen.return_value = _make_response('content')
+        self.assertTrue(conditional_fetch.fetch(URL).changed)
+        self.assertEqual({}, self._get_request_headers())
+
+    def testInvalidate(self):
+        conditional_fetch.fetch(URL).commit()
+        conditional_fetch.invalidate()
+        urllib2.urlopen.return_value = _make_response('content')
+        self.assertTrue(conditional_fetch.fetch(URL).changed)
+        self.assertEqual({}, self._get_request_headers())
+
+    def testUnconditionalFetch(self):
+        conditional_fetch.fetch(URL).commit()
+        urllib2.urlopen.return_value = _make_response('content')
+        result = conditional_fetch.fetch(URL, conditional=False)
+        self.assertEqual('content', result.content)
+        self.assertEqual({}, self._get_request_headers())
+
+    def testErrorsAreRaised(self):
+        urllib2.urlopen.side_effect = _not_modified
+        # A 304 answer to an unconditional request is an error.
+        self.assertRaises(urllib2.HTTPError, conditional_fetch.fetch, URL)
+
+
+if __name__ == '__main__':
+    unittest2.main()
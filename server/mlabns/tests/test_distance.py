@@ -24,5 +24,25 @@ class DistanceTestCase(unittest2.TestCase):
         self.assertFalse(math.isnan(dist))
 
 
+class DistancesTestCase(unittest2.TestCase):
+
+    LATITUDES = [10, 100, 37.93, -33.94]
+    LONGITUDES = [10, 100, 23.94, 151.17]
+
+    def testEmpty(self):
+        site_coordinates = distance.SiteCoordinates([], [])
+        self.assertEqual(0, len(distance.distances(0, 0, site_coordinates)))
+
+    def testMatchesDistance(self):
+        site_coordinates = distance.SiteCoordinates(self.LATITUDES,
+                                                    self.LONGITUDES)
+        results = distance.distances(20, 20, site_coordinates)
+        self.assertEqual(len(self.LATITUDES), len(results))
+        for latitude, longitude, result in zip(self.LATITUDES,
+                                               self.LONGITUDES, results):
+            self.assertAlmostEqual(
+                distance.distance(20, 20, latitude, longitude), result)
+
+
 if __name__ == '__main__':
     unittest2.main()
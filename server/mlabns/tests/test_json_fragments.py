@@ -0,0 +1,69 @@
+import json
+import unittest2
+
+from mlabns.util import json_fragments
+from mlabns.util import message
+
+
+class MockSliverTool():
+
+    def __init__(self, **kwargs):
+        self.fqdn = 'npad.iupui.mlab3.ath01.measurement-lab.org'
+        self.sliver_ipv4 = '1.2.3.4'
+        self.sliver_ipv6 = '2001:db8::1'
+        self.status_ipv4 = message.STATUS_ONLINE
+        self.status_ipv6 = message.STATUS_ONLINE
+        self.http_port = '8000'
+        self.server_port = '3001'
+        self.site_id = 'ath01'
+        self.city = 'Athens'
+        self.country = 'GR'
+        self.tool_extra = 'extra'
+        for name, value in kwargs.iteritems():
+            setattr(self, name, value)
+
+
+class JsonFragmentsTestCase(unittest2.TestCase):
+
+    def testAnnotateFqdn(self):
+        fqdn = 'npad.iupui.mlab3.ath01.measurement-lab.org'
+        self.assertEqual(fqdn, json_fragments.annotate_fqdn(fqdn, None))
+        self.assertEqual(
+            'npad.iupui.mlab3v4.ath01.measurement-lab.org',
+            json_fragments.annotate_fqdn(fqdn, message.ADDRESS_FAMILY_IPv4))
+        self.assertEqual(
+            'npad.iupui.mlab3v6.ath01.measurement-lab.org',
+            json_fragments.annotate_fqdn(fqdn, message.ADDRESS_FAMILY_IPv6))
+
+    def testGetJsonDataDualStack(self):
+        data = json_fragments.get_json_data(MockSliverTool(), None, False)
+        self.assertEqual(['1.2.3.4', '2001:db8::1'], data['ip'])
+        self.assertEqual('npad.iupui.mlab3.ath01.measurement-lab.org',
+                         data['fqdn'])
+        self.assertEqual(
+            'http://npad.iupui.mlab3.ath01.measurement-lab.org:8000',
+            data['url'])
+        self.assertEqual('3001', data['port'])
+        self.assertNotIn('tool_extra', data)
+
+        data = json_fragments.get_json_data(
+            MockSliverTool(status_ipv6=message.STATUS_OFFLINE), None, True)
+        self.assertEqual(['1.2.3.4'], data['ip'])
+        self.assertEqual('extra', data['tool_extra'])
+
+    def testGetJsonFragments(self):
+        fragments = json_fragments.get_json_fragments(MockSliverTool(), False)
+        self.assertItemsEqual(json_fragments.ADDRESS_FAMILIES,
+                              fragments.keys())
+        for address_family in json_fragments.ADDRESS_FAMILIES:
+            self.assertEqual(
+                json_fragments.get_json_data(MockSliverTool(), address_family,
+                                             False),
+                json.loads(fragments[address_family]))
+        self.assertEqual(
+            ['2001:db8::1'],
+            json.loads(fragments[message.ADDRESS_FAMILY_IPv6])['ip'])
+
+
+if __name__ == '__main__':
+    unittest2.main()
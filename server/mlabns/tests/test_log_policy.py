@@ -0,0 +1,73 @@
+import logging
+import mock
+import unittest2
+
+from mlabns.util import log_policy
+
+
+class LogPolicyTestCase(unittest2.TestCase):
+
+    def setUp(self):
+        log_patch = mock.patch.object(logging, 'log', autospec=True)
+        self.addCleanup(log_patch.stop)
+        self.mock_log = log_patch.start()
+        random_patch = mock.patch.object(log_policy.random, 'random',
+                                         return_value=0.5)
+        self.addCleanup(random_patch.stop)
+        random_patch.start()
+        time_patch = mock.patch.object(log_policy.time, 'time',
+                                       return_value=1000.0)
+        self.addCleanup(time_patch.stop)
+        self.mock_time = time_patch.start()
+
+    def testSampledOutMessagesAreCounted(self):
+        policy = log_policy.LogPolicy(sample_rate=0.1, max_per_second=5)
+        for _ in range(3):
+            policy.log(logging.INFO, 'Policy is %s', 'geo')
+        self.assertFalse(self.mock_log.called)
+        self.assertDictEqual({'Policy is %s': 3}, policy.get_counts())
+
+    def testPerMessageSampleRate(self):
+        policy = log_policy.LogPolicy(sample_rate=0.1, max_per_second=5,
+                                      sample_rates={'Policy is %s': 1.0})
+        policy.log(logging.INFO, 'Policy is %s', 'geo')
+        policy.log(logging.INFO, 'Other message.')
+        self.mock_log.assert_called_once_with(logging.INFO, 'Policy is %s',
+                                              'geo')
+
+    def testRateLimit(self):
+        policy = log_policy.LogPolicy(sample_rate=1.0, max_per_second=2)
+        for _ in range(5):
+            policy.log(logging.INFO, 'Policy is %s', 'geo')
+        self.assertEqual(2, self.mock_log.call_count)
+
+        self.mock_time.return_value = 1001.0
+        policy.log(logging.INFO, 'Policy is %s', 'geo')
+        self.mock_log.assert_called_with(
+            logging.INFO, 'Policy is %s (%d similar messages not logged)',
+            'geo', 3)
+        self.assertDictEqual({'Policy is %s': 6}, policy.get_counts())
+
+    def testQuietModeDropsInfo(self):
+        policy = log_policy.LogPolicy(sample_rate=1.0, max_per_second=5,
+                                      quiet=True)
+        policy.log(logging.INFO, 'Policy is %s', 'geo')
+        policy.log(logging.WARNING, 'No sliver tool found.')
+        self.mock_log.assert_called_once_with(logging.WARNING,
+                                              'No sliver tool found.')
+
+    def testErrorsAreAlwaysLogged(self):
+        policy = log_policy.LogPolicy(sample_rate=0.0, max_per_second=0,
+                                      quiet=True)
+        policy.log(logging.ERROR, 'Failed.')
+        self.mock_log.assert_called_once_with(logging.ERROR, 'Failed.')
+
+    def testReset(self):
+        policy = log_policy.LogPolicy(sample_rate=0.0, max_per_second=5)
+        policy.log(logging.INFO, 'Policy is %s', 'geo')
+        policy.reset()
+        self.assertDictEqual({}, policy.get_counts())
+
+
+if __name__ == '__main__':
+    unittest2.main()
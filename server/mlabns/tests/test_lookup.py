@@ -0,0 +1,232 @@
+from google.appengine.ext import testbed
+from google.appengine.ext import webapp
+
+import collections
+import json
+import mock
+import unittest2
+
+from mlabns.db import model
+from mlabns.handlers import lookup
+from mlabns.util import json_fragments
+from mlabns.util import lookup_log
+from mlabns.util import maxmind
+from mlabns.util import message
+from mlabns.util import resolver
+from mlabns.util import response_cache
+
+
+def _make_sliver_tool(tool_id, site_id):
+    sliver_tool = model.SliverToolSnapshot(
+        tool_id=tool_id, slice_id='iupui_' + tool_id, site_id=site_id,
+        server_id='mlab1', server_port='3001', http_port=None,
+        tool_extra=None,
+        fqdn='%s.iupui.mlab1.%s.measurement-lab.org' % (tool_id, site_id),
+        sliver_ipv4='1.2.3.4', sliver_ipv6=message.NO_IP_ADDRESS,
+        status_ipv4=message.STATUS_ONLINE, status_ipv6=message.STATUS_OFFLINE,
+        latitude=1.0, longitude=2.0, city='Xyzville', country='AB',
+        json_fragments=None)
+    return sliver_tool._replace(
+        json_fragments=json_fragments.get_json_fragments(sliver_tool, False))
+
+
+class FakeResolver:
+    """Answers each tool with the sliver tools of 'answers'."""
+
+    def __init__(self, answers, queries):
+        self.answers = answers
+        self.queries = queries
+
+    def answer_query(self, query):
+        self.queries.append((query.tool_id, query.policy))
+        return self.answers.get(query.tool_id)
+
+
+class BatchLookupHandlerTest(unittest2.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_memcache_stub()
+        self.addCleanup(self.testbed.deactivate)
+
+        geolocation_patch = mock.patch.object(
+            maxmind, 'get_ip_geolocation', autospec=True,
+            return_value=maxmind.GeoRecord(city='Xyzville', country='AB',
+                                           latitude=1.5, longitude=2.5))
+        self.addCleanup(geolocation_patch.stop)
+        geolocation_patch.start()
+
+        add_records_patch = mock.patch.object(lookup_log, 'add_records',
+                                              autospec=True)
+        self.addCleanup(add_records_patch.stop)
+        add_records_patch.start()
+
+        self.ndt = _make_sliver_tool('ndt', 'xyz01')
+        self.npad = _make_sliver_tool('npad', 'abc01')
+        self.answers = {'ndt': [self.ndt], 'npad': [self.npad]}
+        self.queries = []
+        new_resolver_patch = mock.patch.object(
+            resolver, 'new_resolver', autospec=True,
+            side_effect=lambda policy: FakeResolver(self.answers,
+                                                    self.queries))
+        self.addCleanup(new_resolver_patch.stop)
+        new_resolver_patch.start()
+
+    def get(self, query_string):
+        handler = lookup.BatchLookupHandler()
+        handler.initialize(
+            webapp.Request.blank('/batch?' + query_string,
+                                 remote_addr='9.8.7.6'),
+            webapp.Response())
+        handler.get()
+        return handler.response
+
+    def testSharedPolicy(self):
+        response = self.get('tool_id=ndt&tool_id=npad&policy=random')
+        self.assertEqual(200, response.status_int)
+        self.assertEqual([('ndt', message.POLICY_RANDOM),
+                          ('npad', message.POLICY_RANDOM)], self.queries)
+
+    def testPolicyPerTool(self):
+        response = self.get('tool_id=ndt&tool_id=npad&policy=random&'
+                            'policy=all')
+        self.assertEqual(200, response.status_int)
+        self.assertEqual([('ndt', message.POLICY_RANDOM),
+                          ('npad', message.POLICY_ALL)], self.queries)
+
+    def testPolicyCountMismatch(self):
+        response = self.get('tool_id=ndt&tool_id=npad&policy=random&'
+                            'policy=all&policy=geo')
+        self.assertEqual(404, response.status_int)
+        self.assertEqual([], self.queries)
+
+    def testNoToolId(self):
+        self.assertEqual(404, self.get('policy=random').status_int)
+
+    def testDuplicateToolIds(self):
+        response = self.get('tool_id=ndt&tool_id=npad&tool_id=ndt')
+        self.assertEqual(['ndt', 'npad'],
+                         [tool_id for tool_id, _ in self.queries])
+        self.assertEqual(['ndt', 'npad'], json.loads(
+            response.body, object_pairs_hook=collections.OrderedDict).keys())
+
+    def testToolWithoutCandidates(self):
+        del self.answers['npad']
+        response = self.get('tool_id=ndt&tool_id=npad')
+        self.assertEqual([], json.loads(response.body)['npad'])
+
+    def testResponse(self):
+        response = self.get('tool_id=npad&tool_id=ndt&policy=random&'
+                            'address_family=ipv4')
+        self.assertEqual('application/json', response.headers['Content-Type'])
+        self.assertEqual('*', response.headers['Access-Control-Allow-Origin'])
+        self.assertEqual(
+            '{"npad":[%s],"ndt":[%s]}' % (
+                self.npad.json_fragments[message.ADDRESS_FAMILY_IPv4],
+                self.ndt.json_fragments[message.ADDRESS_FAMILY_IPv4]),
+            response.body)
+        self.assertEqual(
+            {'fqdn': 'ndt.iupui.mlab1v4.xyz01.measurement-lab.org',
+             'ip': ['1.2.3.4'], 'port': '3001', 'site': 'xyz01',
+             'city': 'Xyzville', 'country': 'AB'},
+            json.loads(response.body)['ndt'][0])
+
+
+class LookupHandlerTest(unittest2.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_memcache_stub()
+        self.addCleanup(self.testbed.deactivate)
+
+        add_records_patch = mock.patch.object(lookup_log, 'add_records',
+                                              autospec=True)
+        self.addCleanup(add_records_patch.stop)
+        add_records_patch.start()
+
+        # A single sampled response is enough to answer from the cache.
+        cache_patch = mock.patch.object(
+            response_cache, 'response_cache',
+            response_cache.ResponseCache(max_variants=1))
+        self.addCleanup(cache_patch.stop)
+        cache_patch.start()
+
+        self.ndt = _make_sliver_tool('ndt', 'xyz01')
+        self.answers = {'ndt': [self.ndt]}
+        self.queries = []
+        new_resolver_patch = mock.patch.object(
+            resolver, 'new_resolver', autospec=True,
+            side_effect=lambda policy: FakeResolver(self.answers,
+                                                    self.queries))
+        self.addCleanup(new_resolver_patch.stop)
+        new_resolver_patch.start()
+
+    def get(self, query_string, headers=None):
+        request = webapp.Request.blank('/ndt?policy=geo&' + query_string,
+                                       remote_addr='9.8.7.6')
+        if headers:
+            request.headers.update(headers)
+        handler = lookup.LookupHandler()
+        handler.initialize(request, webapp.Response())
+        handler.get()
+        return handler.response
+
+    def testResponseHeaders(self):
+        response = self.get('lat=1.0&lon=2.0')
+        self.assertEqual(200, response.status_int)
+        self.assertEqual('application/json', response.headers['Content-Type'])
+        self.assertEqual('private, max-age=60',
+                         response.headers['Cache-Control'])
+        self.assertEqual(response_cache.get_etag(response.body),
+                         response.headers['ETag'])
+
+    def testCacheHit(self):
+        first = self.get('lat=1.0&lon=2.0')
+        self.answers['ndt'] = [_make_sliver_tool('ndt', 'abc01')]
+        second = self.get('lat=1.0&lon=2.0')
+        self.assertEqual(1, len(self.queries))
+        self.assertEqual(first.body, second.body)
+        self.assertEqual(first.headers['ETag'], second.headers['ETag'])
+
+    def testIfNoneMatch(self):
+        etag = self.get('lat=1.0&lon=2.0').headers['ETag']
+        response = self.get('lat=1.0&lon=2.0', {'If-None-Match': etag})
+        self.assertEqual(304, response.status_int)
+        self.assertEqual('', response.body)
+        self.assertEqual(etag, response.headers['ETag'])
+        self.assertEqual(1, len(self.queries))
+
+    def testIfNoneMatchStale(self):
+        response = self.get('lat=1.0&lon=2.0', {'If-None-Match': '"stale"'})
+        self.assertEqual(200, response.status_int)
+        self.assertNotEqual('', response.body)
+
+    def testDifferentQueriesDoNotShareResponses(self):
+        first = self.get('lat=1.0&lon=2.0')
+        self.answers['ndt'] = [_make_sliver_tool('ndt', 'abc01')]
+        far = self.get('lat=-40.0&lon=150.0')
+        ipv4 = self.get('lat=1.0&lon=2.0&address_family=ipv4')
+        bt = self.get('lat=1.0&lon=2.0&format=bt')
+        self.assertEqual(4, len(self.queries))
+        self.assertNotEqual(first.body, far.body)
+        self.assertNotEqual(first.body, ipv4.body)
+        self.assertNotEqual(first.body, bt.body)
+        self.assertEqual('text/html', bt.headers['Content-Type'])
+
+
+class LookupLogFlushHandlerTest(unittest2.TestCase):
+
+    @mock.patch.object(lookup_log, 'flush', autospec=True, return_value=0)
+    def testGet(self, mock_flush):
+        handler = lookup.LookupLogFlushHandler()
+        handler.initialize(webapp.Request.blank('/cron/flush_lookup_log'),
+                           webapp.Response())
+        handler.get()
+        mock_flush.assert_called_once_with()
+        self.assertEqual(200, handler.response.status_int)
+
+
+if __name__ == '__main__':
+    unittest2.main()
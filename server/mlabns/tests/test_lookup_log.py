@@ -0,0 +1,93 @@
+from google.appengine.api import taskqueue
+
+import csv
+import mock
+import StringIO
+import unittest2
+
+from mlabns.util import lookup_log
+from mlabns.util import message
+
+
+def _make_record(tool_id='ndt', user_agent='agent'):
+    return lookup_log.LookupRecord(
+        tool_id, message.POLICY_GEO, '1.2.3.4', False, u'Z\xfcrich', 'CH',
+        47.4, 8.5, 'iupui_ndt', 'mlab1', '5.6.7.8',
+        'ndt.iupui.mlab1.zrh01.measurement-lab.org', 'zrh01', 'Zurich',
+        'CH', 47.5, 8.6, 12.0, 1400000000L, 0.01, user_agent)
+
+
+class LookupLogTestCase(unittest2.TestCase):
+
+    def setUp(self):
+        queue_patch = mock.patch.object(taskqueue, 'Queue')
+        self.addCleanup(queue_patch.stop)
+        self.queue = queue_patch.start().return_value
+
+    def testFormatRecords(self):
+        records = [_make_record(user_agent='Mozilla/5.0 (X11, Linux)'),
+                   _make_record(tool_id='npad', user_agent=None)]
+        rows = list(csv.reader(
+            StringIO.StringIO(lookup_log.format_records(records))))
+        self.assertEqual(2, len(rows))
+        self.assertEqual(len(lookup_log.LookupRecord._fields), len(rows[0]))
+        self.assertEqual('Mozilla/5.0 (X11, Linux)', rows[0][-1])
+        self.assertEqual('Z\xc3\xbcrich', rows[0][4])
+        self.assertEqual('npad', rows[1][0])
+        self.assertEqual('', rows[1][-1])
+
+    def testAddRecords(self):
+        lookup_log.add_records([_make_record(), _make_record('npad')])
+        task = self.queue.add_async.call_args[0][0]
+        self.assertEqual('PULL', task.method)
+        self.assertEqual(
+            lookup_log.format_records([_make_record(), _make_record('npad')]),
+            task.payload)
+
+        self.queue.add_async.reset_mock()
+        lookup_log.add_records([])
+        self.assertFalse(self.queue.add_async.called)
+
+    def testFlush(self):
+        tasks = [mock.Mock(payload='a' * 100), mock.Mock(payload='b' * 300),
+                 mock.Mock(payload='c' * 100)]
+        self.queue.lease_tasks.side_effect = [tasks, []]
+        with mock.patch.object(lookup_log, 'write_records') as write_records:
+            self.assertEqual(3, lookup_log.flush(max_tasks=3, max_bytes=400))
+            self.assertEqual([mock.call('a' * 100 + 'b' * 300),
+                              mock.call('c' * 100)],
+                             write_records.call_args_list)
+        self.queue.delete_tasks.assert_called_once_with(tasks)
+        self.assertEqual(2, self.queue.lease_tasks.call_count)
+
+    def testFlushStopsOnPartialLease(self):
+        self.queue.lease_tasks.return_value = [mock.Mock(payload='a')]
+        with mock.patch.object(lookup_log, 'write_records'):
+            self.assertEqual(1, lookup_log.flush(max_tasks=2))
+        self.assertEqual(1, self.queue.lease_tasks.call_count)
+
+    def testFlushEmptyQueue(self):
+        self.queue.lease_tasks.return_value = []
+        with mock.patch.object(lookup_log, 'write_records') as write_records:
+            self.assertEqual(0, lookup_log.flush())
+            self.assertFalse(write_records.called)
+        self.assertFalse(self.queue.delete_tasks.called)
+
+    def testGetRecords(self):
+        query = mock.Mock(tool_id='ndt', policy=message.POLICY_GEO,
+                          ip_address='2001:db8::1',
+                          tool_address_family=message.ADDRESS_FAMILY_IPv6,
+                          city='Zurich', country='CH', latitude=47.4,
+                          longitude=8.5, distance=12.0)
+        sliver_tool = mock.Mock(sliver_ipv4='5.6.7.8', sliver_ipv6='2001::8')
+        records = lookup_log.get_records(query, [sliver_tool, sliver_tool],
+                                         'agent', 0.5)
+        self.assertEqual(2, len(records))
+        self.assertTrue(records[0].is_ipv6)
+        self.assertEqual('2001::8', records[0].server_ip)
+        self.assertEqual(0.5, records[0].latency)
+        self.assertEqual('agent', records[0].user_agent)
+
+
+if __name__ == '__main__':
+    unittest2.main()
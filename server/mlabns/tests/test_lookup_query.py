@@ -11,8 +11,11 @@ from mlabns.util import message
 
 class LookupQueryTestCase(unittest2.TestCase):
 
-    def mock_get(self, arg, default_value=None):
-        """Mock method to replace the GAE get() API for web requests."""
+    def mock_get(self, arg, default_value=''):
+        """Mock method to replace the GAE get() API for web requests.
+
+        Like webapp, missing arguments default to the empty string.
+        """
         if arg in self.mock_query_params:
             return self.mock_query_params[arg]
         else:
@@ -66,6 +69,8 @@ class LookupQueryTestCase(unittest2.TestCase):
         self.assertIsNone(query.response_format)
         self.assertIsNone(query.ip_address)
         self.assertIsNone(query.tool_address_family)
+        self.assertIsNone(query.user_defined_af)
+        self.assertIsNone(query.address_family)
         self.assertIsNone(query.city)
         self.assertIsNone(query.country)
         self.assertIsNone(query.latitude)
@@ -133,6 +138,33 @@ class LookupQueryTestCase(unittest2.TestCase):
         query.initialize_from_http_request(self.mock_request)
         self.assertEqual(user_defined_af, query.tool_address_family)
 
+    def testInitializeSetsAddressFamilyFromUserDefinedAf(self):
+        self.mock_query_params[message.ADDRESS_FAMILY] = (
+            message.ADDRESS_FAMILY_IPv6)
+        query = lookup_query.LookupQuery()
+        query.initialize_from_http_request(self.mock_request)
+        self.assertEqual(message.ADDRESS_FAMILY_IPv6, query.user_defined_af)
+        self.assertEqual(message.ADDRESS_FAMILY_IPv6, query.address_family)
+
+    def testInitializeSetsAddressFamilyFromClientIp(self):
+        query = lookup_query.LookupQuery()
+        query.initialize_from_http_request(self.mock_request)
+        self.assertIsNone(query.user_defined_af)
+        self.assertEqual(message.ADDRESS_FAMILY_IPv4, query.address_family)
+
+        self.mock_request.remote_addr = '1:2:3::4'
+        query = lookup_query.LookupQuery()
+        query.initialize_from_http_request(self.mock_request)
+        self.assertIsNone(query.user_defined_af)
+        self.assertEqual(message.ADDRESS_FAMILY_IPv6, query.address_family)
+
+    def testInitializeSetsAddressFamilyFromUserDefinedIp(self):
+        self.mock_query_params[message.REMOTE_ADDRESS] = '1:2:3::4'
+        query = lookup_query.LookupQuery()
+        query.initialize_from_http_request(self.mock_request)
+        self.assertIsNone(query.user_defined_af)
+        self.assertEqual(message.ADDRESS_FAMILY_IPv6, query.address_family)
+
     def testInitializeIgnoresInvalidUserDefinedIp(self):
         """Ignore an invalid user-defined IP address."""
         self.mock_query_params[message.REMOTE_ADDRESS] = 'invalid_ip'
@@ -492,6 +524,14 @@ class LookupQueryTestCase(unittest2.TestCase):
         query.initialize_from_http_request(self.mock_request)
         self.assertEqual(message.POLICY_RANDOM, query.policy)
 
+    def testInitializeKeepsPolicyWithoutUserDefinedCountryOrCity(self):
+        self.mock_request.headers = {}
+        self.mock_query_params[message.POLICY] = message.POLICY_RANDOM
+        query = lookup_query.LookupQuery()
+        query.initialize_from_http_request(self.mock_request)
+        self.assertEqual(message.POLICY_RANDOM, query.policy)
+        self.assertIsNone(query.user_defined_country)
+
     def testInitializeDefaultsToGeoPolicyWhenUserDefinedPolicyIsInvalidAndGeoDataIsAvailable(
             self):
         self.mock_query_params[message.POLICY] = 'invalid_policy'
@@ -508,6 +548,32 @@ class LookupQueryTestCase(unittest2.TestCase):
         self.assertEqual(message.POLICY_METRO, query.policy)
         self.assertEqual('lax', query.metro)
 
+    def testCopyForToolKeepsGeolocation(self):
+        query = lookup_query.LookupQuery()
+        query.initialize_from_http_request(self.mock_request)
+
+        tool_query = query.copy_for_tool('npad', message.POLICY_GEO_OPTIONS)
+
+        self.assertEqual('npad', tool_query.tool_id)
+        self.assertEqual(message.POLICY_GEO_OPTIONS, tool_query.policy)
+        self.assertEqual(self.mock_gae_latitude, tool_query.latitude)
+        self.assertEqual(self.mock_gae_longitude, tool_query.longitude)
+        self.assertEqual(self.mock_gae_city, tool_query.city)
+        self.assertEqual(self.mock_tool_id, query.tool_id)
+        self.assertEqual(message.POLICY_GEO, query.policy)
+
+    def testCopyForToolValidatesPolicy(self):
+        query = lookup_query.LookupQuery()
+        query.initialize_from_http_request(self.mock_request)
+
+        self.assertEqual(message.POLICY_GEO,
+                         query.copy_for_tool('npad', None).policy)
+        self.assertEqual(message.POLICY_GEO,
+                         query.copy_for_tool('npad', 'invalid_policy').policy)
+        self.assertEqual(message.POLICY_RANDOM,
+                         query.copy_for_tool('npad',
+                                             message.POLICY_RANDOM).policy)
+
 
 if __name__ == '__main__':
     unittest2.main()
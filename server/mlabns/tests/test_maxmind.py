@@ -1,3 +1,8 @@
+from google.appengine.ext import db
+from google.appengine.ext import testbed
+
+import mock
+import tempfile
 import unittest2
 
 from mlabns.third_party import ipaddr
@@ -13,13 +18,145 @@ class GeoRecordTestCase(unittest2.TestCase):
         self.assertIsNone(geo_record.latitude)
         self.assertIsNone(geo_record.longitude)
 
+class GeolocationCacheTestCase(unittest2.TestCase):
+
+    RANGE_TABLE = maxmind.RangeTable(maxmind.build_range_table([
+        (16909056, 16909183,   # 1.2.3.0 - 1.2.3.127
+         maxmind.GeoRecord('city1', 'country1', 1.0, 1.5)),
+        (16909184, 16909311,   # 1.2.3.128 - 1.2.3.255
+         maxmind.GeoRecord('city2', 'country2', 2.0, 2.5))]))
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_memcache_stub()
+        maxmind.geolocation_cache.flush()
+
+        get_ipv4_geolocation_patch = mock.patch.object(
+            maxmind, 'get_ipv4_geolocation', autospec=True,
+            return_value=maxmind.GeoRecord('city', 'country', 1.0, 2.0))
+        self.addCleanup(get_ipv4_geolocation_patch.stop)
+        get_ipv4_geolocation_patch.start()
+
+        get_ipv6_geolocation_patch = mock.patch.object(
+            maxmind, 'get_ipv6_geolocation', autospec=True,
+            return_value=maxmind.GeoRecord())
+        self.addCleanup(get_ipv6_geolocation_patch.stop)
+        get_ipv6_geolocation_patch.start()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def testSameIpv4Address(self):
+        geo_record = maxmind.get_ip_geolocation('1.2.3.4')
+        self.assertEqual('city', geo_record.city)
+        geo_record = maxmind.get_ip_geolocation('1.2.3.4')
+        self.assertEqual('city', geo_record.city)
+        self.assertEqual(1.0, geo_record.latitude)
+        self.assertEqual(1, maxmind.get_ipv4_geolocation.call_count)
+
+        # Without a range table, the Maxmind blocks are not known.
+        maxmind.get_ip_geolocation('1.2.3.5')
+        self.assertEqual(2, maxmind.get_ipv4_geolocation.call_count)
+
+    def testSameIpv6Prefix(self):
+        maxmind.get_ip_geolocation('1:2:3:4::5')
+        maxmind.get_ip_geolocation('1:2:3:4:ffff::6')
+        self.assertEqual(1, maxmind.get_ipv6_geolocation.call_count)
+        maxmind.get_ip_geolocation('1:2:3:5::5')
+        self.assertEqual(2, maxmind.get_ipv6_geolocation.call_count)
+
+    def testMemcacheHit(self):
+        maxmind.get_ip_geolocation('1.2.3.4')
+        maxmind.geolocation_cache.flush()
+        self.assertEqual('city', maxmind.get_ip_geolocation('1.2.3.4').city)
+        self.assertEqual(1, maxmind.get_ipv4_geolocation.call_count)
+
+    @mock.patch.object(maxmind, 'geolocation_cache',
+                       maxmind.GeolocationCache())
+    def testRangeTableIsNotCachedInMemcache(self):
+        with mock.patch.object(maxmind, 'get_range_table', autospec=True,
+                               return_value=self.RANGE_TABLE):
+            with mock.patch.object(maxmind.memcache, 'get') as mock_get:
+                with mock.patch.object(maxmind.memcache, 'set') as mock_set:
+                    maxmind.get_ip_geolocation('1.2.3.4')
+                    maxmind.get_ip_geolocation('1.2.3.5')
+                    self.assertFalse(mock_get.called)
+                    self.assertFalse(mock_set.called)
+        self.assertEqual(1, maxmind.get_ipv4_geolocation.call_count)
+        self.assertDictEqual(
+            {'local_hits': 1, 'memcache_hits': 0, 'misses': 1},
+            maxmind.geolocation_cache.get_counts())
+
+    @mock.patch.object(maxmind, 'get_range_table', autospec=True,
+                       return_value=RANGE_TABLE)
+    def testRangeTableKeyedByRange(self, unused_get_range_table):
+        maxmind.get_ip_geolocation('1.2.3.4')
+        maxmind.get_ip_geolocation('1.2.3.127')
+        self.assertEqual(1, maxmind.get_ipv4_geolocation.call_count)
+
+        # Ranges smaller than a /24 do not share their entries.
+        maxmind.get_ip_geolocation('1.2.3.128')
+        self.assertEqual(2, maxmind.get_ipv4_geolocation.call_count)
+
+        # Addresses outside the ranges are not cached.
+        maxmind.get_ip_geolocation('1.2.4.1')
+        maxmind.get_ip_geolocation('1.2.4.1')
+        self.assertEqual(4, maxmind.get_ipv4_geolocation.call_count)
+
+    def testCounters(self):
+        geolocation_cache = maxmind.GeolocationCache(max_size=1)
+        self.assertIsNone(geolocation_cache.get('key1'))
+        geolocation_cache.set('key1', maxmind.GeoRecord('city1'))
+        geolocation_cache.set('key2', maxmind.GeoRecord('city2'))
+        self.assertEqual('city2', geolocation_cache.get('key2').city)
+        # key1 was evicted from the instance, but is still in memcache.
+        self.assertEqual('city1', geolocation_cache.get('key1').city)
+        self.assertEqual(1, geolocation_cache.local_hits)
+        self.assertEqual(1, geolocation_cache.memcache_hits)
+        self.assertEqual(1, geolocation_cache.misses)
+
+    def testExpiredLocally(self):
+        geolocation_cache = maxmind.GeolocationCache(ttl=0)
+        geolocation_cache.set('key', maxmind.GeoRecord('city'))
+        geolocation_cache.get('key')
+        self.assertEqual(0, geolocation_cache.local_hits)
+
+
 class MaxmindTestClass(unittest2.TestCase):
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_memcache_stub()
+        maxmind.country_locations.flush()
+        maxmind.location_cache.flush()
+        maxmind.city_table_version.flush()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
     class GqlMockup:
         def __init__(self, result=None):
             self.result = result
         def get(self):
             return self.result
 
+    class QueryMockup:
+        def __init__(self, result=None):
+            self.result = result
+        def order(self, unused_arg):
+            return MaxmindTestClass.GqlMockup()
+        def run(self, batch_size='unused_value'):
+            if self.result is None:
+                return []
+            return [self.result]
+
+    class KeyMockup:
+        def __init__(self, name):
+            self._name = name
+        def name(self):
+            return self._name
+
     class ModelMockup:
         def __init__(self, gql_obj=None, location=None):
             self.gql_obj = gql_obj
@@ -31,6 +168,8 @@ class MaxmindTestClass(unittest2.TestCase):
             return self.gql_obj
         def get_by_key_name(self, unused_arg):
             return self.location
+        def all(self):
+            return MaxmindTestClass.QueryMockup(self.location)
 
     def assertNoneGeoRecord(self, geo_record):
         self.assertIsNone(geo_record.city)
@@ -182,6 +321,8 @@ class MaxmindTestClass(unittest2.TestCase):
                 self.alpha2_code = 'country'
                 self.latitude = 'latitude'
                 self.longitude = 'longitude'
+            def key(self):
+                return MaxmindTestClass.KeyMockup('unused_country')
         location = Location()
         expected_geo_record = maxmind.GeoRecord()
         expected_geo_record.city = constants.UNKNOWN_CITY
@@ -224,6 +365,174 @@ class MaxmindTestClass(unittest2.TestCase):
                  city_table=MaxmindTestClass.ModelMockup(
                      gql_obj=MaxmindTestClass.GqlMockup(result=location))))
 
+    def _make_country_table(self, locations, when=1):
+        country_table = mock.Mock()
+        query = country_table.all.return_value
+        query.order.return_value.get.return_value = mock.Mock(when=when)
+        query.run.return_value = locations
+        return country_table
+
+    def _make_country(self, alpha2_code, latitude=1.0, longitude=2.0):
+        location = mock.Mock(alpha2_code=alpha2_code, latitude=latitude,
+                             longitude=longitude)
+        location.key.return_value.name.return_value = alpha2_code
+        return location
+
+    def testGetCountryGeolocationPreloaded(self):
+        country_table = self._make_country_table(
+            [self._make_country('US'), self._make_country('CH')])
+        self.assertEqual('US', maxmind.get_country_geolocation(
+            'US', country_table=country_table).country)
+        self.assertEqual('CH', maxmind.get_country_geolocation(
+            'CH', country_table=country_table).country)
+        self.assertNoneGeoRecord(maxmind.get_country_geolocation(
+            'XX', country_table=country_table))
+        self.assertEqual(1, country_table.all.return_value.run.call_count)
+        self.assertFalse(country_table.get_by_key_name.called)
+
+    @mock.patch.object(maxmind, 'country_locations',
+                       maxmind.CountryTable(check_interval=0))
+    def testGetCountryGeolocationReloadedOnVersionChange(self):
+        country_table = self._make_country_table([self._make_country('US')])
+        query = country_table.all.return_value
+        maxmind.get_country_geolocation('US', country_table=country_table)
+        maxmind.get_country_geolocation('US', country_table=country_table)
+        self.assertEqual(1, query.run.call_count)
+
+        query.order.return_value.get.return_value = mock.Mock(when=2)
+        query.run.return_value = [self._make_country('US', latitude=3.0)]
+        self.assertEqual(3.0, maxmind.get_country_geolocation(
+            'US', country_table=country_table).latitude)
+        self.assertEqual(2, query.run.call_count)
+
+    def testGetCountryGeolocationTableNotLoaded(self):
+        country_table = self._make_country_table([])
+        country_table.all.return_value.run.side_effect = db.Timeout()
+        country_table.get_by_key_name.return_value = self._make_country('US')
+        self.assertEqual('US', maxmind.get_country_geolocation(
+            'US', country_table=country_table).country)
+
+    @mock.patch.object(maxmind, 'city_table_version',
+                       maxmind.TableVersion(check_interval=0))
+    def testGetCityGeolocationCached(self):
+        city_table = mock.Mock()
+        city_table.all.return_value.order.return_value.get.return_value = (
+            mock.Mock(when=1))
+        city_table.gql.return_value.get.return_value = None
+        maxmind.get_city_geolocation('city', 'country', city_table=city_table)
+        self.assertNoneGeoRecord(maxmind.get_city_geolocation(
+            'city', 'country', city_table=city_table))
+        self.assertEqual(1, city_table.gql.call_count)
+        maxmind.get_city_geolocation('city2', 'country', city_table=city_table)
+        self.assertEqual(2, city_table.gql.call_count)
+
+        # Missing cities are looked up again once the table changes.
+        city_table.all.return_value.order.return_value.get.return_value = (
+            mock.Mock(when=2))
+        maxmind.get_city_geolocation('city', 'country', city_table=city_table)
+        self.assertEqual(3, city_table.gql.call_count)
+
+
+class RangeTableTestCase(unittest2.TestCase):
+
+    def setUp(self):
+        self.range_table = maxmind.RangeTable(maxmind.build_range_table([
+            (16909060, 16909061,   # 1.2.3.4 - 1.2.3.5
+             maxmind.GeoRecord('city2', 'country2', 2.0, 2.5)),
+            (16777216, 16777471,   # 1.0.0.0 - 1.0.0.255
+             maxmind.GeoRecord(u'Z\xfcrich', 'CH', 47.37, 8.54)),
+            (16909062, 16909062,   # 1.2.3.6
+             maxmind.GeoRecord('city2', 'country2', 2.0, 2.5)),
+            (33554432, 33554432,   # 2.0.0.0
+             maxmind.GeoRecord(country='country3'))]))
+
+    def assertGeoRecordEqual(self, geo_record1, geo_record2):
+        self.assertEqual(geo_record1.city, geo_record2.city)
+        self.assertEqual(geo_record1.country, geo_record2.country)
+        self.assertEqual(geo_record1.latitude, geo_record2.latitude)
+        self.assertEqual(geo_record1.longitude, geo_record2.longitude)
+
+    def testNotValidBuffer(self):
+        self.assertRaises(ValueError, maxmind.RangeTable, '')
+        self.assertRaises(ValueError, maxmind.RangeTable, 'x' * 100)
+        self.assertRaises(ValueError, maxmind.RangeTable,
+                          maxmind.build_range_table([])[:-1])
+
+    def testEmpty(self):
+        range_table = maxmind.RangeTable(maxmind.build_range_table([]))
+        self.assertEqual(0, len(range_table))
+        self.assertIsNone(range_table.lookup(16909060))
+
+    def testLookup(self):
+        self.assertEqual(4, len(self.range_table))
+        self.assertIsNone(self.range_table.lookup(16777215))
+        self.assertIsNone(self.range_table.lookup(16909059))
+        self.assertIsNone(self.range_table.lookup(16909063))
+        self.assertIsNone(self.range_table.lookup(33554433))
+        self.assertGeoRecordEqual(
+            maxmind.GeoRecord(u'Z\xfcrich', 'CH', 47.37, 8.54),
+            self.range_table.lookup(16777300))
+        self.assertGeoRecordEqual(
+            maxmind.GeoRecord('city2', 'country2', 2.0, 2.5),
+            self.range_table.lookup(16909060))
+        self.assertGeoRecordEqual(
+            maxmind.GeoRecord('city2', 'country2', 2.0, 2.5),
+            self.range_table.lookup(16909062))
+        self.assertGeoRecordEqual(
+            maxmind.GeoRecord('', 'country3', None, None),
+            self.range_table.lookup(33554432))
+
+    def testFind(self):
+        self.assertIsNone(self.range_table.find(16777215))
+        self.assertIsNone(self.range_table.find(16909063))
+        self.assertEqual(16777216, self.range_table.find(16777300))
+        self.assertEqual(16909060, self.range_table.find(16909061))
+        self.assertEqual(16909062, self.range_table.find(16909062))
+
+    def testLoadRangeTable(self):
+        range_table_file = tempfile.NamedTemporaryFile()
+        self.addCleanup(range_table_file.close)
+        range_table_file.write(maxmind.build_range_table([
+            (16909060, 16909061,
+             maxmind.GeoRecord('city2', 'country2', 2.0, 2.5))]))
+        range_table_file.flush()
+
+        range_table = maxmind.load_range_table(range_table_file.name)
+        self.assertGeoRecordEqual(
+            maxmind.GeoRecord('city2', 'country2', 2.0, 2.5),
+            range_table.lookup(16909061))
+
+    def testLoadRangeTableNotValid(self):
+        self.assertIsNone(maxmind.load_range_table('/non/existing/file'))
+        range_table_file = tempfile.NamedTemporaryFile()
+        self.addCleanup(range_table_file.close)
+        self.assertIsNone(maxmind.load_range_table(range_table_file.name))
+        range_table_file.write('not a range table')
+        range_table_file.flush()
+        self.assertIsNone(maxmind.load_range_table(range_table_file.name))
+
+    def testGetIpv4GeolocationRangeTable(self):
+        self.assertGeoRecordEqual(
+            maxmind.GeoRecord('city2', 'country2', 2.0, 2.5),
+            maxmind.get_ipv4_geolocation(
+                '1.2.3.4', ipv4_table=None, city_table=None,
+                range_table=self.range_table))
+        self.assertGeoRecordEqual(
+            maxmind.GeoRecord(),
+            maxmind.get_ipv4_geolocation(
+                '1.2.3.7', ipv4_table=None, city_table=None,
+                range_table=self.range_table))
+
+    def testGetIpv6GeolocationRangeTable(self):
+        range_table = maxmind.RangeTable(maxmind.build_range_table([
+            (281483566841860, 281483566841861,  # 1:2:3:4:: - 1:2:3:5::
+             maxmind.GeoRecord(constants.UNKNOWN_CITY, 'country', 1.0, 2.0))
+            ]))
+        self.assertGeoRecordEqual(
+            maxmind.GeoRecord(constants.UNKNOWN_CITY, 'country', 1.0, 2.0),
+            maxmind.get_ipv6_geolocation(
+                '1:2:3:4::5', ipv6_table=None, range_table=range_table))
+
 
 if __name__ == '__main__':
     unittest2.main()
@@ -1,6 +1,12 @@
+from google.appengine.ext import db
+from google.appengine.ext import testbed
+
+import mock
+import pickle
 import unittest2
 
 from mlabns.db import model
+from mlabns.util import conditional_fetch
 
 class ModelTestCase(unittest2.TestCase):
     def testGetSliverToolIdNone(self):
@@ -20,6 +26,103 @@ class ModelTestCase(unittest2.TestCase):
             model.get_sliver_tool_id(tool_id, slice_id, server_id, site_id),
             'tool_id-slice_id-server_id-site_id')
 
+    def testSliverToolSnapshot(self):
+        sliver_tool = model.SliverTool(
+            tool_id='ndt', slice_id='iupui_ndt', site_id='ath01',
+            server_id='mlab1', fqdn='ndt.iupui.mlab1.ath01.measurement-lab.org',
+            sliver_ipv4='1.2.3.4', sliver_ipv6='off', status_ipv4='online',
+            status_ipv6='offline', latitude=37.93, longitude=23.94)
+        snapshot = model.SliverToolSnapshot.from_sliver_tool(sliver_tool)
+        for field in model.SNAPSHOT_FIELDS:
+            self.assertEqual(getattr(sliver_tool, field),
+                             getattr(snapshot, field))
+        self.assertIsNone(snapshot.json_fragments)
+        self.assertEqual(snapshot, pickle.loads(pickle.dumps(snapshot, 2)))
+        self.assertRaises(AttributeError, setattr, snapshot, 'fqdn', 'other')
+
+
+class ToolCacheTestCase(unittest2.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        model.invalidate_tool_cache()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def testGetToolFromToolId(self):
+        model.Tool(tool_id='ndt', slice_id='iupui_ndt').put()
+        self.assertEqual('iupui_ndt',
+                         model.get_tool_from_tool_id('ndt').slice_id)
+        self.assertIsNone(model.get_tool_from_tool_id('npad'))
+
+    def testGetSliverToolSnapshotsRendersJson(self):
+        model.Tool(tool_id='ndt', slice_id='iupui_ndt',
+                   show_tool_extra=True).put()
+        sliver_tool = model.SliverTool(
+            tool_id='ndt', slice_id='iupui_ndt', site_id='ath01',
+            server_id='mlab1', fqdn='ndt.iupui.mlab1.ath01.measurement-lab.org',
+            sliver_ipv4='1.2.3.4', sliver_ipv6='off', status_ipv4='online',
+            status_ipv6='offline', tool_extra='extra')
+        snapshots = model.get_sliver_tool_snapshots([sliver_tool])
+        self.assertEqual(1, len(snapshots))
+        self.assertIn('"tool_extra": "extra"',
+                      snapshots[0].json_fragments[None])
+
+    def testPutInvalidatesCache(self):
+        self.assertIsNone(model.get_tool_from_tool_id('npad'))
+
+        # Bulk writes are only seen once the cache expires.
+        db.put([model.Tool(tool_id='npad', slice_id='iupui_npad')])
+        self.assertIsNone(model.get_tool_from_tool_id('npad'))
+
+        model.Tool(tool_id='ndt', slice_id='iupui_ndt').put()
+        self.assertEqual('iupui_npad',
+                         model.get_tool_from_tool_id('npad').slice_id)
+
+    @mock.patch.object(conditional_fetch, 'invalidate', autospec=True)
+    def testPutInvalidatesFetchValidators(self, mock_invalidate):
+        model.Tool(tool_id='ndt', slice_id='iupui_ndt').put()
+        mock_invalidate.assert_called_once_with()
+
+
+class PutInBatchesTestCase(unittest2.TestCase):
+
+    def setUp(self):
+        put_patch = mock.patch.object(db, 'put', autospec=True)
+        self.addCleanup(put_patch.stop)
+        put_patch.start()
+        sleep_patch = mock.patch.object(model.time, 'sleep', autospec=True)
+        self.addCleanup(sleep_patch.stop)
+        sleep_patch.start()
+
+    def testBatches(self):
+        entities = range(5)
+        self.assertListEqual([], model.put_in_batches(entities, batch_size=2))
+        self.assertListEqual([mock.call([0, 1]), mock.call([2, 3]),
+                              mock.call([4])], db.put.call_args_list)
+
+    def testNoEntities(self):
+        self.assertListEqual([], model.put_in_batches([]))
+        self.assertFalse(db.put.called)
+
+    def testFailedBatchIsRetried(self):
+        db.put.side_effect = [db.Timeout(), None, None]
+        self.assertListEqual([], model.put_in_batches(range(4), batch_size=2,
+                                                      retries=1))
+        self.assertListEqual([mock.call([0, 1]), mock.call([0, 1]),
+                              mock.call([2, 3])], db.put.call_args_list)
+
+    def testFailedBatchIsReturned(self):
+        db.put.side_effect = [None, db.Timeout(), db.TransactionFailedError(),
+                              None]
+        self.assertListEqual([2, 3], model.put_in_batches(
+            range(6), batch_size=2, retries=1))
+        self.assertEqual(4, db.put.call_count)
+
 
 if __name__ == '__main__':
     unittest2.main()
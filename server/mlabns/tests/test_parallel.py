@@ -0,0 +1,52 @@
+import threading
+import time
+import unittest2
+
+from mlabns.util import parallel
+
+
+class MapConcurrentlyTestCase(unittest2.TestCase):
+
+    def testResultsAreInOrder(self):
+        def slow_square(x):
+            time.sleep(0.01 * (5 - x))
+            return x * x
+        self.assertListEqual([0, 1, 4, 9, 16],
+                             parallel.map_concurrently(slow_square, range(5),
+                                                       3))
+
+    def testNoItems(self):
+        self.assertListEqual([], parallel.map_concurrently(abs, [], 3))
+
+    def testMaxWorkers(self):
+        lock = threading.Lock()
+        state = {'running': 0, 'max_running': 0}
+
+        def work(unused_item):
+            with lock:
+                state['running'] += 1
+                state['max_running'] = max(state['max_running'],
+                                           state['running'])
+            time.sleep(0.02)
+            with lock:
+                state['running'] -= 1
+
+        parallel.map_concurrently(work, range(10), 3)
+        self.assertEqual(3, state['max_running'])
+
+    def testExceptionIsRaisedOnceAllCallsAreDone(self):
+        done = []
+
+        def work(x):
+            if x == 0:
+                raise ValueError('bad item')
+            time.sleep(0.02)
+            done.append(x)
+
+        with self.assertRaises(ValueError):
+            parallel.map_concurrently(work, range(4), 4)
+        self.assertItemsEqual([1, 2, 3], done)
+
+
+if __name__ == '__main__':
+    unittest2.main()
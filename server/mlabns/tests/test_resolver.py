@@ -2,13 +2,18 @@ from google.appengine.api import memcache
 from google.appengine.ext import db
 from google.appengine.ext import testbed
 
+import itertools
 import mock
 import unittest2
 
 from mlabns.db import model
+from mlabns.util import candidate_cache
 from mlabns.util import constants
 from mlabns.util import message
 from mlabns.util import resolver
+from mlabns.util import sliver_store
+from mlabns.util import spatial_index
+from mlabns.util import stage_timer
 
 
 # We need to define our own class here instead of using the mock library
@@ -16,8 +21,14 @@ from mlabns.util import resolver
 # mock.Mock objects.
 class MockSliverTool():
 
+    # Gives each sliver tool a distinct fqdn, which identifies it in the
+    # sliver_store.
+    _count = itertools.count()
+
     def __init__(self, site_id=None, status_ipv4=None, status_ipv6=None,
                  latitude=None, longitude=None):
+        self.fqdn = 'mlab%d.%s.measurement-lab.org' % (
+            next(MockSliverTool._count), site_id)
         self.site_id = site_id
         self.status_ipv4 = status_ipv4
         self.status_ipv6 = status_ipv6
@@ -38,6 +49,7 @@ class ResolverBaseTestCase(unittest2.TestCase):
         self.testbed.activate()
         self.testbed.init_datastore_v3_stub()
         self.testbed.init_memcache_stub()
+        resolver.local_cache.flush()
 
     def tearDown(self):
         self.testbed.deactivate()
@@ -53,27 +65,31 @@ class ResolverBaseTestCase(unittest2.TestCase):
         base_resolver = ResolverBaseMockup()
 
         # Case 1) List is not empty for the input address family.
-        query = mock.Mock(address_family=message.ADDRESS_FAMILY_IPv6)
+        query = mock.Mock(address_family=message.ADDRESS_FAMILY_IPv6,
+                          timer=stage_timer.StageTimer())
         self.assertListEqual(['valid_candidate'],
                              base_resolver.get_candidates(query))
 
         # Case 2) List is empty for input address_family and there is no
         #         user-defined address family.
         query = mock.Mock(address_family=message.ADDRESS_FAMILY_IPv4,
-                          user_defined_af=None)
+                          user_defined_af=None,
+                          timer=stage_timer.StageTimer())
         self.assertListEqual(['valid_candidate'],
                              base_resolver.get_candidates(query))
 
         # Case 3) List is empty for input address_family and user-defined
         #         address family == input address family.
         query = mock.Mock(address_family=message.ADDRESS_FAMILY_IPv4,
-                          user_defined_af=message.ADDRESS_FAMILY_IPv4)
+                          user_defined_af=message.ADDRESS_FAMILY_IPv4,
+                          timer=stage_timer.StageTimer())
         self.assertEqual(len(base_resolver.get_candidates(query)), 0)
 
         # Case 4) List is empty for input address_family and user-defined
         #         address family != input address family.
         query = mock.Mock(address_family=message.ADDRESS_FAMILY_IPv4,
-                          user_defined_af=message.ADDRESS_FAMILY_IPv6)
+                          user_defined_af=message.ADDRESS_FAMILY_IPv6,
+                          timer=stage_timer.StageTimer())
         self.assertListEqual(['valid_candidate'],
                              base_resolver.get_candidates(query))
 
@@ -89,8 +105,7 @@ class ResolverBaseTestCase(unittest2.TestCase):
                            status_ipv6=message.STATUS_ONLINE),
             MockSliverTool(status_ipv4=message.STATUS_OFFLINE,
                            status_ipv6=message.STATUS_OFFLINE)]
-        memcache.set('valid_tool_id', sliver_tool_list,
-                     namespace=constants.MEMCACHE_NAMESPACE_TOOLS)
+        sliver_store.update('valid_tool_id', sliver_tool_list)
 
         base_resolver = resolver.ResolverBase()
         mock_query = mock.Mock(tool_id='valid_tool_id')
@@ -106,8 +121,7 @@ class ResolverBaseTestCase(unittest2.TestCase):
         sliver_tool_list = [
             MockSliverTool(status_ipv4=message.STATUS_OFFLINE,
                            status_ipv6=message.STATUS_OFFLINE)]
-        memcache.set('valid_tool_id', sliver_tool_list,
-                     namespace=constants.MEMCACHE_NAMESPACE_TOOLS)
+        sliver_store.update('valid_tool_id', sliver_tool_list)
 
         root = TestEntityGroupRoot(key_name='root')
         st1 = model.SliverTool(parent=root.key())
@@ -166,8 +180,7 @@ class ResolverBaseTestCase(unittest2.TestCase):
         sliver_tool_list = [
             MockSliverTool(status_ipv4=message.STATUS_OFFLINE,
                            status_ipv6=message.STATUS_OFFLINE)]
-        memcache.set('tool_id2', sliver_tool_list,
-                     namespace=constants.MEMCACHE_NAMESPACE_TOOLS)
+        sliver_store.update('tool_id2', sliver_tool_list)
 
         root = TestEntityGroupRoot(key_name='root')
         st1 = model.SliverTool(parent=root.key())
@@ -197,8 +210,7 @@ class ResolverBaseTestCase(unittest2.TestCase):
                 's2', message.STATUS_ONLINE, message.STATUS_ONLINE),
             MockSliverTool(
                 's1', message.STATUS_OFFLINE, message.STATUS_OFFLINE)]
-        memcache.set('valid_tool_id', sliver_tool_list,
-                     namespace=constants.MEMCACHE_NAMESPACE_TOOLS)
+        sliver_store.update('valid_tool_id', sliver_tool_list)
 
         base_resolver = resolver.ResolverBase()
         mock_query = mock.Mock(tool_id='valid_tool_id')
@@ -215,8 +227,7 @@ class ResolverBaseTestCase(unittest2.TestCase):
                 's2', message.STATUS_ONLINE, message.STATUS_ONLINE),
             MockSliverTool(
                 's1', message.STATUS_OFFLINE, message.STATUS_OFFLINE)]
-        memcache.set('valid_tool_id', sliver_tool_list,
-                     namespace=constants.MEMCACHE_NAMESPACE_TOOLS)
+        sliver_store.update('valid_tool_id', sliver_tool_list)
 
         root = TestEntityGroupRoot(key_name='root')
         st1 = model.SliverTool(parent=root.key())
@@ -281,8 +292,7 @@ class ResolverBaseTestCase(unittest2.TestCase):
         sliver_tool_list = [
             MockSliverTool(
                 's1', message.STATUS_OFFLINE, message.STATUS_OFFLINE)]
-        memcache.set('tool_id2', sliver_tool_list,
-                     namespace=constants.MEMCACHE_NAMESPACE_TOOLS)
+        sliver_store.update('tool_id2', sliver_tool_list)
 
         root = TestEntityGroupRoot(key_name='root')
         st1 = model.SliverTool(parent=root.key())
@@ -321,6 +331,48 @@ class ResolverBaseTestCase(unittest2.TestCase):
                              base_resolver.get_candidates(mock_query))
 
 
+class LocalCacheTestCase(unittest2.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_memcache_stub()
+        self.load = mock.Mock(return_value=['valid_candidate'])
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def testGetWithinTtl(self):
+        local_cache = resolver.LocalCache(ttl=60)
+        self.assertListEqual(['valid_candidate'],
+                             local_cache.get('key', self.load))
+        self.assertListEqual(['valid_candidate'],
+                             local_cache.get('key', self.load))
+        self.assertEqual(1, self.load.call_count)
+
+    def testGetExpiredSameGeneration(self):
+        candidate_cache.increment_generation()
+        local_cache = resolver.LocalCache(ttl=0)
+        local_cache.get('key', self.load)
+        local_cache.get('key', self.load)
+        self.assertEqual(1, self.load.call_count)
+
+    def testGetExpiredNewGeneration(self):
+        candidate_cache.increment_generation()
+        local_cache = resolver.LocalCache(ttl=0)
+        local_cache.get('key', self.load)
+        candidate_cache.increment_generation()
+        local_cache.get('key', self.load)
+        self.assertEqual(2, self.load.call_count)
+
+    def testGetNoneIsNotCached(self):
+        self.load.return_value = None
+        local_cache = resolver.LocalCache(ttl=60)
+        self.assertIsNone(local_cache.get('key', self.load))
+        self.assertIsNone(local_cache.get('key', self.load))
+        self.assertEqual(2, self.load.call_count)
+
+
 class GeoResolverTestCase(unittest2.TestCase):
 
     def testAnswerQueryNoCandidates(self):
@@ -390,6 +442,38 @@ class GeoResolverTestCase(unittest2.TestCase):
         self.assertEqual(1.0, results[0].longitude)
 
 
+class GeoResolverPublishedIndexTestCase(unittest2.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_memcache_stub()
+        resolver.local_cache.flush()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def testPublishedGeoIndexIsUsed(self):
+        candidate_cache.publish_metros([])
+        candidate_cache.publish_candidates('valid_tool_id', [
+            MockSliverTool('a', message.STATUS_ONLINE, message.STATUS_OFFLINE,
+                           latitude=2.0, longitude=1.0),
+            MockSliverTool('b', message.STATUS_ONLINE, message.STATUS_OFFLINE,
+                           latitude=20.0, longitude=34.9)])
+        mock_query = mock.MagicMock(tool_id='valid_tool_id', latitude=0.0,
+                                   longitude=0.0,
+                                   address_family=message.ADDRESS_FAMILY_IPv4,
+                                   user_defined_af=None)
+
+        for geo_resolver in (resolver.GeoResolver(),
+                             resolver.GeoResolverWithOptions()):
+            with mock.patch.object(spatial_index.GeoIndex,
+                                   '__init__') as mock_init:
+                results = geo_resolver.answer_query(mock_query)
+                self.assertFalse(mock_init.called)
+            self.assertEqual('a', results[0].site_id)
+
+
 class CountryResolverTestCase(unittest2.TestCase):
 
     def testAnswerQueryNoUserDefinedCountry(self):
@@ -441,6 +525,8 @@ class MetroResolverTestCase(unittest2.TestCase):
         self.testbed = testbed.Testbed()
         self.testbed.activate()
         self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        resolver.local_cache.flush()
 
     def tearDown(self):
         self.testbed.deactivate()
@@ -483,6 +569,25 @@ class MetroResolverTestCase(unittest2.TestCase):
         self.assertEqual(
             2, len(metro_resolver._get_candidates(mock_query, 'unused_arg')))
 
+    def testGetCandidatesFromMetroCandidates(self):
+        candidate_cache.publish_metros([('s1', ['metro1']),
+                                        ('s2', ['metro1', 'site2']),
+                                        ('s3', ['metro2'])])
+        candidate_cache.publish_candidates('valid_tool_id', [
+            MockSliverTool('s1', message.STATUS_ONLINE, message.STATUS_ONLINE),
+            MockSliverTool('s2', message.STATUS_ONLINE, message.STATUS_OFFLINE),
+            MockSliverTool('s3', message.STATUS_ONLINE, message.STATUS_ONLINE)])
+
+        metro_resolver = resolver.MetroResolver()
+        mock_query = mock.Mock(tool_id='valid_tool_id', metro='metro1')
+        candidates = metro_resolver._get_candidates(
+            mock_query, message.ADDRESS_FAMILY_IPv4)
+        self.assertSetEqual(set(['s1', 's2']),
+                            set([c.site_id for c in candidates]))
+        candidates = metro_resolver._get_candidates(
+            mock_query, message.ADDRESS_FAMILY_IPv6)
+        self.assertEqual(['s1'], [c.site_id for c in candidates])
+
 
 class ResolverTestCase(unittest2.TestCase):
     def testNewResolver(self):
@@ -0,0 +1,129 @@
+from google.appengine.ext import testbed
+
+import mock
+import unittest2
+
+from mlabns.util import candidate_cache
+from mlabns.util import message
+from mlabns.util import response_cache
+
+
+def _make_response(body):
+    return response_cache.CachedResponse(
+        body, response_cache.get_etag(body), 'application/json', (), None)
+
+
+class GetKeyTestCase(unittest2.TestCase):
+
+    def _make_query(self, **kwargs):
+        query = mock.Mock(tool_id='ndt', policy=message.POLICY_GEO,
+                          address_family=message.ADDRESS_FAMILY_IPv4,
+                          user_defined_af=None,
+                          response_format=message.FORMAT_JSON,
+                          latitude=44.1, longitude=-5.2, metro=None,
+                          user_defined_country=None)
+        for name, value in kwargs.iteritems():
+            setattr(query, name, value)
+        return query
+
+    def testGeoQueriesInTheSameCellShareTheKey(self):
+        self.assertEqual(
+            response_cache.get_key(self._make_query()),
+            response_cache.get_key(self._make_query(latitude=44.2,
+                                                    longitude=-5.1)))
+        self.assertNotEqual(
+            response_cache.get_key(self._make_query()),
+            response_cache.get_key(self._make_query(latitude=45.1)))
+
+    def testKeyDependsOnQueryParameters(self):
+        key = response_cache.get_key(self._make_query())
+        self.assertNotEqual(key, response_cache.get_key(
+            self._make_query(tool_id='npad')))
+        self.assertNotEqual(key, response_cache.get_key(
+            self._make_query(response_format=message.FORMAT_BT)))
+        self.assertNotEqual(
+            response_cache.get_key(self._make_query(
+                policy=message.POLICY_METRO, metro='ath')),
+            response_cache.get_key(self._make_query(
+                policy=message.POLICY_METRO, metro='lga')))
+
+    def testKeyDependsOnAddressFamilies(self):
+        # Clients of both address families asking for IPv4 servers get the
+        # same candidates, but not the same fqdns as dual-stack clients.
+        ipv4_query = self._make_query(
+            user_defined_af=message.ADDRESS_FAMILY_IPv4)
+        self.assertNotEqual(response_cache.get_key(self._make_query()),
+                            response_cache.get_key(ipv4_query))
+        # Dual-stack clients get candidates of their own address family
+        # first.
+        self.assertNotEqual(
+            response_cache.get_key(self._make_query()),
+            response_cache.get_key(self._make_query(
+                address_family=message.ADDRESS_FAMILY_IPv6)))
+        self.assertNotEqual(
+            response_cache.get_key(ipv4_query),
+            response_cache.get_key(self._make_query(
+                address_family=message.ADDRESS_FAMILY_IPv6,
+                user_defined_af=message.ADDRESS_FAMILY_IPv6)))
+
+    def testUncachedQueries(self):
+        self.assertIsNone(response_cache.get_key(
+            self._make_query(policy=message.POLICY_RANDOM)))
+        self.assertIsNone(response_cache.get_key(
+            self._make_query(response_format=message.FORMAT_HTML)))
+        self.assertIsNone(response_cache.get_key(
+            self._make_query(latitude=None, longitude=None)))
+
+
+class ResponseCacheTestCase(unittest2.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_memcache_stub()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def testGetReturnsNoneUntilAllVariantsAreSampled(self):
+        cache = response_cache.ResponseCache(max_variants=2)
+        self.assertIsNone(cache.get('key'))
+        cache.add('key', _make_response('a'))
+        self.assertIsNone(cache.get('key'))
+        cache.add('key', _make_response('b'))
+        self.assertIn(cache.get('key').body, ['a', 'b'])
+        self.assertEqual(2, len(cache.get_variants('key')))
+
+        cache.add('key', _make_response('c'))
+        self.assertEqual(2, len(cache.get_variants('key')))
+
+    def testLeastRecentlyUsedEntryIsEvicted(self):
+        cache = response_cache.ResponseCache(max_size=2, max_variants=1)
+        cache.add('key1', _make_response('a'))
+        cache.add('key2', _make_response('b'))
+        cache.get('key1')
+        cache.add('key3', _make_response('c'))
+        self.assertIsNotNone(cache.get('key1'))
+        self.assertIsNone(cache.get('key2'))
+        self.assertIsNotNone(cache.get('key3'))
+
+    def testNewGenerationDropsEntries(self):
+        cache = response_cache.ResponseCache(max_variants=1, ttl=0)
+        cache.add('key', _make_response('a'))
+        self.assertIsNotNone(cache.get('key'))
+
+        candidate_cache.increment_generation()
+        self.assertIsNone(cache.get('key'))
+
+    def testGetEtag(self):
+        self.assertEqual(response_cache.get_etag('a'),
+                         response_cache.get_etag('a'))
+        self.assertNotEqual(response_cache.get_etag('a'),
+                            response_cache.get_etag('b'))
+        self.assertTrue(response_cache.get_etag('a').startswith('"'))
+        self.assertEqual(response_cache.get_etag('abc'),
+                         response_cache.get_etag(['a', '', 'bc']))
+
+
+if __name__ == '__main__':
+    unittest2.main()
@@ -0,0 +1,164 @@
+from google.appengine.api import memcache
+from google.appengine.ext import db
+from google.appengine.ext import testbed
+
+import collections
+import mock
+import unittest2
+
+from mlabns.db import model
+from mlabns.util import candidate_cache
+from mlabns.util import constants
+from mlabns.util import message
+from mlabns.util import sliver_store
+
+# Stands in for model.SliverToolSnapshot: sliver tools are pickled into
+# memcache and compared by value.
+MockSliverTool = collections.namedtuple(
+    'MockSliverTool', ['fqdn', 'site_id', 'status_ipv4', 'status_ipv6'])
+
+
+def _make_sliver_tool(fqdn, status_ipv4=message.STATUS_ONLINE):
+    return MockSliverTool(fqdn, fqdn.split('.')[1], status_ipv4,
+                          message.STATUS_OFFLINE)
+
+
+class SliverStoreTestCase(unittest2.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_memcache_stub()
+        self.sliver_tools = [_make_sliver_tool('mlab1.abc01'),
+                             _make_sliver_tool('mlab2.abc01'),
+                             _make_sliver_tool('mlab1.xyz01')]
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def _get_manifest(self):
+        return memcache.get(
+            'tool_id', namespace=constants.MEMCACHE_NAMESPACE_SLIVER_MANIFESTS)
+
+    def _evict(self, fqdn):
+        record_id = self._get_manifest()['records'][fqdn]
+        memcache.delete('tool_id:%s:%s' % (fqdn, record_id),
+                        namespace=constants.MEMCACHE_NAMESPACE_SLIVER_RECORDS)
+
+    def testGetSliverToolsNotPublished(self):
+        self.assertIsNone(sliver_store.get_sliver_tools('tool_id'))
+
+    def testFirstUpdate(self):
+        expected = sorted(self.sliver_tools)
+        self.assertListEqual(
+            expected, sliver_store.update('tool_id', self.sliver_tools))
+        self.assertListEqual(expected,
+                             sliver_store.get_sliver_tools('tool_id'))
+        self.assertEqual(1, self._get_manifest()['version'])
+
+    def testUnchangedUpdateWritesNothing(self):
+        sliver_store.update('tool_id', self.sliver_tools)
+        with mock.patch.object(memcache, 'set_multi') as mock_set_multi:
+            self.assertIsNone(
+                sliver_store.update('tool_id', list(self.sliver_tools)))
+            self.assertFalse(mock_set_multi.called)
+        self.assertEqual(1, self._get_manifest()['version'])
+
+    def testDeltaUpdate(self):
+        sliver_store.update('tool_id', self.sliver_tools)
+        changed = _make_sliver_tool('mlab2.abc01', message.STATUS_OFFLINE)
+        with mock.patch.object(
+            memcache, 'set_multi', wraps=memcache.set_multi) as mock_set_multi:
+            published = sliver_store.update('tool_id', [changed])
+            self.assertEqual(1, len(mock_set_multi.call_args[0][0]))
+
+        # Sliver tools missing from the update are kept.
+        self.assertListEqual(
+            [self.sliver_tools[0], self.sliver_tools[2], changed], published)
+        self.assertListEqual(published,
+                             sliver_store.get_sliver_tools('tool_id'))
+        manifest = self._get_manifest()
+        self.assertEqual(2, manifest['version'])
+        self.assertEqual(manifest['records']['mlab1.abc01'],
+                         manifest['records']['mlab1.xyz01'])
+        self.assertNotEqual(manifest['records']['mlab1.abc01'],
+                            manifest['records']['mlab2.abc01'])
+
+    def testEvictedRecord(self):
+        sliver_store.update('tool_id', self.sliver_tools)
+        self._evict('mlab1.xyz01')
+        self.assertIsNone(sliver_store.get_sliver_tools('tool_id'))
+
+        # The next update rewrites the evicted record.
+        self.assertListEqual(
+            sorted(self.sliver_tools),
+            sliver_store.update('tool_id', self.sliver_tools))
+        self.assertListEqual(sorted(self.sliver_tools),
+                             sliver_store.get_sliver_tools('tool_id'))
+
+    @mock.patch.object(model, 'get_sliver_tool_snapshots',
+                       side_effect=lambda sliver_tools: sliver_tools)
+    @mock.patch.object(model.SliverTool, 'gql')
+    def testEvictedRecordIsReadFromDatastore(self, mock_gql,
+                                             unused_mock_snapshots):
+        sliver_store.update('tool_id', self.sliver_tools)
+        self._evict('mlab1.xyz01')
+        mock_gql.return_value.run.return_value = self.sliver_tools
+
+        # A partial update does not drop the evicted sliver tool.
+        changed = _make_sliver_tool('mlab2.abc01', message.STATUS_OFFLINE)
+        expected = [self.sliver_tools[0], self.sliver_tools[2], changed]
+        self.assertListEqual(expected,
+                             sliver_store.update('tool_id', [changed]))
+        self.assertListEqual(expected,
+                             sliver_store.get_sliver_tools('tool_id'))
+        mock_gql.assert_called_once_with('WHERE tool_id=:tool_id',
+                                         tool_id='tool_id')
+
+    @mock.patch.object(model.SliverTool, 'gql')
+    def testEvictedRecordAndDatastoreFailure(self, mock_gql):
+        sliver_store.update('tool_id', self.sliver_tools)
+        self._evict('mlab1.xyz01')
+        mock_gql.return_value.run.side_effect = db.Timeout()
+
+        changed = _make_sliver_tool('mlab2.abc01', message.STATUS_OFFLINE)
+        self.assertIsNone(sliver_store.update('tool_id', [changed]))
+        # The manifest is left incomplete, so that readers keep falling back
+        # to the datastore.
+        self.assertEqual(1, self._get_manifest()['version'])
+        self.assertIsNone(sliver_store.get_sliver_tools('tool_id'))
+
+    def testConcurrentUpdateIsRetried(self):
+        sliver_store.update('tool_id', self.sliver_tools)
+        changed = _make_sliver_tool('mlab1.xyz01', message.STATUS_OFFLINE)
+        with mock.patch.object(memcache.Client, 'cas',
+                               side_effect=[False, True]) as mock_cas:
+            self.assertIsNotNone(sliver_store.update('tool_id', [changed]))
+            self.assertEqual(2, mock_cas.call_count)
+
+        with mock.patch.object(memcache.Client, 'cas', return_value=False):
+            self.assertIsNone(sliver_store.update(
+                'tool_id', [self.sliver_tools[2]], retries=1))
+
+    @mock.patch.object(candidate_cache, 'publish_candidates', autospec=True)
+    def testPublish(self, mock_publish_candidates):
+        sliver_store.publish('tool_id', self.sliver_tools)
+        mock_publish_candidates.assert_called_once_with(
+            'tool_id', sorted(self.sliver_tools))
+
+        # Nothing changed, but the candidate tables are missing.
+        mock_publish_candidates.reset_mock()
+        sliver_store.publish('tool_id', self.sliver_tools)
+        mock_publish_candidates.assert_called_once_with(
+            'tool_id', sorted(self.sliver_tools))
+
+        # Nothing changed and the candidate tables are in memcache.
+        mock_publish_candidates.reset_mock()
+        with mock.patch.object(candidate_cache, 'get_candidates',
+                               return_value=[]):
+            sliver_store.publish('tool_id', self.sliver_tools)
+        self.assertFalse(mock_publish_candidates.called)
+
+
+if __name__ == '__main__':
+    unittest2.main()
@@ -0,0 +1,89 @@
+import unittest2
+
+from mlabns.util import distance
+from mlabns.util import spatial_index
+
+
+class MockSliverTool():
+
+    def __init__(self, site_id, latitude, longitude):
+        self.site_id = site_id
+        self.latitude = latitude
+        self.longitude = longitude
+
+
+class SiteIndexTestCase(unittest2.TestCase):
+
+    site_index_class = spatial_index.SiteIndex
+
+    SITES = [('ath01', 37.93, 23.94),
+             ('lga01', 40.77, -73.87),
+             ('lga02', 40.77, -73.87),
+             ('nuq01', 37.42, -122.06),
+             ('syd01', -33.94, 151.17),
+             ('nbo01', -1.32, 36.92)]
+
+    def testNearestEmpty(self):
+        site_index = self.site_index_class([])
+        self.assertEqual((None, []), site_index.nearest(0.0, 0.0))
+        self.assertEqual([], site_index.k_nearest(0.0, 0.0, 4))
+
+    def testNearestSingleSite(self):
+        site_index = self.site_index_class(self.SITES)
+        min_distance, site_ids = site_index.nearest(38.0, 23.7)
+        self.assertListEqual(['ath01'], site_ids)
+        self.assertAlmostEqual(distance.distance(38.0, 23.7, 37.93, 23.94),
+                               min_distance)
+
+    def testNearestReturnsTies(self):
+        site_index = self.site_index_class(self.SITES)
+        unused_distance, site_ids = site_index.nearest(40.0, -74.0)
+        self.assertItemsEqual(['lga01', 'lga02'], site_ids)
+
+    def testKNearestMatchesBruteForce(self):
+        site_index = self.site_index_class(self.SITES)
+        expected = sorted(
+            (distance.distance(10.0, 10.0, latitude, longitude), site_id)
+            for site_id, latitude, longitude in self.SITES)
+        results = site_index.k_nearest(10.0, 10.0, 3)
+        self.assertEqual(3, len(results))
+        for (expected_distance, unused_id), (result_distance, unused_id) in \
+            zip(expected[:3], results):
+            self.assertAlmostEqual(expected_distance, result_distance)
+
+    def testKNearestMoreThanAvailable(self):
+        site_index = self.site_index_class(self.SITES)
+        self.assertEqual(len(self.SITES),
+                         len(site_index.k_nearest(0.0, 0.0, 100)))
+
+
+class SiteScanTestCase(SiteIndexTestCase):
+
+    site_index_class = spatial_index.SiteScan
+
+
+class GeoIndexTestCase(unittest2.TestCase):
+
+    def testGeoIndex(self):
+        sliver_tools = [MockSliverTool('ath01', 37.93, 23.94),
+                        MockSliverTool('nuq01', 37.42, -122.06),
+                        MockSliverTool('ath01', 37.93, 23.94)]
+        geo_index = spatial_index.GeoIndex(sliver_tools)
+        self.assertIs(sliver_tools, geo_index.candidates)
+        self.assertEqual({'ath01': [sliver_tools[0], sliver_tools[2]],
+                          'nuq01': [sliver_tools[1]]},
+                         geo_index.site_candidates)
+        self.assertEqual(['nuq01'],
+                         geo_index.site_index.nearest(37.0, -122.0)[1])
+
+    def testOneShotGeoIndexScans(self):
+        sliver_tools = [MockSliverTool('ath01', 37.93, 23.94),
+                        MockSliverTool('nuq01', 37.42, -122.06)]
+        geo_index = spatial_index.GeoIndex(sliver_tools, one_shot=True)
+        self.assertIsInstance(geo_index.site_index, spatial_index.SiteScan)
+        self.assertEqual(['nuq01'],
+                         geo_index.site_index.nearest(37.0, -122.0)[1])
+
+
+if __name__ == '__main__':
+    unittest2.main()
@@ -0,0 +1,106 @@
+import logging
+import mock
+import unittest2
+
+from mlabns.util import constants
+from mlabns.util import message
+from mlabns.util import stage_timer
+
+
+class HistogramTestCase(unittest2.TestCase):
+
+    def testEmptyHistogram(self):
+        histogram = stage_timer.Histogram()
+        self.assertIsNone(histogram.percentile(50))
+
+    def testPercentiles(self):
+        histogram = stage_timer.Histogram()
+        for i in range(1, 101):
+            histogram.add(i / 1000.0)
+        for percent in [50, 95, 99]:
+            expected = percent / 1000.0
+            estimate = histogram.percentile(percent)
+            self.assertGreaterEqual(estimate, expected)
+            self.assertLessEqual(
+                estimate, expected * constants.HISTOGRAM_GROWTH_FACTOR)
+        self.assertEqual(0.1, histogram.percentile(100))
+
+    def testDurationAboveLastBucket(self):
+        histogram = stage_timer.Histogram()
+        histogram.add(constants.HISTOGRAM_MAX_SECONDS * 2)
+        self.assertEqual(constants.HISTOGRAM_MAX_SECONDS * 2,
+                         histogram.percentile(99))
+
+    def testMerge(self):
+        histogram1 = stage_timer.Histogram()
+        histogram1.add(0.001)
+        histogram2 = stage_timer.Histogram()
+        histogram2.add(0.002)
+        histogram2.add(0.003)
+        histogram1.merge(histogram2)
+        self.assertEqual(3, histogram1.count)
+        self.assertEqual(0.003, histogram1.max)
+        self.assertAlmostEqual(0.006, histogram1.total)
+
+
+class StageTimingsTestCase(unittest2.TestCase):
+
+    def setUp(self):
+        time_patch = mock.patch.object(stage_timer.time, 'time',
+                                       return_value=1000.0)
+        self.addCleanup(time_patch.stop)
+        self.mock_time = time_patch.start()
+        self.timings = stage_timer.StageTimings(flush_interval=60)
+
+    def testStageTimer(self):
+        timer = stage_timer.StageTimer()
+        self.mock_time.side_effect = [1000.0, 1000.002, 1000.002, 1000.003]
+        with timer.time(stage_timer.STAGE_GEOLOCATION):
+            pass
+        with timer.time(stage_timer.STAGE_GEOLOCATION):
+            pass
+        self.mock_time.side_effect = None
+        timer.add(stage_timer.STAGE_RENDER, 0.004)
+        timer.finish(message.POLICY_GEO, self.timings)
+
+        summary = self.timings.get_summary()
+        self.assertEqual(
+            [[stage_timer.STAGE_GEOLOCATION, message.POLICY_GEO, 1],
+             [stage_timer.STAGE_RENDER, message.POLICY_GEO, 1]],
+            [row[:3] for row in summary])
+        self.assertAlmostEqual(3.0, summary[0][3])
+        self.assertAlmostEqual(4.0, summary[1][3])
+        self.assertEqual({}, timer.durations)
+
+    def testSummaryIsPerStageAndPolicy(self):
+        self.timings.record(stage_timer.STAGE_TOTAL, message.POLICY_GEO, 0.01)
+        self.timings.record(stage_timer.STAGE_TOTAL, message.POLICY_GEO, 0.02)
+        self.timings.record(stage_timer.STAGE_TOTAL, message.POLICY_RANDOM,
+                            0.03)
+
+        summary = self.timings.get_summary()
+        self.assertEqual(2, len(summary))
+        geo_row = dict(zip(stage_timer.SUMMARY_HEADERS, summary[0]))
+        self.assertEqual(message.POLICY_GEO, geo_row['policy'])
+        self.assertEqual(2, geo_row['count'])
+        self.assertAlmostEqual(15.0, geo_row['mean_ms'])
+        self.assertEqual(20.0, geo_row['max_ms'])
+        self.assertEqual(20.0, geo_row['p99_ms'])
+
+    @mock.patch.object(logging, 'info', autospec=True)
+    def testFlush(self, mock_info):
+        self.timings.record(stage_timer.STAGE_TOTAL, message.POLICY_GEO, 0.01)
+        self.mock_time.return_value = 1061.0
+        self.timings.record(stage_timer.STAGE_TOTAL, message.POLICY_GEO, 0.02)
+        self.assertEqual(1, mock_info.call_count)
+        # The previous interval is still included in the summary.
+        self.assertEqual(2, self.timings.get_summary()[0][2])
+
+        self.mock_time.return_value = 1122.0
+        self.assertEqual(1, self.timings.get_summary()[0][2])
+        self.mock_time.return_value = 1183.0
+        self.assertListEqual([], self.timings.get_summary())
+
+
+if __name__ == '__main__':
+    unittest2.main()
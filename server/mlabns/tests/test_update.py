@@ -1,16 +1,39 @@
+from google.appengine.ext import db
+from google.appengine.ext import testbed
+
+import BaseHTTPServer
+import mimetools
 import mock
+import SocketServer
 import StringIO
+import threading
+import time
 import urllib2
+import urlparse
 import unittest2
 
 from mlabns.handlers import update
 from mlabns.db import model
+from mlabns.util import candidate_cache
+from mlabns.util import message
+from mlabns.util import sliver_store
 from mlabns.util import util
 
 
+def _make_response(content):
+    return urllib2.addinfourl(StringIO.StringIO(content),
+                              mimetools.Message(StringIO.StringIO('')),
+                              'http://ks.measurementlab.net/')
+
+
 class SiteRegistrationHandlerTest(unittest2.TestCase):
 
     def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_memcache_stub()
+        self.addCleanup(self.testbed.deactivate)
+
         # Patch out the APIs that SiteRegistrationHandler calls.
         #
         # TODO(mtlynch): Redesign SiteRegistrationHandler to be more
@@ -33,7 +56,7 @@ class SiteRegistrationHandlerTest(unittest2.TestCase):
 
     def testGetIgnoresTestSites(self):
         """Test sites should not be processed in the sites update."""
-        urllib2.urlopen.return_value = StringIO.StringIO("""[
+        urllib2.urlopen.return_value = _make_response("""[
 {
     "site": "xyz0t",
     "metro": ["xyz0t", "xyz"],
@@ -53,7 +76,8 @@ class SiteRegistrationHandlerTest(unittest2.TestCase):
     "longitude": 34.567890
 }
 ]""")
-        model.Site.all.return_value = [mock.Mock(site_id='xyz01')]
+        model.Site.all.return_value = [
+            mock.Mock(site_id='xyz01', metro=['xyz01', 'xyz'])]
         handler = update.SiteRegistrationHandler()
         handler.get()
 
@@ -61,6 +85,373 @@ class SiteRegistrationHandlerTest(unittest2.TestCase):
 
         self.assertFalse(model.Site.called,
                          'Test site should not be added to the datastore')
+        self.assertEqual({'xyz01': frozenset(['xyz01']),
+                          'xyz': frozenset(['xyz01'])},
+                         candidate_cache.get_metros())
+
+
+class IPUpdateHandlerTest(unittest2.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_memcache_stub()
+        self.addCleanup(self.testbed.deactivate)
+
+        urlopen_patch = mock.patch.object(urllib2, 'urlopen', autospec=True)
+        self.addCleanup(urlopen_patch.stop)
+        urlopen_patch.start()
+
+        for model_class in [model.SliverTool, model.Tool, model.Site]:
+            for method in ['all', 'gql']:
+                model_patch = mock.patch.object(model_class, method)
+                self.addCleanup(model_patch.stop)
+                model_patch.start()
+
+        put_patch = mock.patch.object(db, 'put', autospec=True)
+        self.addCleanup(put_patch.stop)
+        put_patch.start()
+
+        snapshots_patch = mock.patch.object(
+            model, 'get_sliver_tool_snapshots', autospec=True,
+            side_effect=lambda sliver_tools: sliver_tools)
+        self.addCleanup(snapshots_patch.stop)
+        snapshots_patch.start()
+
+        publish_patch = mock.patch.object(candidate_cache,
+                                          'publish_candidates', autospec=True)
+        self.addCleanup(publish_patch.stop)
+        publish_patch.start()
+
+        util_patch = mock.patch.object(util, 'send_success', autospec=True)
+        self.addCleanup(util_patch.stop)
+        util_patch.start()
+
+    IP_LIST = ('ndt.iupui.mlab1.xyz01.measurement-lab.org,1.2.3.4,\n'
+               'ndt.iupui.mlab2.xyz01.measurement-lab.org,1.2.3.6,::6\n'
+               'ndt.iupui.mlab3.xyz01.measurement-lab.org,1.2.3.7,\n'
+               'npad.iupui.mlab1.xyz01.measurement-lab.org,1.2.3.8,\n'
+               'ndt.iupui.mlab1.abc01.measurement-lab.org,1.2.3.9,\n')
+
+    def testGetWritesOnlyChangedSliverTools(self):
+        unchanged = model.SliverTool(
+            tool_id='ndt', fqdn='ndt.iupui.mlab1.xyz01.measurement-lab.org',
+            sliver_ipv4='1.2.3.4', sliver_ipv6='')
+        changed = model.SliverTool(
+            tool_id='ndt', fqdn='ndt.iupui.mlab2.xyz01.measurement-lab.org',
+            sliver_ipv4='1.2.3.5', sliver_ipv6='')
+        model.SliverTool.all.return_value.run.return_value = [unchanged,
+                                                              changed]
+        model.Tool.all.return_value.run.return_value = [
+            model.Tool(tool_id='ndt', slice_id='iupui_ndt',
+                       server_port='3001', http_port='7123')]
+        model.Site.all.return_value.run.return_value = [
+            model.Site(site_id='xyz01', city='Xyzville', country='AB',
+                       latitude=1.0, longitude=2.0)]
+        urllib2.urlopen.return_value = _make_response(self.IP_LIST)
+
+        update.IPUpdateHandler().get()
+
+        self.assertFalse(model.SliverTool.gql.called)
+        self.assertFalse(model.Tool.gql.called)
+        self.assertFalse(model.Site.gql.called)
+        self.assertEqual(1, db.put.call_count)
+        written = db.put.call_args[0][0]
+        self.assertEqual(
+            [changed.fqdn, 'ndt.iupui.mlab3.xyz01.measurement-lab.org'],
+            [sliver_tool.fqdn for sliver_tool in written])
+        self.assertEqual(('1.2.3.6', '::6'),
+                         (changed.sliver_ipv4, changed.sliver_ipv6))
+        self.assertEqual('xyz01', written[1].site_id)
+        self.assertEqual('1.2.3.7', written[1].sliver_ipv4)
+        candidate_cache.publish_candidates.assert_called_once_with(
+            'ndt', [unchanged] + written)
+        self.assertTrue(util.send_success.called)
+
+    def testGetReloadsCachedTools(self):
+        stale_tool = model.Tool(tool_id='ndt', show_tool_extra=False)
+        model.Tool.all.return_value.run.return_value = [stale_tool]
+        self.assertIs(stale_tool, model.get_tool_from_tool_id('ndt'))
+
+        tool = model.Tool(tool_id='ndt', show_tool_extra=True)
+        model.Tool.all.return_value.run.return_value = [tool]
+        model.SliverTool.all.return_value.run.return_value = []
+        model.Site.all.return_value.run.return_value = []
+        urllib2.urlopen.return_value = _make_response(self.IP_LIST)
+        update.IPUpdateHandler().get()
+
+        self.assertIs(tool, model.get_tool_from_tool_id('ndt'))
+
+    def testGetSkipsUnchangedIPList(self):
+        model.SliverTool.all.return_value.run.return_value = []
+        model.Tool.all.return_value.run.return_value = []
+        model.Site.all.return_value.run.return_value = []
+        urllib2.urlopen.return_value = _make_response(self.IP_LIST)
+        update.IPUpdateHandler().get()
+        self.assertTrue(model.SliverTool.all.called)
+
+        model.SliverTool.all.reset_mock()
+        urllib2.urlopen.return_value = _make_response(self.IP_LIST)
+        update.IPUpdateHandler().get()
+        self.assertFalse(model.SliverTool.all.called)
+        self.assertFalse(db.put.called)
+        self.assertEqual(2, util.send_success.call_count)
+
+        # A new IP address is processed.
+        urllib2.urlopen.return_value = _make_response(
+            self.IP_LIST +
+            'ndt.iupui.mlab2.abc01.measurement-lab.org,1.2.3.10,\n')
+        update.IPUpdateHandler().get()
+        self.assertTrue(model.SliverTool.all.called)
+
+
+class FakeNagiosServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Serves the status of two slivers for any service name."""
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           FakeNagiosRequestHandler)
+        self.lock = threading.Lock()
+        self.requests = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        # Nagios state of mlab2, and ETag of the pages.
+        self.mlab2_state = '2'
+        self.etag = '"1"'
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/status' % self.server_address[1]
+
+
+class FakeNagiosRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        server = self.server
+        service_name = urlparse.parse_qs(
+            urlparse.urlparse(self.path).query)['service_name'][0]
+        with server.lock:
+            server.requests.append(service_name)
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+        # Leave time for the other fetches to start.
+        time.sleep(0.1)
+        if service_name == 'broken_ipv6':
+            self.send_error(500)
+        elif self.headers.getheader('If-None-Match') == server.etag:
+            self.send_response(304)
+            self.end_headers()
+        else:
+            self.send_response(200)
+            self.send_header('ETag', server.etag)
+            self.end_headers()
+            self.wfile.write(
+                'mlab1.xyz01.measurement-lab.org/%s 0 1 extra1\n'
+                'mlab2.xyz01.measurement-lab.org/%s %s 1 extra2\n' % (
+                    service_name, service_name, server.mlab2_state))
+        with server.lock:
+            server.in_flight -= 1
+
+    def log_message(self, *args):
+        pass
+
+
+class StatusUpdateHandlerTest(unittest2.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_memcache_stub()
+        self.addCleanup(self.testbed.deactivate)
+
+        self.nagios = FakeNagiosServer()
+        nagios_thread = threading.Thread(target=self.nagios.serve_forever)
+        nagios_thread.daemon = True
+        nagios_thread.start()
+        self.addCleanup(self.nagios.server_close)
+        self.addCleanup(self.nagios.shutdown)
+
+        nagios_model_patch = mock.patch.object(model, 'Nagios', autospec=True)
+        self.addCleanup(nagios_model_patch.stop)
+        nagios_model_patch.start()
+        model.Nagios.get_by_key_name.return_value = mock.Mock(
+            url=self.nagios.url, username='user', password='secret')
+
+        tool_model_patch = mock.patch.object(model, 'Tool', autospec=True)
+        self.addCleanup(tool_model_patch.stop)
+        tool_model_patch.start()
+
+        util_patch = mock.patch.object(util, 'send_success', autospec=True)
+        self.addCleanup(util_patch.stop)
+        util_patch.start()
+
+        update_patch = mock.patch.object(
+            update.StatusUpdateHandler, 'update_sliver_tools_status',
+            autospec=True)
+        self.addCleanup(update_patch.stop)
+        self.mock_update_sliver_tools_status = update_patch.start()
+
+    def testGetInvalidatesToolCache(self):
+        model.Tool.gql.return_value.run.return_value = []
+        with mock.patch.object(model, 'invalidate_tool_cache',
+                               autospec=True):
+            update.StatusUpdateHandler().get()
+            self.assertTrue(model.invalidate_tool_cache.called)
+
+    def testGetFetchesNagiosConcurrently(self):
+        model.Tool.gql.return_value.run.return_value = [
+            mock.Mock(tool_id='ndt'), mock.Mock(tool_id='npad'),
+            mock.Mock(tool_id='broken')]
+        handler = update.StatusUpdateHandler()
+        handler.get()
+
+        self.assertItemsEqual(
+            ['ndt', 'ndt_ipv6', 'npad', 'npad_ipv6', 'broken', 'broken_ipv6'],
+            self.nagios.requests)
+        self.assertGreater(self.nagios.max_in_flight, 1)
+        self.assertTrue(util.send_success.called)
+
+        # The slices are processed in order, skipping the failed fetch.
+        calls = (update.StatusUpdateHandler.update_sliver_tools_status.
+                 call_args_list)
+        self.assertEqual(
+            [('ndt', ''), ('ndt', '_ipv6'), ('npad', ''), ('npad', '_ipv6'),
+             ('broken', '')],
+            [(args[2], args[3]) for args, _ in calls])
+        self.assertDictEqual(
+            {'mlab1.xyz01.measurement-lab.org': {
+                'status': message.STATUS_ONLINE, 'tool_extra': 'extra1'},
+             'mlab2.xyz01.measurement-lab.org': {
+                'status': message.STATUS_OFFLINE, 'tool_extra': 'extra2'}},
+            calls[1][0][1])
+
+    @mock.patch.object(sliver_store, 'is_published', return_value=True)
+    def testGetSkipsUnchangedPages(self, unused_mock_is_published):
+        model.Tool.gql.return_value.run.return_value = [
+            mock.Mock(tool_id='ndt'), mock.Mock(tool_id='npad')]
+        update_sliver_tools_status = self.mock_update_sliver_tools_status
+        # The first status of npad_ipv6 fails to be written.
+        update_sliver_tools_status.side_effect = (
+            lambda handler, slice_status, tool_id, family:
+                (tool_id, family) != ('npad', '_ipv6'))
+        update.StatusUpdateHandler().get()
+        self.assertEqual(4, update_sliver_tools_status.call_count)
+
+        update_sliver_tools_status.reset_mock()
+        update.StatusUpdateHandler().get()
+        self.assertEqual(
+            [('npad', '_ipv6')],
+            [(args[2], args[3])
+             for args, _ in update_sliver_tools_status.call_args_list])
+
+        # Changed pages are processed again.
+        update_sliver_tools_status.reset_mock()
+        self.nagios.mlab2_state = '0'
+        self.nagios.etag = '"2"'
+        update.StatusUpdateHandler().get()
+        self.assertEqual(4, update_sliver_tools_status.call_count)
+
+    def testGetProcessesUnpublishedTools(self):
+        model.Tool.gql.return_value.run.return_value = [
+            mock.Mock(tool_id='ndt')]
+        update.StatusUpdateHandler().get()
+        update.StatusUpdateHandler().get()
+        self.assertEqual(4, self.mock_update_sliver_tools_status.call_count)
+
+
+class UpdateSliverToolsStatusTest(unittest2.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_memcache_stub()
+        self.addCleanup(self.testbed.deactivate)
+
+        sliver_tool_model_patch = mock.patch.object(model.SliverTool, 'gql')
+        self.addCleanup(sliver_tool_model_patch.stop)
+        sliver_tool_model_patch.start()
+
+        put_patch = mock.patch.object(db, 'put', autospec=True)
+        self.addCleanup(put_patch.stop)
+        put_patch.start()
+
+        snapshots_patch = mock.patch.object(
+            model, 'get_sliver_tool_snapshots', autospec=True,
+            side_effect=lambda sliver_tools: sliver_tools)
+        self.addCleanup(snapshots_patch.stop)
+        snapshots_patch.start()
+
+        publish_patch = mock.patch.object(candidate_cache,
+                                          'publish_candidates', autospec=True)
+        self.addCleanup(publish_patch.stop)
+        publish_patch.start()
+
+    def _make_sliver_tool(self, server_id, sliver_ipv4='1.2.3.4',
+                          status_ipv4=message.STATUS_ONLINE,
+                          tool_extra='extra'):
+        return model.SliverTool(
+            tool_id='ndt', slice_id='iupui_ndt', site_id='xyz01',
+            server_id=server_id,
+            fqdn='%s.xyz01.measurement-lab.org' % server_id,
+            sliver_ipv4=sliver_ipv4, sliver_ipv6=message.NO_IP_ADDRESS,
+            status_ipv4=status_ipv4, status_ipv6=message.STATUS_OFFLINE,
+            tool_extra=tool_extra, update_request_timestamp=0)
+
+    def testOnlyChangedSliverToolsAreWritten(self):
+        unchanged = self._make_sliver_tool('mlab1')
+        status_changed = self._make_sliver_tool('mlab2')
+        extra_changed = self._make_sliver_tool('mlab3')
+        no_ip = self._make_sliver_tool('mlab4',
+                                       sliver_ipv4=message.NO_IP_ADDRESS)
+        unknown = self._make_sliver_tool('mlab5')
+        model.SliverTool.gql.return_value.run.return_value = [
+            unchanged, status_changed, extra_changed, no_ip, unknown]
+        slice_status = {}
+        for sliver_tool, status, tool_extra in [
+            (unchanged, message.STATUS_ONLINE, 'extra'),
+            (status_changed, message.STATUS_OFFLINE, 'extra'),
+            (extra_changed, message.STATUS_ONLINE, 'new_extra'),
+            (no_ip, message.STATUS_ONLINE, 'extra')]:
+            slice_status[sliver_tool.fqdn] = {'status': status,
+                                              'tool_extra': tool_extra}
+
+        handler = update.StatusUpdateHandler()
+        with mock.patch.object(update.model, 'put_in_batches',
+                               wraps=model.put_in_batches) as put_in_batches:
+            handler.update_sliver_tools_status(
+                slice_status, 'ndt', update.StatusUpdateHandler.AF_IPV4)
+
+        put_in_batches.assert_called_once_with(
+            [status_changed, extra_changed, no_ip])
+        db.put.assert_called_once_with([status_changed, extra_changed, no_ip])
+        self.assertEqual(message.STATUS_OFFLINE, status_changed.status_ipv4)
+        self.assertEqual('new_extra', extra_changed.tool_extra)
+        self.assertEqual(message.STATUS_OFFLINE, no_ip.status_ipv4)
+        self.assertEqual(0, unchanged.update_request_timestamp)
+        self.assertGreater(status_changed.update_request_timestamp, 0)
+        candidate_cache.publish_candidates.assert_called_once_with(
+            'ndt', [unchanged, status_changed, extra_changed, no_ip])
+
+    def testFailedWritesAreNotPublished(self):
+        unchanged = self._make_sliver_tool('mlab1')
+        changed = self._make_sliver_tool('mlab2')
+        model.SliverTool.gql.return_value.run.return_value = [unchanged,
+                                                               changed]
+        slice_status = {
+            unchanged.fqdn: {'status': message.STATUS_ONLINE,
+                             'tool_extra': 'extra'},
+            changed.fqdn: {'status': message.STATUS_OFFLINE,
+                           'tool_extra': 'extra'}}
+
+        handler = update.StatusUpdateHandler()
+        with mock.patch.object(update.model, 'put_in_batches',
+                               return_value=[changed]):
+            handler.update_sliver_tools_status(
+                slice_status, 'ndt', update.StatusUpdateHandler.AF_IPV4)
+
+        candidate_cache.publish_candidates.assert_called_once_with(
+            'ndt', [unchanged])
 
 
 if __name__ == '__main__':
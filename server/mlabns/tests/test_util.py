@@ -1,3 +1,5 @@
+from google.appengine.ext import testbed
+
 import unittest2
 
 from mlabns.util import message
@@ -18,6 +20,15 @@ class UtilTestCase(unittest2.TestCase):
         def error(self, error_code):
             self.error_code = error_code
 
+    def setUp(self):
+        # The compiled templates are cached in memcache.
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_memcache_stub()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
     def testSendNotFoundJson(self):
         request = UtilTestCase.RequestMockup()
         util.send_not_found(request, output_type=message.FORMAT_JSON)
@@ -70,6 +81,18 @@ class UtilTestCase(unittest2.TestCase):
         self.assertEqual(request.response.out.msg,
                          '<html> Success! </html>')
 
+    def testTemplatesAreCompiledOnce(self):
+        self.assertIs(util._get_jinja_template('not_found.html'),
+                      util._get_jinja_template('not_found.html'))
+
+    def testRenderTemplate(self):
+        html = util.render_template('map_view.html', {
+            'cities': '[]', 'tool_id': 'ndt', 'address_family': 'ipv4'})
+        self.assertIn('Ndt ipv4', html)
+        self.assertIn('/admin/map/ipv4/npad', html)
+        self.assertNotIn('/admin/map/ipv4/ndt">Ndt<', html)
+        self.assertIn('/admin/map/ipv6/ndt', html)
+
 
 if __name__ == '__main__':
     unittest2.main()
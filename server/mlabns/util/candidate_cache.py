@@ -0,0 +1,219 @@
+from google.appengine.api import memcache
+
+from mlabns.db import model
+from mlabns.util import constants
+from mlabns.util import message
+from mlabns.util import spatial_index
+
+import logging
+
+ADDRESS_FAMILIES = [message.ADDRESS_FAMILY_IPv4, message.ADDRESS_FAMILY_IPv6]
+
+
+def _get_key(tool_id, address_family):
+    return '%s:%s' % (tool_id, address_family)
+
+
+def is_online(sliver_tool, address_family):
+    """Indicates whether a sliver tool is online for an address family.
+
+    Args:
+        sliver_tool: A SliverTool entity.
+        address_family: A string specifying the address family.
+
+    Returns:
+        True if the sliver tool is online for 'address_family'.
+    """
+    if address_family == message.ADDRESS_FAMILY_IPv4:
+        return sliver_tool.status_ipv4 == message.STATUS_ONLINE
+    if address_family == message.ADDRESS_FAMILY_IPv6:
+        return sliver_tool.status_ipv6 == message.STATUS_ONLINE
+    return False
+
+
+def publish_candidates(tool_id, sliver_tools):
+    """Publishes the online candidates of a tool to memcache.
+
+    For each address family, four tables are written: the list of online
+    sliver tools, the same sliver tools grouped by site and grouped by metro
+    (used by the metro policy), and their GeoIndex (used by the geo
+    policies). Readers can then use them as they are, without filtering.
+
+    Args:
+        tool_id: A string representing the tool id.
+        sliver_tools: A list of all the SliverTool entities of the tool.
+
+    Returns:
+        True if all the tables were written for all the address families,
+        False otherwise.
+    """
+    metros = get_metros()
+    candidates = {}
+    site_candidates = {}
+    metro_candidates = {}
+    geo_indexes = {}
+    for address_family in ADDRESS_FAMILIES:
+        online = []
+        online_by_site = {}
+        for sliver_tool in sliver_tools:
+            if not is_online(sliver_tool, address_family):
+                continue
+            online.append(sliver_tool)
+            online_by_site.setdefault(sliver_tool.site_id, []).append(
+                sliver_tool)
+        key = _get_key(tool_id, address_family)
+        candidates[key] = online
+        site_candidates[key] = online_by_site
+        online_by_metro = {}
+        for metro, site_ids in metros.iteritems():
+            online_by_metro[metro] = []
+            for site_id in site_ids:
+                online_by_metro[metro].extend(online_by_site.get(site_id, []))
+        metro_candidates[key] = online_by_metro
+        geo_indexes[key] = spatial_index.GeoIndex(online)
+
+    failed_keys = memcache.set_multi(
+        candidates, namespace=constants.MEMCACHE_NAMESPACE_CANDIDATES)
+    failed_keys += memcache.set_multi(
+        site_candidates,
+        namespace=constants.MEMCACHE_NAMESPACE_SITE_CANDIDATES)
+    failed_keys += memcache.set_multi(
+        metro_candidates,
+        namespace=constants.MEMCACHE_NAMESPACE_METRO_CANDIDATES)
+    failed_keys += memcache.set_multi(
+        geo_indexes, namespace=constants.MEMCACHE_NAMESPACE_GEO_INDEXES)
+    increment_generation()
+    if failed_keys:
+        logging.error('Failed to publish candidates in memcache: %s.',
+                      failed_keys)
+        return False
+    return True
+
+
+def publish_metros(site_metros):
+    """Publishes the metro index to memcache.
+
+    Args:
+        site_metros: An iterable of (site_id, metros) tuples, where 'metros'
+            is the list of metros of the site (e.g., ['ath', 'ath01']).
+
+    Returns:
+        A dict mapping each metro to a frozenset of site ids.
+    """
+    metros = {}
+    for site_id, site_metro in site_metros:
+        for metro in site_metro or []:
+            metros.setdefault(metro, set()).add(site_id)
+    for metro in metros:
+        metros[metro] = frozenset(metros[metro])
+
+    if not memcache.set(constants.MEMCACHE_KEY_METROS, metros,
+                        namespace=constants.MEMCACHE_NAMESPACE_METROS):
+        logging.error('Failed to publish the metro index in memcache.')
+    return metros
+
+
+def get_metros():
+    """Returns the metro index, rebuilding it from the datastore if needed.
+
+    Returns:
+        A dict mapping each metro to a frozenset of site ids.
+    """
+    metros = memcache.get(constants.MEMCACHE_KEY_METROS,
+                          namespace=constants.MEMCACHE_NAMESPACE_METROS)
+    if metros is not None:
+        return metros
+
+    logging.info('Metro index not found in memcache, rebuilding it.')
+    sites = model.Site.all().run(batch_size=constants.GQL_BATCH_SIZE)
+    return publish_metros((site.site_id, site.metro) for site in sites)
+
+
+def get_generation():
+    """Returns the current generation of the published sliver tools.
+
+    Returns:
+        An integer that changes every time sliver tools are published, or
+        None if the generation is not in memcache.
+    """
+    return memcache.get(constants.MEMCACHE_KEY_GENERATION,
+                        namespace=constants.MEMCACHE_NAMESPACE_GENERATION)
+
+
+def increment_generation():
+    """Invalidates the instance-local copies of the published sliver tools."""
+    if memcache.incr(constants.MEMCACHE_KEY_GENERATION, initial_value=0,
+                     namespace=constants.MEMCACHE_NAMESPACE_GENERATION) is None:
+        logging.error('Failed to increment the generation in memcache.')
+
+
+def get_candidates(tool_id, address_family):
+    """Returns the published online candidates of a tool.
+
+    Args:
+        tool_id: A string representing the tool id.
+        address_family: A string specifying the address family.
+
+    Returns:
+        A (possibly empty) list of online SliverTool entities, or None if
+        no candidates have been published for this tool.
+    """
+    return memcache.get(_get_key(tool_id, address_family),
+                        namespace=constants.MEMCACHE_NAMESPACE_CANDIDATES)
+
+
+def get_candidates_from_sites(tool_id, address_family, site_id_list):
+    """Returns the published online candidates of a tool in a set of sites.
+
+    Args:
+        tool_id: A string representing the tool id.
+        address_family: A string specifying the address family.
+        site_id_list: A list of site ids.
+
+    Returns:
+        A (possibly empty) list of online SliverTool entities, or None if
+        no candidates have been published for this tool.
+    """
+    site_candidates = memcache.get(
+        _get_key(tool_id, address_family),
+        namespace=constants.MEMCACHE_NAMESPACE_SITE_CANDIDATES)
+    if site_candidates is None:
+        return None
+
+    candidates = []
+    for site_id in site_id_list:
+        if site_id in site_candidates:
+            candidates.extend(site_candidates[site_id])
+    return candidates
+
+
+def get_metro_candidates(tool_id, address_family):
+    """Returns the published online candidates of a tool grouped by metro.
+
+    Args:
+        tool_id: A string representing the tool id.
+        address_family: A string specifying the address family.
+
+    Returns:
+        A dict mapping each known metro to a (possibly empty) list of online
+        SliverTool entities, or None if no candidates have been published for
+        this tool.
+    """
+    return memcache.get(
+        _get_key(tool_id, address_family),
+        namespace=constants.MEMCACHE_NAMESPACE_METRO_CANDIDATES)
+
+
+def get_geo_index(tool_id, address_family):
+    """Returns the published GeoIndex of the online candidates of a tool.
+
+    Args:
+        tool_id: A string representing the tool id.
+        address_family: A string specifying the address family.
+
+    Returns:
+        A spatial_index.GeoIndex, or None if no candidates have been
+        published for this tool.
+    """
+    return memcache.get(_get_key(tool_id, address_family),
+                        namespace=constants.MEMCACHE_NAMESPACE_GEO_INDEXES)
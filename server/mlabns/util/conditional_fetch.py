@@ -0,0 +1,144 @@
+from google.appengine.api import memcache
+
+from mlabns.util import constants
+
+import hashlib
+import logging
+import random
+import urllib2
+
+# The update handlers fetch their inputs (the ks site and IP lists, the
+# Nagios status pages) with fetch(). Once an input is processed, commit()
+# stores its validators (ETag, Last-Modified) and the hash of its content in
+# memcache, so that the next fetch sends a conditional request and reports
+# the input as unchanged when the server answers 304 Not Modified or sends
+# the same content again.
+#
+# The validators are only valid for the datastore state they were
+# processed against: a handler changing the sliver tools, and Tool.put,
+# call invalidate(), so that all the inputs are processed again at their
+# next fetch. They also expire after FETCH_VALIDATORS_MAX_AGE seconds, in
+# case the datastore was changed by other means.
+
+
+def _get_generation():
+    """Returns the token of the current validators.
+
+    The token is random, so that the validators are also invalidated when
+    the token is evicted from memcache.
+    """
+    generation = memcache.get(
+        constants.MEMCACHE_KEY_FETCH_GENERATION,
+        namespace=constants.MEMCACHE_NAMESPACE_FETCH_VALIDATORS)
+    if generation is None:
+        memcache.add(constants.MEMCACHE_KEY_FETCH_GENERATION,
+                     '%08x' % random.getrandbits(32),
+                     namespace=constants.MEMCACHE_NAMESPACE_FETCH_VALIDATORS)
+        generation = memcache.get(
+            constants.MEMCACHE_KEY_FETCH_GENERATION,
+            namespace=constants.MEMCACHE_NAMESPACE_FETCH_VALIDATORS)
+    return generation
+
+
+def _get_key(generation, url):
+    # URLs can be longer than the maximum memcache key size.
+    return '%s:%s' % (generation, hashlib.sha1(url).hexdigest())
+
+
+def invalidate():
+    """Forgets the validators of all the inputs.
+
+    Called after changing the sliver tools, since the unchanged inputs
+    would then give a different result.
+    """
+    if not memcache.set(
+        constants.MEMCACHE_KEY_FETCH_GENERATION,
+        '%08x' % random.getrandbits(32),
+        namespace=constants.MEMCACHE_NAMESPACE_FETCH_VALIDATORS):
+        logging.error('Failed to invalidate the fetch validators.')
+
+
+class FetchResult:
+    """The outcome of a conditional fetch.
+
+    'content' is the body of the response, or None if the input is
+    unchanged since it was last committed.
+    """
+
+    def __init__(self, url, content, validators):
+        self.url = url
+        self.content = content
+        self._validators = validators
+
+    @property
+    def changed(self):
+        return self.content is not None
+
+    def commit(self):
+        """Stores the validators, once the content has been processed."""
+        if not self.changed:
+            return
+        if not memcache.set(
+            _get_key(_get_generation(), self.url), self._validators,
+            time=constants.FETCH_VALIDATORS_MAX_AGE,
+            namespace=constants.MEMCACHE_NAMESPACE_FETCH_VALIDATORS):
+            logging.error('Failed to store the validators of %s.', self.url)
+
+
+def fetch(url, opener=None, timeout=constants.FETCH_TIMEOUT,
+          conditional=True):
+    """Fetches an input of the update handlers, if it changed.
+
+    Args:
+        url: A string representing the URL of the input.
+        opener: A urllib2.OpenerDirector used to fetch 'url'. Defaults to
+            the installed opener.
+        timeout: The timeout of the fetch in seconds.
+        conditional: False to fetch and return the content even if it did
+            not change.
+
+    Returns:
+        A FetchResult. Its validators are not stored until its commit()
+        method is called.
+
+    Raises:
+        urllib2.URLError, socket.error: The fetch failed.
+    """
+    validators = None
+    if conditional:
+        validators = memcache.get(
+            _get_key(_get_generation(), url),
+            namespace=constants.MEMCACHE_NAMESPACE_FETCH_VALIDATORS)
+
+    request = urllib2.Request(url)
+    if validators is not None:
+        if validators['etag'] is not None:
+            request.add_header('If-None-Match', validators['etag'])
+        if validators['last_modified'] is not None:
+            request.add_header('If-Modified-Since',
+                               validators['last_modified'])
+
+    urlopen = urllib2.urlopen
+    if opener is not None:
+        urlopen = opener.open
+    try:
+        response = urlopen(request, timeout=timeout)
+    except urllib2.HTTPError as e:
+        if e.code == 304 and validators is not None:
+            logging.info('%s not modified.', url)
+            return FetchResult(url, None, validators)
+        raise
+
+    content = response.read()
+    headers = response.info()
+    new_validators = {
+        'etag': headers.getheader('ETag'),
+        'last_modified': headers.getheader('Last-Modified'),
+        'content_hash': hashlib.sha1(content).hexdigest()}
+    if (validators is not None and
+        validators['content_hash'] == new_validators['content_hash']):
+        # The stored validators are kept, so that they still expire
+        # FETCH_VALIDATORS_MAX_AGE seconds after the last processing.
+        logging.info('Content of %s unchanged.', url)
+        return FetchResult(url, None, validators)
+    return FetchResult(url, content, new_validators)
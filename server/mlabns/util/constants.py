@@ -13,8 +13,128 @@ GEOLOCATION_USER_DEFINED = 'user_defined'
 # Maximum number of entities fetched from datastore in a single query.
 MAX_FETCHED_RESULTS = 500
 
-# Memcache namespace for map: tool_id -> list of sliver_tools.
-MEMCACHE_NAMESPACE_TOOLS = 'memcache_tools'
+# Compiled Maxmind range tables (see maxmind.RangeTable), relative to the
+# mlabns directory. When a file is missing, the lookups fall back to the
+# datastore.
+MAXMIND_IPV4_RANGE_TABLE = 'data/maxmind_ipv4.bin'
+MAXMIND_IPV6_RANGE_TABLE = 'data/maxmind_ipv6.bin'
+
+# Memcache namespace for map: IP prefix or city -> geolocation fields.
+MEMCACHE_NAMESPACE_GEOLOCATION = 'memcache_geolocation'
+
+# Maximum number of IP prefixes whose geolocation is cached by an instance,
+# and number of seconds the geolocation of a prefix is cached.
+GEOLOCATION_CACHE_SIZE = 10000
+GEOLOCATION_CACHE_TTL = 3600
+
+# Maximum number of cities whose geolocation is cached by an instance, and
+# number of seconds their geolocation is cached.
+LOCATION_CACHE_SIZE = 10000
+LOCATION_CACHE_TTL = 86400
+
+# Number of seconds between two checks of the version of the country and
+# city tables (see maxmind.TableVersion).
+LOCATION_TABLE_CHECK_INTERVAL = 600
+
+# Number of seconds an instance caches the Tool entities.
+TOOL_CACHE_TTL = 600
+
+# Memcache namespaces of the sliver tools published by the update handlers
+# (see sliver_store): manifests (key=tool_id) and immutable per-sliver tool
+# records. An update is retried SLIVER_STORE_RETRIES times when the manifest
+# is concurrently updated.
+MEMCACHE_NAMESPACE_SLIVER_MANIFESTS = 'memcache_sliver_manifests'
+MEMCACHE_NAMESPACE_SLIVER_RECORDS = 'memcache_sliver_records'
+SLIVER_STORE_RETRIES = 3
+
+# Memcache namespace for map: (tool_id, address_family) -> list of online
+# sliver_tools.
+MEMCACHE_NAMESPACE_CANDIDATES = 'memcache_candidates'
+
+# Memcache namespace for map: (tool_id, address_family) -> dict of online
+# sliver_tools (key=site_id, value=list of sliver_tools).
+MEMCACHE_NAMESPACE_SITE_CANDIDATES = 'memcache_site_candidates'
+
+# Memcache namespace for map: (tool_id, address_family) -> dict of online
+# sliver_tools (key=metro, value=list of sliver_tools).
+MEMCACHE_NAMESPACE_METRO_CANDIDATES = 'memcache_metro_candidates'
+
+# Memcache namespace for map: (tool_id, address_family) -> GeoIndex of the
+# online sliver_tools (see spatial_index.GeoIndex).
+MEMCACHE_NAMESPACE_GEO_INDEXES = 'memcache_geo_indexes'
+
+# Memcache namespace and key of the metro index, a dict of site ids
+# (key=metro, value=frozenset of site_ids).
+MEMCACHE_NAMESPACE_METROS = 'memcache_metros'
+MEMCACHE_KEY_METROS = 'metros'
+
+# Memcache namespace and key of the counter incremented every time the update
+# handlers publish new sliver tools to memcache.
+MEMCACHE_NAMESPACE_GENERATION = 'memcache_generation'
+MEMCACHE_KEY_GENERATION = 'generation'
+
+# Memcache namespace of the validators (ETag, Last-Modified, content hash) of
+# the inputs of the update handlers (see conditional_fetch), and key of the
+# token invalidating them. Validators expire after FETCH_VALIDATORS_MAX_AGE
+# seconds, so that every input is processed again at least that often.
+MEMCACHE_NAMESPACE_FETCH_VALIDATORS = 'memcache_fetch_validators'
+MEMCACHE_KEY_FETCH_GENERATION = 'generation'
+FETCH_VALIDATORS_MAX_AGE = 2 * 24 * 3600
+
+# Seconds an instance serves sliver tools from its local cache before checking
+# the generation counter in memcache.
+LOCAL_CACHE_TTL = 30
+
+# Maximum number of lookup keys whose responses are cached by an instance, and
+# number of responses sampled per key. Lookups are answered with one of the
+# sampled responses so that clients are still spread over the servers of a
+# site.
+RESPONSE_CACHE_SIZE = 2000
+RESPONSE_CACHE_VARIANTS = 8
+
+# Size, in degrees of latitude and longitude, of the geo cells sharing the same
+# cached responses.
+RESPONSE_CACHE_GEO_CELL = 0.25
+
+# Seconds a client may reuse a lookup response (Cache-Control max-age).
+RESPONSE_MAX_AGE = 60
+
+# Prefix of the memcache keys of the compiled (bytecode) Jinja templates.
+MEMCACHE_PREFIX_TEMPLATES = 'jinja2/bytecode/'
+
+# Lookup records are queued in the LOOKUP_LOG_QUEUE pull queue (see
+# queue.yaml). The flush cron job leases its tasks LOOKUP_LOG_LEASE_SIZE at a
+# time, for LOOKUP_LOG_LEASE_SECONDS seconds, for at most
+# LOOKUP_LOG_FLUSH_DEADLINE seconds, and writes their records in batches of
+# about LOOKUP_LOG_BATCH_BYTES bytes of CSV. The byte limit keeps batches of
+# records with long User-Agents within a single app log message.
+LOOKUP_LOG_QUEUE = 'lookup-log'
+LOOKUP_LOG_LEASE_SIZE = 1000
+LOOKUP_LOG_LEASE_SECONDS = 60
+LOOKUP_LOG_FLUSH_DEADLINE = 50
+LOOKUP_LOG_BATCH_BYTES = 16000
+
+# Logging policy of the lookup path (see log_policy.LogPolicy): fraction of
+# the messages emitted, maximum number of occurrences of a message emitted
+# per second, and whether messages below WARNING are dropped.
+LOG_SAMPLE_RATE = 0.1
+LOG_MAX_PER_SECOND = 5
+LOG_QUIET = False
+
+# Histograms of the lookup stage durations (see stage_timer.StageTimings):
+# bucket bounds in seconds, growth factor between consecutive buckets, and
+# interval in seconds after which the histograms are logged and renewed.
+HISTOGRAM_MIN_SECONDS = 0.00001
+HISTOGRAM_MAX_SECONDS = 30
+HISTOGRAM_GROWTH_FACTOR = 1.2
+STAGE_TIMINGS_FLUSH_INTERVAL = 300
+
+# Maximum number of Nagios status pages fetched at the same time.
+NAGIOS_MAX_CONCURRENT_FETCHES = 8
+
+# Timeout in seconds of the fetches of the update handler inputs (ks lists
+# and Nagios status pages).
+FETCH_TIMEOUT = 30
 
 # Service state status values from Nagios:
 # OK            0
@@ -26,6 +146,13 @@ NAGIOS_SERVICE_STATUS_OK = '0'
 # Maximum number of entities fetched from datastore in a single query.
 GQL_BATCH_SIZE = 1000
 
+# Maximum number of entities written to datastore in a single db.put, number
+# of times a failed db.put is retried, and delay in seconds before the first
+# retry (doubled after each retry).
+PUT_BATCH_SIZE = 200
+PUT_RETRIES = 2
+PUT_RETRY_DELAY = 0.5
+
 # Name of the encryption key used by the RegistrationClient.
 REGISTRATION_KEY_ID = 'admin'
 
@@ -2,6 +2,11 @@ import math
 
 from mlabns.util import constants
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 def distance(lat1, lon1, lat2, lon2):
     """Computes the distance between two points.
 
@@ -26,3 +31,72 @@ def distance(lat1, lon1, lat2, lon2):
     d = constants.EARTH_RADIUS * c
 
     return d
+
+
+class SiteCoordinates:
+    """Site coordinates with the per-site trigonometric terms precomputed.
+
+    When NumPy is available, the terms are stored as arrays so that
+    distances() evaluates all the sites in a single vectorized pass.
+    """
+
+    def __init__(self, latitudes, longitudes):
+        """Precomputes radians and cosines for a list of sites.
+
+        Args:
+            latitudes: A list of floats representing the sites' latitudes.
+            longitudes: A list of floats representing the sites' longitudes.
+        """
+        self.latitudes = [math.radians(latitude) for latitude in latitudes]
+        self.longitudes = [math.radians(longitude) for longitude in longitudes]
+        self.cos_latitudes = [math.cos(latitude) for latitude in
+                              self.latitudes]
+        if numpy is not None:
+            self.latitudes = numpy.array(self.latitudes)
+            self.longitudes = numpy.array(self.longitudes)
+            self.cos_latitudes = numpy.array(self.cos_latitudes)
+
+    def __len__(self):
+        return len(self.latitudes)
+
+
+def distances(latitude, longitude, site_coordinates):
+    """Computes the distance from a point to every site in a batch.
+
+    Args:
+        latitude: A float representing the latitude of the origin point.
+        longitude: A float representing the longitude of the origin point.
+        site_coordinates: A SiteCoordinates instance.
+
+    Returns:
+        A sequence of floats (a NumPy array if NumPy is available)
+        representing the distances in km from the origin to each site, in
+        the same order as the sites in 'site_coordinates'.
+    """
+    lat1 = math.radians(latitude)
+    lon1 = math.radians(longitude)
+    cos_lat1 = math.cos(lat1)
+    if numpy is not None:
+        return _numpy_distances(lat1, lon1, cos_lat1, site_coordinates)
+
+    results = []
+    for lat2, lon2, cos_lat2 in zip(site_coordinates.latitudes,
+                                    site_coordinates.longitudes,
+                                    site_coordinates.cos_latitudes):
+        dlat = lat2 - lat1
+        dlon = lon2 - lon1
+        a = math.sin(dlat/2) * math.sin(dlat/2) + cos_lat1 * cos_lat2 \
+            * math.sin(dlon/2) * math.sin(dlon/2)
+        c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
+        results.append(constants.EARTH_RADIUS * c)
+    return results
+
+def _numpy_distances(lat1, lon1, cos_lat1, site_coordinates):
+    dlat = site_coordinates.latitudes - lat1
+    dlon = site_coordinates.longitudes - lon1
+    sin_dlat = numpy.sin(dlat/2)
+    sin_dlon = numpy.sin(dlon/2)
+    a = sin_dlat * sin_dlat + cos_lat1 * site_coordinates.cos_latitudes \
+        * sin_dlon * sin_dlon
+    c = 2 * numpy.arctan2(numpy.sqrt(a), numpy.sqrt(1-a))
+    return constants.EARTH_RADIUS * c
@@ -0,0 +1,106 @@
+from mlabns.util import message
+
+import json
+
+# Address families for which a JSON fragment is rendered. None stands for a
+# lookup without a user-defined address family (dual-stack).
+ADDRESS_FAMILIES = [None, message.ADDRESS_FAMILY_IPv4,
+                    message.ADDRESS_FAMILY_IPv6]
+
+
+def annotate_fqdn(fqdn, address_family):
+    """Adds the v4/v6 only annotation to the fqdn.
+
+    Example:
+        fqdn:       'npad.iupui.mlab3.ath01.measurement-lab.org'
+        ipv4 only:  'npad.iupui.mlab3v4.ath01.measurement-lab.org'
+        ipv6 only:  'npad.iupui.mlab3v6.ath01.measurement-lab.org'
+
+    Args:
+        fqdn: A string representing the fqdn.
+        address_family: A string specifying the user-defined address family,
+            or None.
+
+    Returns:
+        A string representing the IPV4/IPV6 only annotated fqdn.
+    """
+    fqdn_annotation = ''
+
+    if address_family == message.ADDRESS_FAMILY_IPv4:
+        fqdn_annotation = 'v4'
+    elif address_family == message.ADDRESS_FAMILY_IPv6:
+        fqdn_annotation = 'v6'
+
+    fqdn_parts = fqdn.split('.')
+    fqdn_parts[2] += fqdn_annotation
+
+    return '.'.join(fqdn_parts)
+
+
+def get_json_data(sliver_tool, address_family, show_tool_extra):
+    """Returns the JSON representation of a sliver tool in a lookup response.
+
+    Args:
+        sliver_tool: A SliverTool entity or snapshot.
+        address_family: A string specifying the user-defined address family,
+            or None.
+        show_tool_extra: Whether to include the tool_extra field.
+
+    Returns:
+        A dict that can be serialized with json.dumps.
+    """
+    data = {}
+
+    ip = []
+
+    if address_family == message.ADDRESS_FAMILY_IPv4:
+        ip = [sliver_tool.sliver_ipv4]
+    elif address_family == message.ADDRESS_FAMILY_IPv6:
+        ip = [sliver_tool.sliver_ipv6]
+    else:
+        # If 'address_family' is not specified, the default is to
+        # return both valid IP addresses (if both 'status_ipv4' and
+        # 'status_ipv6' are 'online').
+        # Although the update will only set the sliver as online if it
+        # has a valid IP address, the resolver still returns it as
+        # a candidate.
+        if (sliver_tool.sliver_ipv4 != message.NO_IP_ADDRESS and
+            sliver_tool.status_ipv4 == message.STATUS_ONLINE):
+            ip.append(sliver_tool.sliver_ipv4)
+        if (sliver_tool.sliver_ipv6 != message.NO_IP_ADDRESS and
+            sliver_tool.status_ipv6 == message.STATUS_ONLINE):
+            ip.append(sliver_tool.sliver_ipv6)
+
+    fqdn = annotate_fqdn(sliver_tool.fqdn, address_family)
+    if sliver_tool.http_port:
+        data['url'] = ''.join([ 'http://', fqdn, ':', sliver_tool.http_port])
+    if sliver_tool.server_port:
+        data['port'] = sliver_tool.server_port
+
+    data['fqdn'] = fqdn
+    data['ip'] = ip
+    data['site'] = sliver_tool.site_id
+    data['city'] = sliver_tool.city
+    data['country'] = sliver_tool.country
+
+    if sliver_tool.tool_extra and show_tool_extra:
+        data['tool_extra'] = sliver_tool.tool_extra
+    return data
+
+
+def get_json_fragments(sliver_tool, show_tool_extra):
+    """Renders the JSON representations of a sliver tool.
+
+    Args:
+        sliver_tool: A SliverTool entity.
+        show_tool_extra: Whether to include the tool_extra field.
+
+    Returns:
+        A dict mapping each of ADDRESS_FAMILIES to the serialized JSON object
+        returned for that address family.
+    """
+    fragments = {}
+    for address_family in ADDRESS_FAMILIES:
+        fragments[address_family] = json.dumps(
+            get_json_data(sliver_tool, address_family, show_tool_extra))
+    return fragments
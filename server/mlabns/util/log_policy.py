@@ -0,0 +1,95 @@
+from mlabns.util import constants
+
+import logging
+import random
+import time
+
+
+class _MessageCounter:
+    def __init__(self):
+        # Number of times the message was logged, emitted or not.
+        self.total = 0
+        # Number of times the message was not emitted since it last was.
+        self.suppressed = 0
+        # Second of the current rate limiting window, and number of messages
+        # emitted in it.
+        self.window = None
+        self.window_count = 0
+
+
+class LogPolicy:
+    """Limits the log messages of the lookup path.
+
+    Each message (identified by its format string) is counted, then emitted
+    with probability 'sample_rate' (or its own rate in 'sample_rates'), and
+    at most 'max_per_second' times per second. In quiet mode, messages below
+    WARNING are not emitted at all. Errors are always emitted.
+
+    When a message is emitted, the number of occurrences that were not is
+    appended to it, so the logs keep the aggregate counts.
+    """
+
+    def __init__(self, sample_rate=constants.LOG_SAMPLE_RATE,
+                 max_per_second=constants.LOG_MAX_PER_SECOND,
+                 quiet=constants.LOG_QUIET, sample_rates=None):
+        self.sample_rate = sample_rate
+        self.max_per_second = max_per_second
+        self.quiet = quiet
+        self.sample_rates = dict(sample_rates or {})
+        self._counters = {}
+
+    def log(self, level, msg, *args):
+        counter = self._counters.get(msg)
+        if counter is None:
+            counter = _MessageCounter()
+            self._counters[msg] = counter
+        counter.total += 1
+
+        if not self._should_emit(level, msg, counter):
+            counter.suppressed += 1
+            return
+
+        if counter.suppressed:
+            logging.log(level, msg + ' (%d similar messages not logged)',
+                        *(args + (counter.suppressed,)))
+            counter.suppressed = 0
+        else:
+            logging.log(level, msg, *args)
+
+    def _should_emit(self, level, msg, counter):
+        if level >= logging.ERROR:
+            return True
+        if self.quiet and level < logging.WARNING:
+            return False
+        if random.random() >= self.sample_rates.get(msg, self.sample_rate):
+            return False
+
+        window = int(time.time())
+        if counter.window != window:
+            counter.window = window
+            counter.window_count = 0
+        if counter.window_count >= self.max_per_second:
+            return False
+        counter.window_count += 1
+        return True
+
+    def get_counts(self):
+        """Returns a dict mapping each message to its number of occurrences."""
+        return dict((msg, counter.total)
+                    for msg, counter in self._counters.iteritems())
+
+    def reset(self):
+        self._counters.clear()
+
+
+lookup_policy = LogPolicy()
+
+
+def info(msg, *args):
+    """Logs an INFO message of the lookup path through lookup_policy."""
+    lookup_policy.log(logging.INFO, msg, *args)
+
+
+def warning(msg, *args):
+    """Logs a WARNING message of the lookup path through lookup_policy."""
+    lookup_policy.log(logging.WARNING, msg, *args)
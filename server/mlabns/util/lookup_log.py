@@ -0,0 +1,150 @@
+from google.appengine.api import taskqueue
+
+from mlabns.util import constants
+from mlabns.util import message
+
+import StringIO
+import collections
+import csv
+import logging
+import time
+
+# Prefix of the app log messages holding lookup records, one CSV line per
+# record (see write_records).
+LOG_TAG = '[lookup_records]\n'
+
+
+class LookupRecord(collections.namedtuple('LookupRecord', [
+    'tool_id', 'policy', 'user_ip', 'is_ipv6', 'user_city', 'user_country',
+    'user_latitude', 'user_longitude', 'slice_id', 'server_id', 'server_ip',
+    'server_fqdn', 'site_id', 'site_city', 'site_country', 'site_latitude',
+    'site_longitude', 'distance', 'log_time', 'latency', 'user_agent'])):
+    """A sliver tool returned by a lookup.
+
+    The fields follow the order of the BigQuery schema (see config.py), so
+    that the CSV lines written by write_records can be loaded as they are.
+    Missing values (None) are written as empty fields, which BigQuery loads
+    as NULL: the columns that can be missing are NULLABLE.
+    """
+    __slots__ = ()
+
+
+def _encode(value):
+    if value is None:
+        return ''
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def format_records(records):
+    """Formats lookup records as CSV.
+
+    Args:
+        records: A list of LookupRecord tuples.
+
+    Returns:
+        A string containing one CSV line per record.
+    """
+    output = StringIO.StringIO()
+    writer = csv.writer(output, lineterminator='\n')
+    for record in records:
+        writer.writerow([_encode(value) for value in record])
+    return output.getvalue()
+
+
+def write_records(csv_lines):
+    """Writes lookup records to the app logs, where log2bq collects them.
+
+    Args:
+        csv_lines: A string containing lookup records formatted as CSV (see
+            format_records).
+    """
+    logging.info('%s%s', LOG_TAG, csv_lines)
+
+
+def add_records(records):
+    """Queues the records of a lookup.
+
+    The records are formatted as CSV and stored as a single task of the
+    LOOKUP_LOG_QUEUE pull queue, where flush() collects them. The task is
+    added asynchronously: the lookup does not wait for it, and the runtime
+    completes the call when the request ends.
+
+    Args:
+        records: A list of LookupRecord tuples.
+    """
+    if not records:
+        return
+    taskqueue.Queue(constants.LOOKUP_LOG_QUEUE).add_async(
+        taskqueue.Task(payload=format_records(records), method='PULL'))
+
+
+def flush(max_tasks=constants.LOOKUP_LOG_LEASE_SIZE,
+          max_bytes=constants.LOOKUP_LOG_BATCH_BYTES,
+          deadline=constants.LOOKUP_LOG_FLUSH_DEADLINE):
+    """Writes the queued lookup records to the app logs, in batches.
+
+    Tasks are leased 'max_tasks' at a time, and their records written in
+    batches of about 'max_bytes' bytes, until the queue is empty or
+    'deadline' seconds have elapsed. Tasks are only deleted once their
+    records are written: records are written at least once.
+
+    Returns:
+        The number of tasks processed.
+    """
+    queue = taskqueue.Queue(constants.LOOKUP_LOG_QUEUE)
+    end_time = time.time() + deadline
+    processed = 0
+    while time.time() < end_time:
+        tasks = queue.lease_tasks(constants.LOOKUP_LOG_LEASE_SECONDS,
+                                  max_tasks)
+        if not tasks:
+            break
+
+        batch = []
+        batch_size = 0
+        for task in tasks:
+            if batch and batch_size + len(task.payload) > max_bytes:
+                write_records(''.join(batch))
+                batch = []
+                batch_size = 0
+            batch.append(task.payload)
+            batch_size += len(task.payload)
+        write_records(''.join(batch))
+
+        queue.delete_tasks(tasks)
+        processed += len(tasks)
+        if len(tasks) < max_tasks:
+            break
+    return processed
+
+
+def get_records(query, sliver_tools, user_agent, latency):
+    """Returns the LookupRecords of a lookup.
+
+    Args:
+        query: A LookupQuery instance.
+        sliver_tools: A list of SliverTool entities returned by the lookup.
+        user_agent: A string representing the User-Agent of the request.
+        latency: A float representing the lookup latency, in seconds.
+
+    Returns:
+        A list of LookupRecord tuples, one per sliver tool.
+    """
+    log_time = long(time.time())
+    is_ipv6 = query.ip_address is not None and ':' in query.ip_address
+    records = []
+    for sliver_tool in sliver_tools:
+        if query.tool_address_family == message.ADDRESS_FAMILY_IPv6:
+            server_ip = sliver_tool.sliver_ipv6
+        else:
+            server_ip = sliver_tool.sliver_ipv4
+        records.append(LookupRecord(
+            query.tool_id, query.policy, query.ip_address, is_ipv6,
+            query.city, query.country, query.latitude, query.longitude,
+            sliver_tool.slice_id, sliver_tool.server_id, server_ip,
+            sliver_tool.fqdn, sliver_tool.site_id, sliver_tool.city,
+            sliver_tool.country, sliver_tool.latitude, sliver_tool.longitude,
+            query.distance, log_time, latency, user_agent))
+    return records
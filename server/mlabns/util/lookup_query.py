@@ -1,8 +1,11 @@
 from mlabns.third_party import ipaddr
 from mlabns.util import constants
+from mlabns.util import log_policy
 from mlabns.util import message
 from mlabns.util import maxmind
+from mlabns.util import stage_timer
 
+import copy
 import logging
 
 def _is_valid_ip(ip):
@@ -39,11 +42,19 @@ class LookupQuery:
         self._geolocation_type = None
         self.ip_address = None
         self.tool_address_family = None
+        # Address family of the tool requested by the user (same as
+        # tool_address_family), or None.
+        self.user_defined_af = None
+        # Address family of the candidates to look for first: the
+        # user-defined one, or else the address family of the client.
+        self.address_family = None
         self.city = None
         self.country = None
         self.latitude = None
         self.longitude = None
         self.distance = None
+        # Durations of the lookup stages (see stage_timer.StageTimer).
+        self.timer = stage_timer.StageTimer()
         self._ip_is_explicit = False
         self._user_defined_city = None
         #TODO(mtlynch): We are using two country fields to store the same type
@@ -67,21 +78,23 @@ class LookupQuery:
         Args:
             request: An instance of google.appengine.webapp.Request.
         """
-        self.tool_id = request.path.strip('/').split('/')[0]
-        self._set_response_format(request)
-        self._set_ip_address(request)
-        self._set_tool_address_family(request)
-        self._set_geolocation(request)
-        self.metro = request.get(message.METRO, default_value=None)
-        self._set_policy(request)
+        with self.timer.time(stage_timer.STAGE_PARSE_QUERY):
+            self.tool_id = request.path.strip('/').split('/')[0]
+            self._set_response_format(request)
+            self._set_ip_address(request)
+            self._set_tool_address_family(request)
+            self._set_address_family()
+            self._set_geolocation(request)
+            self.metro = request.get(message.METRO, default_value=None)
+            self._set_policy(request)
 
     def _set_response_format(self, request):
         self.response_format = request.get(
             message.RESPONSE_FORMAT,
             default_value=message.DEFAULT_RESPONSE_FORMAT)
         if self.response_format not in message.VALID_FORMATS:
-            logging.warning('Non valid response format %s.',
-                            self.response_format)
+            log_policy.warning('Non valid response format %s.',
+                               self.response_format)
             self.response_format = message.DEFAULT_RESPONSE_FORMAT
 
     def _set_ip_address(self, request):
@@ -103,10 +116,22 @@ class LookupQuery:
         if tool_address_family in valid_address_families:
           self.tool_address_family = tool_address_family
 
+    def _set_address_family(self):
+        # Requires the IP address and the tool address family to be set.
+        self.user_defined_af = self.tool_address_family
+        if self.user_defined_af is not None:
+            self.address_family = self.user_defined_af
+        elif self.ip_address is not None and _is_valid_ipv6(self.ip_address):
+            self.address_family = message.ADDRESS_FAMILY_IPv6
+        else:
+            self.address_family = message.ADDRESS_FAMILY_IPv4
+
     def _set_geolocation(self, request):
         self._set_appengine_geolocation(request)
-        self._user_defined_city = request.get(message.CITY)
-        self.user_defined_country = request.get(message.COUNTRY)
+        self._user_defined_city = request.get(message.CITY,
+                                              default_value=None)
+        self.user_defined_country = request.get(message.COUNTRY,
+                                                default_value=None)
         input_latitude, input_longitude = self._get_user_defined_lat_lon(
             request)
 
@@ -187,12 +212,13 @@ class LookupQuery:
 
     def _set_maxmind_geolocation(self, ip_address, country, city):
         geo_record = maxmind.GeoRecord()
-        if ip_address is not None:
-            geo_record = maxmind.get_ip_geolocation(ip_address)
-        elif city is not None and country is not None:
-            geo_record = maxmind.get_city_geolocation(city, country)
-        elif country is not None:
-            geo_record = maxmind.get_country_geolocation(country)
+        with self.timer.time(stage_timer.STAGE_GEOLOCATION):
+            if ip_address is not None:
+                geo_record = maxmind.get_ip_geolocation(ip_address)
+            elif city is not None and country is not None:
+                geo_record = maxmind.get_city_geolocation(city, country)
+            elif country is not None:
+                geo_record = maxmind.get_country_geolocation(country)
         self._maxmind_city = geo_record.city
         self._maxmind_country = geo_record.country
         self._maxmind_latitude = geo_record.latitude
@@ -219,15 +245,38 @@ class LookupQuery:
             except ValueError:
                 logging.error('GAE provided bad lat/long %s.', lat_long)
 
+    def copy_for_tool(self, tool_id, policy):
+        """Returns a copy of the query for another tool and policy.
+
+        The copy shares the address and geolocation of this query, so that a
+        batch lookup only geolocates the client once.
+
+        Args:
+            tool_id: A string representing the tool id.
+            policy: A string representing the user-defined policy, or None.
+
+        Returns:
+            A LookupQuery instance.
+        """
+        query = copy.copy(self)
+        query.tool_id = tool_id
+        query.distance = None
+        query.timer = stage_timer.StageTimer()
+        query._resolve_policy(policy)
+        return query
+
     def _set_policy(self, request):
-        self.policy = request.get(message.POLICY, default_value=None)
+        self._resolve_policy(request.get(message.POLICY, default_value=None))
+
+    def _resolve_policy(self, policy):
+        self.policy = policy
         if ((self._user_defined_latitude and
              self._user_defined_longitude) or
                 self._ip_is_explicit):
             if self.policy != message.POLICY_GEO and \
                self.policy != message.POLICY_GEO_OPTIONS:
                 if self.policy:
-                     logging.warning(
+                     log_policy.warning(
                          'Lat/longs user-defined, but policy is %s.',
                          self.policy)
                 self.policy = message.POLICY_GEO
@@ -236,7 +285,7 @@ class LookupQuery:
             if self.policy != message.POLICY_COUNTRY and \
                 self.policy != message.POLICY_GEO:
                 if self.policy:
-                    logging.warning(
+                    log_policy.warning(
                         'Country user-defined, but policy is %s.',
                         self.policy)
                 self.policy = message.POLICY_GEO
@@ -244,23 +293,24 @@ class LookupQuery:
         if self.metro is not None:
             if self.policy != message.POLICY_METRO:
                 if self.policy:
-                    logging.warning(
+                    log_policy.warning(
                          'Metro defined, but policy is %s', self.policy)
                 self.policy = message.POLICY_METRO
             return
         if self.policy == message.POLICY_GEO:
             if self.latitude is None or self.longitude is None:
-                logging.warning('Policy geo, but no geo args defined.')
+                log_policy.warning('Policy geo, but no geo args defined.')
                 self.policy = message.POLICY_RANDOM
             return
         if self.policy == message.POLICY_COUNTRY:
             if self.user_defined_country is None:
-                logging.warning('Policy country, but arg country not defined.')
+                log_policy.warning(
+                    'Policy country, but arg country not defined.')
                 self.policy = self._get_default_policy()
             return
         if self.policy == message.POLICY_METRO:
             if self.metro is None:
-                logging.warning('Policy metro, but arg metro not defined.')
+                log_policy.warning('Policy metro, but arg metro not defined.')
                 self.policy = self._get_default_policy()
             return
         if self.policy  ==  message.POLICY_RANDOM:
@@ -270,7 +320,7 @@ class LookupQuery:
         if self.policy == message.POLICY_ALL:
             return
         if self.policy:
-            logging.warning('Non valid policy %s.', self.policy)
+            log_policy.warning('Non valid policy %s.', self.policy)
         self.policy = self._get_default_policy()
 
     def _get_default_policy(self):
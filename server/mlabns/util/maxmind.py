@@ -1,12 +1,26 @@
+from google.appengine.api import memcache
 from google.appengine.ext import db
 
 from mlabns.db import model
 from mlabns.third_party import ipaddr
 from mlabns.util import constants
+from mlabns.util import log_policy
+from mlabns.util import message
 
+import bisect
+import collections
 import logging
+import math
+import os
 import socket
 import string
+import struct
+import time
+
+try:
+    import mmap
+except ImportError:
+    mmap = None
 
 # For more details about the decimal representation of the IP addresses
 # used in the CVS files and the conversion algorithm see
@@ -20,9 +34,411 @@ class GeoRecord:
         self.longitude = longitude
 
 
+# Binary layout of a range table (all values little-endian):
+#   header:     magic, version, number of ranges, number of locations
+#   starts:     one uint64 per range, sorted
+#   ends:       one uint64 per range
+#   locations:  one uint32 per range, index of the range's location
+#   location records: latitude, longitude (NaN if unknown), offset and
+#               length of the city and of the country in the string table
+#   string table: UTF-8 strings referenced by the location records
+RANGE_TABLE_MAGIC = 'MLRT'
+RANGE_TABLE_VERSION = 1
+_HEADER = struct.Struct('<4sHII')
+_LOCATION = struct.Struct('<ddIHIH')
+
+
+class _PackedArray:
+    """Read-only sequence view over fixed-width integers in a buffer."""
+
+    def __init__(self, buf, offset, length, item_format):
+        self._buf = buf
+        self._offset = offset
+        self._length = length
+        self._item = struct.Struct('<' + item_format)
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, index):
+        if not 0 <= index < self._length:
+            raise IndexError(index)
+        return self._item.unpack_from(
+            self._buf, self._offset + index * self._item.size)[0]
+
+
+class RangeTable:
+    """Maps sorted, non-overlapping IP ranges to geolocation data.
+
+    The table is a compact buffer (see build_range_table) searched with
+    bisect, so a lookup needs no datastore access.
+    """
+
+    def __init__(self, buf):
+        """Wraps a range table buffer.
+
+        Args:
+            buf: A string (or any buffer) containing a range table.
+
+        Raises:
+            ValueError, if 'buf' is not a valid range table.
+        """
+        if len(buf) < _HEADER.size:
+            raise ValueError('Range table is truncated.')
+        magic, version, num_ranges, num_locations = _HEADER.unpack_from(buf)
+        if magic != RANGE_TABLE_MAGIC or version != RANGE_TABLE_VERSION:
+            raise ValueError('Not a version %d range table.' %
+                             RANGE_TABLE_VERSION)
+
+        offset = _HEADER.size
+        self._starts = _PackedArray(buf, offset, num_ranges, 'Q')
+        offset += 8 * num_ranges
+        self._ends = _PackedArray(buf, offset, num_ranges, 'Q')
+        offset += 8 * num_ranges
+        self._location_ids = _PackedArray(buf, offset, num_ranges, 'I')
+        offset += 4 * num_ranges
+        self._locations_offset = offset
+        self._strings_offset = offset + _LOCATION.size * num_locations
+        if len(buf) < self._strings_offset:
+            raise ValueError('Range table is truncated.')
+        self._num_locations = num_locations
+        self._buf = buf
+
+    def __len__(self):
+        return len(self._starts)
+
+    def _find(self, ip_num):
+        i = bisect.bisect_right(self._starts, ip_num) - 1
+        if i < 0 or self._ends[i] < ip_num:
+            return None
+        return i
+
+    def find(self, ip_num):
+        """Returns the start of the range containing 'ip_num'.
+
+        All the addresses of a range share its geolocation, so the start
+        identifies the result of lookup().
+
+        Args:
+            ip_num: An integer representing an IP address (or, for IPv6,
+                its /64 prefix).
+
+        Returns:
+            An integer, or None if no range contains 'ip_num'.
+        """
+        i = self._find(ip_num)
+        if i is None:
+            return None
+        return self._starts[i]
+
+    def lookup(self, ip_num):
+        """Returns the GeoRecord of the range containing 'ip_num'.
+
+        Args:
+            ip_num: An integer representing an IP address (or, for IPv6,
+                its /64 prefix).
+
+        Returns:
+            A GeoRecord, or None if no range contains 'ip_num'.
+        """
+        i = self._find(ip_num)
+        if i is None:
+            return None
+        return self._get_location(self._location_ids[i])
+
+    def _get_location(self, location_id):
+        latitude, longitude, city_offset, city_length, country_offset, \
+            country_length = _LOCATION.unpack_from(
+                self._buf, self._locations_offset +
+                location_id * _LOCATION.size)
+        return GeoRecord(
+            city=self._get_string(city_offset, city_length),
+            country=self._get_string(country_offset, country_length),
+            latitude=None if math.isnan(latitude) else latitude,
+            longitude=None if math.isnan(longitude) else longitude)
+
+    def _get_string(self, offset, length):
+        start = self._strings_offset + offset
+        return self._buf[start:start + length].decode('utf-8')
+
+
+def build_range_table(ranges):
+    """Builds a range table buffer.
+
+    Args:
+        ranges: An iterable of (start_ip_num, end_ip_num, GeoRecord) tuples.
+            The ranges must not overlap.
+
+    Returns:
+        A string containing the range table, to be read by RangeTable.
+    """
+    ranges = sorted(ranges, key=lambda item: item[0])
+    location_ids = {}
+    locations = []
+    strings = {}
+    string_table = []
+    string_table_size = [0]
+
+    def add_string(value):
+        value = (value or u'').encode('utf-8')
+        if value not in strings:
+            strings[value] = string_table_size[0]
+            string_table.append(value)
+            string_table_size[0] += len(value)
+        return strings[value], len(value)
+
+    range_location_ids = []
+    for unused_start, unused_end, geo_record in ranges:
+        key = (geo_record.city, geo_record.country, geo_record.latitude,
+               geo_record.longitude)
+        if key not in location_ids:
+            location_ids[key] = len(locations)
+            city_offset, city_length = add_string(geo_record.city)
+            country_offset, country_length = add_string(geo_record.country)
+            locations.append(_LOCATION.pack(
+                float('nan') if geo_record.latitude is None else
+                    geo_record.latitude,
+                float('nan') if geo_record.longitude is None else
+                    geo_record.longitude,
+                city_offset, city_length, country_offset, country_length))
+        range_location_ids.append(location_ids[key])
+
+    num_ranges = len(ranges)
+    return ''.join([
+        _HEADER.pack(RANGE_TABLE_MAGIC, RANGE_TABLE_VERSION, num_ranges,
+                     len(locations)),
+        struct.pack('<%dQ' % num_ranges, *[item[0] for item in ranges]),
+        struct.pack('<%dQ' % num_ranges, *[item[1] for item in ranges]),
+        struct.pack('<%dI' % num_ranges, *range_location_ids),
+        ''.join(locations),
+        ''.join(string_table)])
+
+
+# Range tables loaded by get_range_table, keyed by address family.
+_range_tables = {}
+
+
+def load_range_table(path):
+    """Loads a range table from a file.
+
+    The file is memory-mapped when the mmap module is available: nothing is
+    copied at load time, only the pages touched by the lookups are read, and
+    they are shared by all the processes mapping the same file. Otherwise,
+    the file is read in memory.
+
+    Args:
+        path: A string representing the path of the range table file, as
+            written by build_maxmind_tables.py.
+
+    Returns:
+        A RangeTable, or None if the file does not exist or is not valid.
+    """
+    try:
+        with open(path, 'rb') as range_table_file:
+            if mmap is None:
+                return RangeTable(range_table_file.read())
+            # The mapping stays valid after the file is closed.
+            return RangeTable(mmap.mmap(range_table_file.fileno(), 0,
+                                        access=mmap.ACCESS_READ))
+    except EnvironmentError:
+        logging.info('Range table %s not found.', path)
+    except ValueError as e:
+        logging.error('Range table %s is not valid: %s', path, e)
+    return None
+
+
+def get_range_table(address_family):
+    """Returns the range table of an address family, loading it if needed.
+
+    Args:
+        address_family: A string specifying the address family.
+
+    Returns:
+        A RangeTable, or None if no range table is available, in which case
+        the geolocation comes from the datastore.
+    """
+    if address_family not in _range_tables:
+        if address_family == message.ADDRESS_FAMILY_IPv4:
+            filename = constants.MAXMIND_IPV4_RANGE_TABLE
+        else:
+            filename = constants.MAXMIND_IPV6_RANGE_TABLE
+        _range_tables[address_family] = load_range_table(os.path.join(
+            os.path.dirname(__file__), '..', filename))
+    return _range_tables[address_family]
+
+
+class GeolocationCache:
+    """LRU cache of geolocation data, optionally backed by memcache.
+
+    Entries are keyed by Maxmind range or by address (see
+    get_ip_geolocation), so that all the clients in the same range share
+    the same entry. Memcache is only worth its round trip when the data
+    comes from the datastore: callers pass use_memcache=False when it comes
+    from a range table.
+    """
+
+    def __init__(self, max_size=constants.GEOLOCATION_CACHE_SIZE,
+                 ttl=constants.GEOLOCATION_CACHE_TTL):
+        self._max_size = max_size
+        self._ttl = ttl
+        self._entries = collections.OrderedDict()
+        self.local_hits = 0
+        self.memcache_hits = 0
+        self.misses = 0
+
+    def get(self, key, use_memcache=True):
+        """Returns the GeoRecord cached for 'key', or None if not cached."""
+        now = time.time()
+        entry = self._entries.pop(key, None)
+        if entry is not None and now < entry[1]:
+            # Re-insert the entry to mark it as the most recently used.
+            self._entries[key] = entry
+            self.local_hits += 1
+            return GeoRecord(*entry[0])
+
+        if use_memcache:
+            fields = memcache.get(
+                key, namespace=constants.MEMCACHE_NAMESPACE_GEOLOCATION)
+            if fields is not None:
+                self.memcache_hits += 1
+                self._add(key, fields, now)
+                return GeoRecord(*fields)
+
+        self.misses += 1
+        return None
+
+    def set(self, key, geo_record, use_memcache=True):
+        fields = (geo_record.city, geo_record.country, geo_record.latitude,
+                  geo_record.longitude)
+        self._add(key, fields, time.time())
+        if use_memcache and not memcache.set(
+            key, fields, time=self._ttl,
+            namespace=constants.MEMCACHE_NAMESPACE_GEOLOCATION):
+            logging.error('Failed to cache geolocation of %s in memcache.', key)
+
+    def get_counts(self):
+        """Returns the number of lookups by outcome since the instance
+        started."""
+        return {'local_hits': self.local_hits,
+                'memcache_hits': self.memcache_hits,
+                'misses': self.misses}
+
+    def _add(self, key, fields, now):
+        self._entries[key] = (fields, now + self._ttl)
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+
+    def flush(self):
+        self._entries.clear()
+
+
+class TableVersion:
+    """Tracks the version of a datastore table, i.e. the time of the latest
+    write to one of its entities (their 'when' property).
+
+    The version is read from the datastore at most every 'check_interval'
+    seconds.
+    """
+
+    def __init__(self, check_interval=constants.LOCATION_TABLE_CHECK_INTERVAL):
+        self._check_interval = check_interval
+        self._version = None
+        self._next_check = 0
+
+    def get(self, table):
+        """Returns the version of 'table', or None if it is not known."""
+        now = time.time()
+        if now >= self._next_check:
+            self._next_check = now + self._check_interval
+            try:
+                latest = table.all().order('-when').get()
+            except (db.Timeout, db.InternalError) as e:
+                # Keep the previous version until the next check.
+                logging.error('Failed to read the version of %s: %s',
+                              table.kind(), e)
+            else:
+                self._version = latest.when if latest is not None else None
+        return self._version
+
+    def flush(self):
+        self._version = None
+        self._next_check = 0
+
+
+class CountryTable:
+    """The geolocation of all the countries, preloaded from the datastore.
+
+    The table is loaded in the instance once, and reloaded only when the
+    version of the CountryCode table changes, so that country lookups cost
+    no datastore call.
+    """
+
+    def __init__(self, check_interval=constants.LOCATION_TABLE_CHECK_INTERVAL):
+        self._version = TableVersion(check_interval)
+        self._loaded_version = None
+        self._locations = None
+
+    def get(self, country, country_table):
+        """Returns the GeoRecord of a country.
+
+        Args:
+            country: A string describing a two alphanumeric country code.
+            country_table: The model of the country table.
+
+        Returns:
+            A GeoRecord, empty if the country is not in the table, or None
+            if the table could not be loaded.
+        """
+        version = self._version.get(country_table)
+        if self._locations is None or version != self._loaded_version:
+            self._load(country_table, version)
+        if self._locations is None:
+            return None
+
+        fields = self._locations.get(country)
+        if fields is None:
+            return GeoRecord()
+        return GeoRecord(*fields)
+
+    def _load(self, country_table, version):
+        log_policy.info('Loading the country table (version %s).', version)
+        locations = {}
+        try:
+            for location in country_table.all().run(
+                batch_size=constants.GQL_BATCH_SIZE):
+                locations[location.key().name()] = (
+                    constants.UNKNOWN_CITY, location.alpha2_code,
+                    location.latitude, location.longitude)
+        except (db.Timeout, db.InternalError) as e:
+            # Keep the previous table until the next check.
+            logging.error('Failed to load the country table: %s', e)
+            return
+        self._locations = locations
+        self._loaded_version = version
+
+    def flush(self):
+        self._version.flush()
+        self._loaded_version = None
+        self._locations = None
+
+
+geolocation_cache = GeolocationCache()
+country_locations = CountryTable()
+location_cache = GeolocationCache(max_size=constants.LOCATION_CACHE_SIZE,
+                                  ttl=constants.LOCATION_CACHE_TTL)
+city_table_version = TableVersion()
+
+
 def get_ip_geolocation(remote_addr):
     """Returns the geolocation data associated with an IP address.
 
+    Results are cached in geolocation_cache. When a range table is loaded,
+    they are keyed by the start of the matched range, which all the
+    addresses of the range share. Otherwise, they come from the datastore,
+    are keyed by address (by /64 for IPv6 addresses, which is the precision
+    of the MaxmindCityBlockv6 table) since Maxmind blocks can be smaller
+    than any fixed prefix, and are also shared through memcache.
+
     Args:
         remote_addr: A string describing an IPv4 or IPv6 address.
 
@@ -31,26 +447,54 @@ def get_ip_geolocation(remote_addr):
         otherwise an empty GeoRecord.
     """
     try:
-        return get_ipv4_geolocation(remote_addr)
+        ip_num = int(ipaddr.IPv4Address(remote_addr))
+        key_prefix = 'v4'
+        address_family = message.ADDRESS_FAMILY_IPv4
+        get_geolocation = get_ipv4_geolocation
     except ipaddr.AddressValueError:
-        pass
-
-    try:
-        return get_ipv6_geolocation(remote_addr)
-    except ipaddr.AddressValueError:
-        pass
+        try:
+            ip_num = int(ipaddr.IPv6Address(remote_addr)) >> 64
+            key_prefix = 'v6'
+            address_family = message.ADDRESS_FAMILY_IPv6
+            get_geolocation = get_ipv6_geolocation
+        except ipaddr.AddressValueError:
+            # Return an empty GeoRecord.
+            log_policy.warning('Returning empty record')
+            return GeoRecord()
+
+    range_table = get_range_table(address_family)
+    if range_table is None:
+        cache_key = '%s:%d' % (key_prefix, ip_num)
+    else:
+        range_start = range_table.find(ip_num)
+        if range_start is None:
+            return get_geolocation(remote_addr, range_table=range_table)
+        cache_key = '%s-range:%d' % (key_prefix, range_start)
+
+    use_memcache = range_table is None
+    geo_record = geolocation_cache.get(cache_key, use_memcache)
+    if geo_record is None:
+        geo_record = get_geolocation(remote_addr, range_table=range_table)
+        geolocation_cache.set(cache_key, geo_record, use_memcache)
+    return geo_record
 
-    # Return an empty GeoRecord.
-    logging.warning('Returning empty record')
-    return GeoRecord()
+def _lookup_range_table(range_table, ip_num):
+    geo_record = range_table.lookup(ip_num)
+    if geo_record is None:
+        logging.error('IP %s not found in the Maxmind database.', str(ip_num))
+        return GeoRecord()
+    return geo_record
 
 def get_ipv4_geolocation(remote_addr,
                          ipv4_table=model.MaxmindCityBlock,
-                         city_table=model.MaxmindCityLocation):
+                         city_table=model.MaxmindCityLocation,
+                         range_table=None):
     """Returns the geolocation data associated with an IPv4 address.
 
     Args:
         remote_addr: A string describing an IPv4 address.
+        range_table: A RangeTable to search instead of the datastore. By
+            default, the IPv4 range table is used if available.
 
     Returns:
         A GeoRecord containing the geolocation data if is found in the db,
@@ -62,6 +506,11 @@ def get_ipv4_geolocation(remote_addr,
     geo_record = GeoRecord()
     ip_num = int(ipaddr.IPv4Address(remote_addr))
 
+    if range_table is None:
+        range_table = get_range_table(message.ADDRESS_FAMILY_IPv4)
+    if range_table is not None:
+        return _lookup_range_table(range_table, ip_num)
+
     geo_city_block = ipv4_table.gql(
         'WHERE start_ip_num <= :ip_num '
         'ORDER BY start_ip_num DESC',
@@ -83,11 +532,14 @@ def get_ipv4_geolocation(remote_addr,
     return geo_record
 
 def get_ipv6_geolocation(remote_addr,
-                         ipv6_table=model.MaxmindCityBlockv6):
+                         ipv6_table=model.MaxmindCityBlockv6,
+                         range_table=None):
     """Returns the geolocation data associated with an IPv6 address.
 
     Args:
         remote_addr: A string describing an IPv6 address.
+        range_table: A RangeTable to search instead of the datastore. By
+            default, the IPv6 range table is used if available.
 
     Returns:
         A GeoRecord containing the geolocation data if found,
@@ -101,6 +553,11 @@ def get_ipv6_geolocation(remote_addr,
     # We currently keep only /64s in the MaxmindCityBlocksv6 db.
     ip_num = (ip_num >> 64)
 
+    if range_table is None:
+        range_table = get_range_table(message.ADDRESS_FAMILY_IPv6)
+    if range_table is not None:
+        return _lookup_range_table(range_table, ip_num)
+
     geo_city_block_v6 = ipv6_table.gql(
         'WHERE start_ip_num <= :ip_num '
         'ORDER BY start_ip_num DESC',
@@ -118,6 +575,9 @@ def get_ipv6_geolocation(remote_addr,
 def get_country_geolocation(country, country_table=model.CountryCode):
     """Returns the geolocation data associated with a country code.
 
+    The data comes from the country table preloaded in country_locations,
+    or from the datastore if the table could not be loaded.
+
     Args:
         country: A string describing a two alphanumeric country code.
 
@@ -125,9 +585,15 @@ def get_country_geolocation(country, country_table=model.CountryCode):
         A GeoRecord containing the geolocation data if found,
         otherwise an empty GeoRecord.
     """
+    geo_record = country_locations.get(country, country_table)
+    if geo_record is None:
+        geo_record = _get_country_geolocation(country, country_table)
+    return geo_record
+
+def _get_country_geolocation(country, country_table):
     geo_record = GeoRecord()
 
-    logging.info('Retrieving geolocation info for country %s.', country)
+    log_policy.info('Retrieving geolocation info for country %s.', country)
     location = country_table.get_by_key_name(country)
     if location is not None:
         geo_record.city = constants.UNKNOWN_CITY
@@ -139,6 +605,9 @@ def get_country_geolocation(country, country_table=model.CountryCode):
 def get_city_geolocation(city, country, city_table=model.MaxmindCityLocation):
     """Returns the geolocation data associated with a city and country code.
 
+    Results, including missing cities, are cached in location_cache until
+    the version of the city table changes.
+
     Args:
         city: A string specifying the name of the city.
         country: A string describing a two alphanumeric country code.
@@ -147,10 +616,19 @@ def get_city_geolocation(city, country, city_table=model.MaxmindCityLocation):
         A GeoRecord containing the geolocation data if found,
         otherwise an empty GeoRecord.
     """
+    cache_key = 'city:%s:%s:%s' % (city_table_version.get(city_table),
+                                   country, city)
+    geo_record = location_cache.get(cache_key)
+    if geo_record is None:
+        geo_record = _get_city_geolocation(city, country, city_table)
+        location_cache.set(cache_key, geo_record)
+    return geo_record
+
+def _get_city_geolocation(city, country, city_table):
     geo_record = GeoRecord()
 
-    logging.info('Retrieving geolocation info for country %s, city %s.',
-                 city, country)
+    log_policy.info('Retrieving geolocation info for country %s, city %s.',
+                    city, country)
     location = city_table.gql(
         'WHERE city = :city AND country = :country',
         city=city,country=country).get()
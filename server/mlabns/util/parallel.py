@@ -0,0 +1,57 @@
+import collections
+import logging
+import sys
+import threading
+
+
+def map_concurrently(function, items, max_workers):
+    """Calls a function on each item, from a bounded pool of threads.
+
+    Meant for blocking I/O (e.g., fetching URLs): the calls overlap while
+    they wait on the network.
+
+    Args:
+        function: A function taking a single argument.
+        items: An iterable of arguments for 'function'.
+        max_workers: An integer representing the maximum number of calls
+            running at the same time.
+
+    Returns:
+        A list of the results of 'function', in the order of 'items'.
+
+    Raises:
+        The first exception raised by 'function', once all the calls are
+        done. The other exceptions are logged.
+    """
+    items = list(items)
+    results = [None] * len(items)
+    errors = []
+    pending = collections.deque(enumerate(items))
+
+    def work():
+        while True:
+            try:
+                index, item = pending.popleft()
+            except IndexError:
+                return
+            try:
+                results[index] = function(item)
+            except Exception:
+                errors.append(sys.exc_info())
+
+    num_workers = min(max_workers, len(items))
+    if num_workers <= 1:
+        work()
+    else:
+        threads = [threading.Thread(target=work) for _ in range(num_workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    if errors:
+        for unused_type, error, unused_traceback in errors[1:]:
+            logging.error('Concurrent call failed: %s', error)
+        error_type, error, error_traceback = errors[0]
+        raise error_type, error, error_traceback
+    return results
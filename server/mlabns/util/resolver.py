@@ -1,15 +1,67 @@
 from google.appengine.api import memcache
 
 from mlabns.db import model
+from mlabns.util import candidate_cache
 from mlabns.util import constants
-from mlabns.util import distance
+from mlabns.util import log_policy
 from mlabns.util import message
-from mlabns.util import sliver_tool_distance
+from mlabns.util import sliver_store
+from mlabns.util import spatial_index
+from mlabns.util import stage_timer
 
 import logging
 import math
 import random
-from operator import attrgetter
+import time
+
+
+class LocalCache:
+    """Process-local cache in front of memcache.
+
+    Entries are served without any RPC for 'ttl' seconds. Once an entry
+    expires, it is kept if the generation published by the update handlers
+    has not changed since the entry was loaded, so a warm instance reloads
+    (and unpickles) sliver tools only after they were actually updated.
+    """
+
+    def __init__(self, ttl=constants.LOCAL_CACHE_TTL):
+        self._ttl = ttl
+        self._entries = {}
+
+    def get(self, key, load):
+        """Returns the value cached for 'key'.
+
+        Args:
+            key: A hashable key identifying the value.
+            load: A function returning the value from memcache (or None if
+                not available) when it is not cached locally.
+
+        Returns:
+            The cached value, or the result of 'load()'.
+        """
+        now = time.time()
+        entry = self._entries.get(key)
+        if entry is not None and now < entry[2]:
+            return entry[0]
+
+        generation = candidate_cache.get_generation()
+        if (entry is not None and generation is not None and
+            entry[1] == generation):
+            self._entries[key] = (entry[0], generation, now + self._ttl)
+            return entry[0]
+
+        value = load()
+        if value is None:
+            self._entries.pop(key, None)
+        else:
+            self._entries[key] = (value, generation, now + self._ttl)
+        return value
+
+    def flush(self):
+        self._entries.clear()
+
+
+local_cache = LocalCache()
 
 
 class ResolverBase:
@@ -25,6 +77,10 @@ class ResolverBase:
             A list of SliverTool entities that match the requirements
             specified in the 'query'.
         """
+        with query.timer.time(stage_timer.STAGE_GET_CANDIDATES):
+            return self._get_candidates_with_fallback(query)
+
+    def _get_candidates_with_fallback(self, query):
         candidates = []
         if query.address_family is not None:
             candidates = self._get_candidates(query, query.address_family)
@@ -42,13 +98,22 @@ class ResolverBase:
 
     def _get_candidates(self, query, address_family):
         """Returns a (possibly empty) list of available candidates."""
-        logging.info('Looking for %s in memcache.', query.tool_id)
-        # First try to get the sliver tools from the memcache.
-        sliver_tools = memcache.get(
-            query.tool_id, namespace=constants.MEMCACHE_NAMESPACE_TOOLS)
+        # First try the online candidates published by the update handlers.
+        candidates = local_cache.get(
+            ('candidates', query.tool_id, address_family),
+            lambda: candidate_cache.get_candidates(query.tool_id,
+                                                   address_family))
+        if candidates is not None:
+            return candidates
+
+        log_policy.info('Looking for %s in memcache.', query.tool_id)
+        # Then try to get the sliver tools from the memcache.
+        sliver_tools = local_cache.get(
+            ('sliver_tools', query.tool_id),
+            lambda: sliver_store.get_sliver_tools(query.tool_id))
         if sliver_tools is not None:
-            logging.info('Sliver tools found in memcache (%s results).',
-                         len(sliver_tools))
+            log_policy.info('Sliver tools found in memcache (%s results).',
+                            len(sliver_tools))
             candidates = []
             for sliver_tool in sliver_tools:
                 if (address_family == message.ADDRESS_FAMILY_IPv4 and
@@ -56,10 +121,10 @@ class ResolverBase:
                     (address_family == message.ADDRESS_FAMILY_IPv6 and
                     sliver_tool.status_ipv6 == message.STATUS_ONLINE):
                     candidates.append(sliver_tool)
-            logging.info('After filtering, %d candidates match criteria.',
-                         len(candidates))
+            log_policy.info('After filtering, %d candidates match criteria.',
+                            len(candidates))
             return candidates
-        logging.info(
+        log_policy.info(
             'Sliver tools not found in memcache, falling back to data store.')
 
         # Get the sliver tools from datastore.
@@ -69,30 +134,42 @@ class ResolverBase:
             'AND ' + status_field + ' = :status',
             tool_id=query.tool_id,
             status=message.STATUS_ONLINE)
-        logging.info('Found %s candidates in data store', candidates.count())
-        return candidates.fetch(constants.MAX_FETCHED_RESULTS)
+        candidates = candidates.fetch(constants.MAX_FETCHED_RESULTS)
+        log_policy.info('Found %d candidates in data store', len(candidates))
+        return candidates
 
     def _get_candidates_from_sites(self, query, address_family, site_id_list):
         """Returns a (possibly empty) list of available candidates."""
-        logging.info('Looking for %s in memcache', query.tool_id)
-        # First try to get the sliver tools from the cache.
-        sliver_tools = memcache.get(
-            query.tool_id, namespace=constants.MEMCACHE_NAMESPACE_TOOLS)
+        # First try the online candidates published by the update handlers.
+        candidates = local_cache.get(
+            ('site_candidates', query.tool_id, address_family,
+             tuple(site_id_list)),
+            lambda: candidate_cache.get_candidates_from_sites(
+                query.tool_id, address_family, site_id_list))
+        if candidates is not None:
+            return candidates
+
+        log_policy.info('Looking for %s in memcache', query.tool_id)
+        # Then try to get the sliver tools from the cache.
+        sliver_tools = local_cache.get(
+            ('sliver_tools', query.tool_id),
+            lambda: sliver_store.get_sliver_tools(query.tool_id))
         if sliver_tools is not None:
-            logging.info('Sliver tools found in memcache (%s results).',
-                         len(sliver_tools))
+            log_policy.info('Sliver tools found in memcache (%s results).',
+                            len(sliver_tools))
+            site_ids = set(site_id_list)
             candidates = []
             for sliver_tool in sliver_tools:
-                if sliver_tool.site_id in site_id_list and \
+                if sliver_tool.site_id in site_ids and \
                     ((address_family == message.ADDRESS_FAMILY_IPv4 and
                     sliver_tool.status_ipv4 == message.STATUS_ONLINE) or
                     (address_family == message.ADDRESS_FAMILY_IPv6 and
                     sliver_tool.status_ipv6 == message.STATUS_ONLINE)):
                     candidates.append(sliver_tool)
-            logging.info('After filtering, %d candidates match criteria.',
-                         len(candidates))
+            log_policy.info('After filtering, %d candidates match criteria.',
+                            len(candidates))
             return candidates
-        logging.info(
+        log_policy.info(
             'Sliver tools not found in memcache, falling back to data store.')
 
         # Get the sliver tools from datastore.
@@ -104,8 +181,9 @@ class ResolverBase:
             tool_id=query.tool_id,
             status=message.STATUS_ONLINE,
             site_id_list=site_id_list)
-        logging.info('Found %s candidates in data store', candidates.count())
-        return candidates.fetch(constants.MAX_FETCHED_RESULTS)
+        candidates = candidates.fetch(constants.MAX_FETCHED_RESULTS)
+        log_policy.info('Found %d candidates in data store', len(candidates))
+        return candidates
 
     def answer_query(self, query):
         """Selects a random sliver tool among the available candidates.
@@ -131,7 +209,44 @@ class AllResolver(ResolverBase):
             return None
         return candidates
 
-class GeoResolver(ResolverBase):
+class GeoResolverBase(ResolverBase):
+    """Base class of the geo resolvers.
+
+    The candidates are read from the GeoIndex published with them, which
+    the resolvers then use to find the closest sites. The index is loaded
+    once per generation of the published candidates (see LocalCache). It is
+    only built on the request path, as a one-shot scan, when the candidates
+    come from the sliver store or the datastore.
+    """
+
+    _geo_index = None
+
+    def _get_candidates(self, query, address_family):
+        geo_index = local_cache.get(
+            ('geo_index', query.tool_id, address_family),
+            lambda: candidate_cache.get_geo_index(query.tool_id,
+                                                  address_family))
+        if geo_index is not None:
+            self._geo_index = geo_index
+            return geo_index.candidates
+        return ResolverBase._get_candidates(self, query, address_family)
+
+    def _get_geo_index(self, candidates):
+        """Returns the GeoIndex of the candidates returned by get_candidates.
+
+        Args:
+            candidates: A list of SliverTool entities.
+
+        Returns:
+            A spatial_index.GeoIndex instance.
+        """
+        if (self._geo_index is not None and
+            self._geo_index.candidates is candidates):
+            return self._geo_index
+        return spatial_index.GeoIndex(candidates, one_shot=True)
+
+
+class GeoResolver(GeoResolverBase):
     """Chooses the server geographically closest to the client."""
 
     def answer_query(self, query):
@@ -150,35 +265,17 @@ class GeoResolver(ResolverBase):
             return None
 
         if (query.latitude is None) or (query.longitude is None):
-            logging.warning('No latide/longitude, return a random sliver tool.')
+            log_policy.warning(
+                'No latide/longitude, return a random sliver tool.')
             return [random.choice(candidates)]
 
-        min_distance = float('+inf')
+        geo_index = self._get_geo_index(candidates)
+        min_distance, site_ids = geo_index.site_index.nearest(query.latitude,
+                                                              query.longitude)
+
         closest_sliver_tools = []
-        distances = {}
-
-        # Compute for each SliverTool the distance and add keep in the
-        # 'closest_sliver_tools' list only the SliverTools whose distance is
-        # less or equal than the current minimum.
-        for sliver_tool in candidates:
-            # Check if we already computed the distance of this site.
-            if distances.has_key(sliver_tool.site_id):
-                current_distance = distances[sliver_tool.site_id]
-            else:
-                current_distance = distance.distance(
-                    query.latitude,
-                    query.longitude,
-                    sliver_tool.latitude,
-                    sliver_tool.longitude)
-
-                distances[sliver_tool.site_id] = current_distance
-
-            # Update the min distance and add the SliverTool to the list.
-            if current_distance < min_distance:
-                min_distance = current_distance
-                closest_sliver_tools = [sliver_tool]
-            elif current_distance == min_distance:
-                closest_sliver_tools.append(sliver_tool)
+        for site_id in site_ids:
+            closest_sliver_tools.extend(geo_index.site_candidates[site_id])
 
         # Add the min_distance to the query so it can be logged later. Round to
         # the next highest kilometre radius to remove precision.
@@ -188,7 +285,7 @@ class GeoResolver(ResolverBase):
         return [random.choice(closest_sliver_tools)]
 
 
-class GeoResolverWithOptions(ResolverBase):
+class GeoResolverWithOptions(GeoResolverBase):
     """Chooses the N geographically closest servers to the client."""
 
     def answer_query(self, query):
@@ -212,58 +309,43 @@ class GeoResolverWithOptions(ResolverBase):
             return None
 
         if (query.latitude is None) or (query.longitude is None):
-            logging.warning('No latide/longitude, return a random sliver tool.')
+            log_policy.warning(
+                'No latide/longitude, return a random sliver tool.')
             return [random.choice(candidates)]
 
-        min_distance = float('+inf')
-        sliver_tool_bins = {}
-        sliver_tools = []
-        distances = {}
-
-        # Combine the candidates into bins by site.
-        for sliver_tool in candidates:
-            if not sliver_tool_bins.has_key(sliver_tool.site_id):
-                sliver_tool_bins[sliver_tool.site_id] = [sliver_tool]
-            else:
-                sliver_tool_bins[sliver_tool.site_id].append(sliver_tool)
-
-        for site_id in sliver_tool_bins:
-            # Take a random sliver from the list.
-            sliver_tool = random.choice(sliver_tool_bins[site_id])
-            # Check if we already computed the distance of this site.
-            if distances.has_key(sliver_tool.site_id):
-                current_distance = distances[sliver_tool.site_id]
-            else:
-                current_distance = distance.distance(
-                    query.latitude,
-                    query.longitude,
-                    sliver_tool.latitude,
-                    sliver_tool.longitude)
-                distances[sliver_tool.site_id] = current_distance
-
-            sliver_tools.append(\
-                sliver_tool_distance.SliverToolDistance(sliver_tool, \
-                                                        current_distance))
-
-        sliver_tools_sorted = sorted(sliver_tools, key=attrgetter('distance'))
+        geo_index = self._get_geo_index(candidates)
+
+        # Take a random sliver from each of the closest sites.
         final_results = []
-        for std in sliver_tools_sorted:
-            final_results.append(std.sliver_tool)
-        return final_results[:MAX_RESULTS]
+        for unused_distance, site_id in geo_index.site_index.k_nearest(
+            query.latitude, query.longitude, MAX_RESULTS):
+            final_results.append(
+                random.choice(geo_index.site_candidates[site_id]))
+        return final_results
 
 
 class MetroResolver(ResolverBase):
     """Implements the metro policy."""
 
     def _get_candidates(self, query, address_family):
+        # First try the metro candidates published by the update handlers.
+        # Metros registered after the last publication are not in the table
+        # yet, and are looked up in the datastore below.
+        metro_candidates = local_cache.get(
+            ('metro_candidates', query.tool_id, address_family),
+            lambda: candidate_cache.get_metro_candidates(
+                query.tool_id, address_family))
+        if metro_candidates is not None and query.metro in metro_candidates:
+            return metro_candidates[query.metro]
+
         # TODO(claudiu) Test whether the following query is better.
         # sites = model.Site.gql("WHERE metro = :metro", metro=query.metro)
         sites = model.Site.all().filter("metro =", query.metro).fetch(
             constants.MAX_FETCHED_RESULTS)
-        logging.info(
+        log_policy.info(
             'Found %s results for metro %s.', len(sites), query.metro)
         if len(sites) == 0:
-            logging.info('No results found for metro %s.', query.metro)
+            log_policy.info('No results found for metro %s.', query.metro)
             return []
 
         site_id_list = []
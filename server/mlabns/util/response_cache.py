@@ -0,0 +1,148 @@
+from mlabns.util import candidate_cache
+from mlabns.util import constants
+from mlabns.util import message
+
+import collections
+import hashlib
+import math
+import random
+import time
+
+# Formats whose responses are cached. Html and map responses embed the
+# query, and redirects are cheap to build.
+CACHED_FORMATS = [message.FORMAT_JSON, message.FORMAT_BT]
+
+
+class CachedResponse(collections.namedtuple(
+    'CachedResponse',
+    ['body', 'etag', 'content_type', 'sliver_tools', 'distance'])):
+    """A serialized lookup response and the sliver tools it contains."""
+    __slots__ = ()
+
+
+def get_key(query):
+    """Returns the key of the cached responses of a lookup query.
+
+    Only queries whose answer depends on a few parameters are cached: for the
+    geo policies, these are the coordinates rounded to a geo cell, for the
+    metro and country policies the metro or the country. The key also holds
+    the address families of the query: 'address_family' selects the
+    candidates, and 'user_defined_af' the JSON fragments and the fqdn
+    annotation of the response.
+
+    Args:
+        query: A LookupQuery instance.
+
+    Returns:
+        A (tool_id, policy, address_family, user_defined_af, cell,
+        response_format) tuple, or None if the responses to this query are
+        not cached.
+    """
+    if query.response_format not in CACHED_FORMATS:
+        return None
+
+    if query.policy in (message.POLICY_GEO, message.POLICY_GEO_OPTIONS):
+        if query.latitude is None or query.longitude is None:
+            return None
+        cell = (int(math.floor(query.latitude /
+                               constants.RESPONSE_CACHE_GEO_CELL)),
+                int(math.floor(query.longitude /
+                               constants.RESPONSE_CACHE_GEO_CELL)))
+    elif query.policy == message.POLICY_METRO:
+        cell = query.metro
+    elif query.policy == message.POLICY_COUNTRY:
+        cell = query.user_defined_country
+    elif query.policy == message.POLICY_ALL:
+        cell = None
+    else:
+        return None
+    return (query.tool_id, query.policy, query.address_family,
+            query.user_defined_af, cell, query.response_format)
+
+
+def get_etag(body):
+    """Returns the (quoted) ETag of a response body.
+
+    Args:
+        body: A string, or a list of strings whose concatenation is the body.
+
+    Returns:
+        A string representing the ETag header.
+    """
+    if isinstance(body, basestring):
+        body = [body]
+    digest = hashlib.md5()
+    for fragment in body:
+        digest.update(fragment)
+    return '"%s"' % digest.hexdigest()
+
+
+class ResponseCache:
+    """LRU cache of lookup responses.
+
+    Resolvers pick a random server among equally good candidates, so each key
+    holds up to 'max_variants' responses sampled from actual lookups, and
+    hits are answered with one of them. All the entries are dropped when the
+    update handlers publish a new generation of sliver tools, which is
+    checked at most every 'ttl' seconds.
+    """
+
+    def __init__(self, max_size=constants.RESPONSE_CACHE_SIZE,
+                 max_variants=constants.RESPONSE_CACHE_VARIANTS,
+                 ttl=constants.LOCAL_CACHE_TTL):
+        self._max_size = max_size
+        self._max_variants = max_variants
+        self._ttl = ttl
+        self._entries = collections.OrderedDict()
+        self._generation = None
+        self._expiry = 0
+
+    def _check_generation(self):
+        now = time.time()
+        if now < self._expiry:
+            return
+        self._expiry = now + self._ttl
+        generation = candidate_cache.get_generation()
+        if generation != self._generation:
+            self._entries.clear()
+            self._generation = generation
+
+    def get_variants(self, key):
+        """Returns the (possibly empty) list of responses cached for 'key'."""
+        self._check_generation()
+        variants = self._entries.pop(key, None)
+        if variants is None:
+            return []
+        # Re-insert the entry to mark it as the most recently used.
+        self._entries[key] = variants
+        return variants
+
+    def get(self, key):
+        """Returns a random cached response for 'key'.
+
+        Returns:
+            A CachedResponse, or None until 'max_variants' responses have been
+            sampled for 'key'.
+        """
+        variants = self.get_variants(key)
+        if len(variants) < self._max_variants:
+            return None
+        return random.choice(variants)
+
+    def add(self, key, response):
+        """Samples a CachedResponse for 'key'."""
+        self._check_generation()
+        variants = self._entries.pop(key, [])
+        if len(variants) < self._max_variants:
+            variants.append(response)
+        self._entries[key] = variants
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+
+    def flush(self):
+        self._entries.clear()
+        self._generation = None
+        self._expiry = 0
+
+
+response_cache = ResponseCache()
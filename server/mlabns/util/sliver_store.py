@@ -0,0 +1,211 @@
+from google.appengine.api import memcache
+from google.appengine.ext import db
+
+from mlabns.db import model
+from mlabns.util import candidate_cache
+from mlabns.util import constants
+from mlabns.util import message
+
+import logging
+import random
+
+# The sliver tools of a tool are stored in memcache as one record per sliver
+# tool, plus a manifest listing the current record of each sliver tool:
+#
+#   manifest: {'version': 12, 'records': {fqdn: record_id, ...}}
+#   record:   SliverToolSnapshot (key='tool_id:fqdn:record_id')
+#
+# Records are never modified: an update writes new records for the sliver
+# tools that changed, then replaces the manifest with compare-and-set. Readers
+# fetch the manifest, then the records it lists, so they always see the
+# sliver tools of a single version. Superseded records are left to the
+# memcache eviction. Evicted records that an update does not replace are
+# rebuilt from the datastore, so that a manifest always lists all the sliver
+# tools of its tool.
+
+
+def _get_record_key(tool_id, fqdn, record_id):
+    return '%s:%s:%s' % (tool_id, fqdn, record_id)
+
+
+def _read_records(tool_id, manifest):
+    """Returns a dict of the records of a manifest (key=fqdn).
+
+    Records that are no longer in memcache are missing from the dict.
+    """
+    record_keys = dict(
+        (_get_record_key(tool_id, fqdn, record_id), fqdn)
+        for fqdn, record_id in manifest['records'].iteritems())
+    records = memcache.get_multi(
+        record_keys.keys(),
+        namespace=constants.MEMCACHE_NAMESPACE_SLIVER_RECORDS)
+    return dict((record_keys[key], record)
+                for key, record in records.iteritems())
+
+
+def _load_sliver_tools(tool_id, fqdns):
+    """Returns the SliverToolSnapshots of some sliver tools of a tool.
+
+    Args:
+        tool_id: A string representing the tool id.
+        fqdns: A set of the fqdns of the sliver tools.
+
+    Returns:
+        A list of SliverToolSnapshots, read from the datastore, or None if
+        the datastore cannot be read.
+    """
+    sliver_tools_gql = model.SliverTool.gql('WHERE tool_id=:tool_id',
+                                            tool_id=tool_id)
+    try:
+        sliver_tools = [
+            sliver_tool for sliver_tool in sliver_tools_gql.run(
+                batch_size=constants.GQL_BATCH_SIZE)
+            if sliver_tool.fqdn in fqdns]
+    except (db.Timeout, db.InternalError) as e:
+        logging.error('Failed to read the sliver tools of %s: %s', tool_id, e)
+        return None
+    return model.get_sliver_tool_snapshots(sliver_tools)
+
+
+def _sort_by_fqdn(records):
+    return [records[fqdn] for fqdn in sorted(records)]
+
+
+def get_sliver_tools(tool_id):
+    """Returns the published sliver tools of a tool.
+
+    Args:
+        tool_id: A string representing the tool id.
+
+    Returns:
+        A list of SliverToolSnapshots, sorted by fqdn, or None if the
+        sliver tools of the tool are not (all) in memcache.
+    """
+    manifest = memcache.get(
+        tool_id, namespace=constants.MEMCACHE_NAMESPACE_SLIVER_MANIFESTS)
+    if manifest is None:
+        return None
+    records = _read_records(tool_id, manifest)
+    if len(records) != len(manifest['records']):
+        logging.warning('%d records of %s are missing from memcache.',
+                        len(manifest['records']) - len(records), tool_id)
+        return None
+    return _sort_by_fqdn(records)
+
+
+def update(tool_id, sliver_tools, retries=constants.SLIVER_STORE_RETRIES):
+    """Publishes the sliver tools of a tool that changed.
+
+    Sliver tools equal to their published record are not written. Published
+    sliver tools missing from 'sliver_tools' are kept as they are, or read
+    from the datastore if their record was evicted from memcache.
+
+    Args:
+        tool_id: A string representing the tool id.
+        sliver_tools: A list of SliverToolSnapshots.
+        retries: An integer representing the number of times the update is
+            retried when another update of the same tool happens at the same
+            time.
+
+    Returns:
+        A list of all the published SliverToolSnapshots of the tool, sorted
+        by fqdn, if the update changed them. None if nothing changed or if
+        the update failed.
+    """
+    updated_fqdns = set(sliver_tool.fqdn for sliver_tool in sliver_tools)
+    client = memcache.Client()
+    for unused_attempt in range(retries + 1):
+        manifest = client.gets(
+            tool_id, namespace=constants.MEMCACHE_NAMESPACE_SLIVER_MANIFESTS)
+        records = {}
+        manifest_records = {}
+        version = 0
+        new_sliver_tools = sliver_tools
+        if manifest is not None:
+            records = _read_records(tool_id, manifest)
+            manifest_records = dict(
+                (fqdn, record_id)
+                for fqdn, record_id in manifest['records'].iteritems()
+                if fqdn in records)
+            version = manifest['version']
+
+            # Dropping the evicted records from the manifest would shrink
+            # the published sliver tools, so they are written again.
+            evicted_fqdns = (set(manifest['records']) - set(records) -
+                             updated_fqdns)
+            if evicted_fqdns:
+                logging.warning('Reading %d evicted records of %s from the '
+                                'datastore.', len(evicted_fqdns), tool_id)
+                stored_sliver_tools = _load_sliver_tools(tool_id,
+                                                         evicted_fqdns)
+                if stored_sliver_tools is None:
+                    # Readers keep falling back to the datastore.
+                    return None
+                new_sliver_tools = sliver_tools + stored_sliver_tools
+
+        changed_sliver_tools = [sliver_tool for sliver_tool in new_sliver_tools
+                                if records.get(sliver_tool.fqdn) != sliver_tool]
+        if (manifest is not None and not changed_sliver_tools and
+            len(manifest_records) == len(manifest['records'])):
+            return None
+
+        version += 1
+        record_id = '%d.%08x' % (version, random.getrandbits(32))
+        new_records = {}
+        for sliver_tool in changed_sliver_tools:
+            new_records[_get_record_key(tool_id, sliver_tool.fqdn,
+                                        record_id)] = sliver_tool
+            manifest_records[sliver_tool.fqdn] = record_id
+            records[sliver_tool.fqdn] = sliver_tool
+        if memcache.set_multi(
+            new_records,
+            namespace=constants.MEMCACHE_NAMESPACE_SLIVER_RECORDS):
+            logging.error('Failed to write the records of %s in memcache.',
+                          tool_id)
+            return None
+
+        new_manifest = {'version': version, 'records': manifest_records}
+        if manifest is None:
+            stored = client.add(
+                tool_id, new_manifest,
+                namespace=constants.MEMCACHE_NAMESPACE_SLIVER_MANIFESTS)
+        else:
+            stored = client.cas(
+                tool_id, new_manifest,
+                namespace=constants.MEMCACHE_NAMESPACE_SLIVER_MANIFESTS)
+        if stored:
+            logging.info('Published version %d of %s (%d changed records).',
+                         version, tool_id, len(changed_sliver_tools))
+            return _sort_by_fqdn(records)
+        logging.warning('Concurrent update of %s, retrying.', tool_id)
+
+    logging.error('Failed to update the manifest of %s in memcache.', tool_id)
+    return None
+
+
+def publish(tool_id, sliver_tools):
+    """Publishes the sliver tools of a tool and their candidate tables.
+
+    The candidate tables (see candidate_cache.publish_candidates) are only
+    rebuilt when the published sliver tools changed, or when the tables are
+    no longer in memcache.
+
+    Args:
+        tool_id: A string representing the tool id.
+        sliver_tools: A list of SliverToolSnapshots.
+    """
+    published_sliver_tools = update(tool_id, sliver_tools)
+    if (published_sliver_tools is None and candidate_cache.get_candidates(
+        tool_id, message.ADDRESS_FAMILY_IPv4) is None):
+        published_sliver_tools = get_sliver_tools(tool_id)
+    if published_sliver_tools is not None:
+        candidate_cache.publish_candidates(tool_id, published_sliver_tools)
+
+
+def is_published(tool_id):
+    """Returns True if the sliver tools of a tool and their candidate tables
+    are in memcache.
+    """
+    return (candidate_cache.get_candidates(
+        tool_id, message.ADDRESS_FAMILY_IPv4) is not None and
+            get_sliver_tools(tool_id) is not None)
@@ -1,4 +0,0 @@
-class SliverToolDistance:
-    def __init__(self, sliver_tool, distance):
-        self.distance = distance
-        self.sliver_tool = sliver_tool
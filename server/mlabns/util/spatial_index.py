@@ -0,0 +1,255 @@
+import bisect
+import heapq
+import math
+
+from mlabns.util import distance
+
+
+def _to_unit_vector(latitude, longitude):
+    """Maps a latitude/longitude pair to a point on the unit sphere."""
+    lat = math.radians(latitude)
+    lon = math.radians(longitude)
+    cos_lat = math.cos(lat)
+    return (cos_lat * math.cos(lon), cos_lat * math.sin(lon), math.sin(lat))
+
+
+def _squared_chord(point1, point2):
+    dx = point1[0] - point2[0]
+    dy = point1[1] - point2[1]
+    dz = point1[2] - point2[2]
+    return dx * dx + dy * dy + dz * dz
+
+
+class _Node:
+    def __init__(self, point, latitude, longitude, site_ids, axis):
+        self.point = point
+        self.latitude = latitude
+        self.longitude = longitude
+        self.site_ids = site_ids
+        self.axis = axis
+        self.left = None
+        self.right = None
+
+
+class SiteIndex:
+    """A k-d tree answering nearest-site queries.
+
+    Sites are stored as points on the unit sphere, where the straight-line
+    (chord) distance between two points grows monotonically with their
+    great-circle distance. Nearest neighbours by chord are therefore also
+    nearest neighbours by haversine distance, and the tree only needs plain
+    arithmetic to find them. Sites sharing the same coordinates are kept in
+    the same node so that ties are reported together.
+    """
+
+    def __init__(self, sites):
+        """Builds the index.
+
+        Args:
+            sites: An iterable of (site_id, latitude, longitude) tuples.
+        """
+        locations = {}
+        for site_id, latitude, longitude in sites:
+            locations.setdefault((latitude, longitude), []).append(site_id)
+
+        nodes = []
+        for (latitude, longitude), site_ids in locations.iteritems():
+            nodes.append(_Node(_to_unit_vector(latitude, longitude),
+                               latitude, longitude, site_ids, 0))
+        self._root = self._build(nodes, 0)
+
+    def _build(self, nodes, depth):
+        if not nodes:
+            return None
+        axis = depth % 3
+        nodes.sort(key=lambda node: node.point[axis])
+        median = len(nodes) // 2
+        node = nodes[median]
+        node.axis = axis
+        node.left = self._build(nodes[:median], depth + 1)
+        node.right = self._build(nodes[median + 1:], depth + 1)
+        return node
+
+    def nearest(self, latitude, longitude):
+        """Finds the sites closest to a location.
+
+        Args:
+            latitude: A float representing the latitude of the origin.
+            longitude: A float representing the longitude of the origin.
+
+        Returns:
+            A (distance, site_ids) tuple, where 'distance' is the distance
+            in km to the closest sites and 'site_ids' lists all the sites at
+            that distance. Returns (None, []) if the index is empty.
+        """
+        target = _to_unit_vector(latitude, longitude)
+        best = [float('+inf'), []]
+        self._search_nearest(self._root, target, best)
+        if not best[1]:
+            return None, []
+
+        site_ids = []
+        for node in best[1]:
+            site_ids.extend(node.site_ids)
+        closest = best[1][0]
+        return (distance.distance(latitude, longitude, closest.latitude,
+                                  closest.longitude), site_ids)
+
+    def _search_nearest(self, node, target, best):
+        if node is None:
+            return
+        squared_chord = _squared_chord(node.point, target)
+        if squared_chord < best[0]:
+            best[0] = squared_chord
+            best[1] = [node]
+        elif squared_chord == best[0]:
+            best[1].append(node)
+
+        delta = target[node.axis] - node.point[node.axis]
+        if delta < 0:
+            near, far = node.left, node.right
+        else:
+            near, far = node.right, node.left
+        self._search_nearest(near, target, best)
+        if delta * delta <= best[0]:
+            self._search_nearest(far, target, best)
+
+    def k_nearest(self, latitude, longitude, k):
+        """Finds the k sites closest to a location.
+
+        Args:
+            latitude: A float representing the latitude of the origin.
+            longitude: A float representing the longitude of the origin.
+            k: An integer representing the maximum number of sites returned.
+
+        Returns:
+            A list of at most k (distance, site_id) tuples, sorted by
+            increasing distance in km.
+        """
+        if k <= 0:
+            return []
+        target = _to_unit_vector(latitude, longitude)
+        best = []
+        self._search_k_nearest(self._root, target, k, best)
+
+        results = []
+        for unused_squared_chord, unused_id, node in best:
+            current_distance = distance.distance(
+                latitude, longitude, node.latitude, node.longitude)
+            for site_id in node.site_ids:
+                results.append((current_distance, site_id))
+        return results[:k]
+
+    def _search_k_nearest(self, node, target, k, best):
+        if node is None:
+            return
+        squared_chord = _squared_chord(node.point, target)
+        if len(best) < k or squared_chord < best[-1][0]:
+            # Entries only need ordering by distance; id(node) breaks ties
+            # without comparing nodes.
+            bisect.insort(best, (squared_chord, id(node), node))
+            del best[k:]
+
+        delta = target[node.axis] - node.point[node.axis]
+        if delta < 0:
+            near, far = node.left, node.right
+        else:
+            near, far = node.right, node.left
+        self._search_k_nearest(near, target, k, best)
+        if len(best) < k or delta * delta <= best[-1][0]:
+            self._search_k_nearest(far, target, k, best)
+
+
+class SiteScan:
+    """A scan answering nearest-site queries.
+
+    The distances to all the sites are computed in a single batch (see
+    distance.distances). A scan is cheaper to build than a SiteIndex, so it
+    is faster for sites that are only queried once, such as the candidates
+    of a single request. It has the same query methods as SiteIndex.
+    """
+
+    def __init__(self, sites):
+        """Builds the scan.
+
+        Args:
+            sites: An iterable of (site_id, latitude, longitude) tuples.
+        """
+        locations = {}
+        for site_id, latitude, longitude in sites:
+            locations.setdefault((latitude, longitude), []).append(site_id)
+
+        self._site_ids = []
+        latitudes = []
+        longitudes = []
+        for (latitude, longitude), site_ids in locations.iteritems():
+            self._site_ids.append(site_ids)
+            latitudes.append(latitude)
+            longitudes.append(longitude)
+        self._coordinates = distance.SiteCoordinates(latitudes, longitudes)
+
+    def nearest(self, latitude, longitude):
+        """Finds the sites closest to a location.
+
+        See SiteIndex.nearest.
+        """
+        if not self._site_ids:
+            return None, []
+        distances = distance.distances(latitude, longitude, self._coordinates)
+        min_distance = min(distances)
+        site_ids = []
+        for current_distance, location_site_ids in zip(distances,
+                                                       self._site_ids):
+            if current_distance == min_distance:
+                site_ids.extend(location_site_ids)
+        return float(min_distance), site_ids
+
+    def k_nearest(self, latitude, longitude, k):
+        """Finds the k sites closest to a location.
+
+        See SiteIndex.k_nearest.
+        """
+        if k <= 0 or not self._site_ids:
+            return []
+        distances = distance.distances(latitude, longitude, self._coordinates)
+        results = []
+        for current_distance, location_site_ids in heapq.nsmallest(
+            k, zip(distances, self._site_ids)):
+            for site_id in location_site_ids:
+                results.append((float(current_distance), site_id))
+        return results[:k]
+
+
+class GeoIndex:
+    """The online candidates of a tool, grouped by site and indexed by the
+    location of their sites.
+
+    Geo indexes are built when the candidates are published (see
+    candidate_cache.publish_candidates), so that the geo resolvers find the
+    closest candidates without going through all of them.
+    """
+
+    def __init__(self, candidates, one_shot=False):
+        """Builds the index.
+
+        Args:
+            candidates: A list of SliverTool entities.
+            one_shot: Whether the index is only queried once. The sites are
+                then scanned (see SiteScan) instead of being put in a k-d
+                tree, which costs more to build than the queries it saves.
+        """
+        self.candidates = candidates
+        self.site_candidates = {}
+        sites = set()
+        for candidate in candidates:
+            self.site_candidates.setdefault(candidate.site_id, []).append(
+                candidate)
+            # Sites without a location cannot be the closest to anything.
+            if candidate.latitude is not None and \
+                candidate.longitude is not None:
+                sites.add((candidate.site_id, candidate.latitude,
+                           candidate.longitude))
+        if one_shot:
+            self.site_index = SiteScan(sites)
+        else:
+            self.site_index = SiteIndex(sites)
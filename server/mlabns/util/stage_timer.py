@@ -0,0 +1,206 @@
+from mlabns.util import constants
+
+import bisect
+import contextlib
+import logging
+import time
+
+# Stages of a lookup. Stages nest: 'parse_query' includes 'geolocation', and
+# 'answer_query' includes 'get_candidates'.
+STAGE_PARSE_QUERY = 'parse_query'
+STAGE_GEOLOCATION = 'geolocation'
+STAGE_GET_CANDIDATES = 'get_candidates'
+STAGE_ANSWER_QUERY = 'answer_query'
+STAGE_RENDER = 'render'
+STAGE_CACHED_RESPONSE = 'cached_response'
+STAGE_TOTAL = 'total'
+
+PERCENTILES = [50, 95, 99]
+
+# Columns of the rows returned by StageTimings.get_summary().
+SUMMARY_HEADERS = (['stage', 'policy', 'count', 'mean_ms', 'max_ms'] +
+                   ['p%d_ms' % percent for percent in PERCENTILES])
+
+
+def _get_bucket_bounds():
+    # Upper bounds, in seconds, of buckets growing geometrically from
+    # HISTOGRAM_MIN_SECONDS to HISTOGRAM_MAX_SECONDS.
+    bounds = []
+    bound = constants.HISTOGRAM_MIN_SECONDS
+    while bound < constants.HISTOGRAM_MAX_SECONDS:
+        bounds.append(bound)
+        bound *= constants.HISTOGRAM_GROWTH_FACTOR
+    bounds.append(constants.HISTOGRAM_MAX_SECONDS)
+    return bounds
+
+_BUCKET_BOUNDS = _get_bucket_bounds()
+
+
+class Histogram:
+    """A fixed-size histogram of durations.
+
+    Durations are counted in buckets whose widths grow geometrically, so
+    that percentiles are estimated within HISTOGRAM_GROWTH_FACTOR of their
+    exact value whatever the number of samples.
+    """
+
+    def __init__(self):
+        # The last bucket counts the durations above HISTOGRAM_MAX_SECONDS.
+        self.buckets = [0] * (len(_BUCKET_BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.buckets[bisect.bisect_left(_BUCKET_BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def merge(self, other):
+        for i, bucket_count in enumerate(other.buckets):
+            self.buckets[i] += bucket_count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, percent):
+        """Estimates a percentile of the durations.
+
+        Args:
+            percent: A number between 0 and 100.
+
+        Returns:
+            The upper bound, in seconds, of the bucket containing the
+            percentile (capped by the largest duration), or None if the
+            histogram is empty.
+        """
+        if not self.count:
+            return None
+        rank = self.count * percent / 100.0
+        seen = 0
+        for i, bucket_count in enumerate(self.buckets):
+            seen += bucket_count
+            if bucket_count and seen >= rank:
+                if i < len(_BUCKET_BOUNDS):
+                    return min(_BUCKET_BOUNDS[i], self.max)
+                break
+        return self.max
+
+
+class StageTimer:
+    """Measures the stages of a single lookup.
+
+    The durations are accumulated until the policy of the lookup is known,
+    then recorded in the instance-wide StageTimings with finish().
+    """
+
+    def __init__(self):
+        self.durations = {}
+
+    @contextlib.contextmanager
+    def time(self, stage):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(stage, time.time() - start)
+
+    def add(self, stage, seconds):
+        self.durations[stage] = self.durations.get(stage, 0.0) + seconds
+
+    def finish(self, policy, stage_timings=None):
+        """Records the durations and resets the timer.
+
+        Args:
+            policy: A string representing the policy of the lookup.
+            stage_timings: The StageTimings receiving the durations. Defaults
+                to the module-level 'timings'.
+        """
+        if stage_timings is None:
+            stage_timings = timings
+        for stage, seconds in self.durations.iteritems():
+            stage_timings.record(stage, policy, seconds)
+        self.durations = {}
+
+
+class StageTimings:
+    """Per-stage and per-policy histograms of the lookup durations.
+
+    The histograms are kept in memory, so they only cover the lookups
+    served by this instance. Every 'flush_interval' seconds, the current
+    histograms are summarized in the logs and replace the previous ones,
+    so that get_summary() covers between one and two intervals.
+    """
+
+    def __init__(self, flush_interval=constants.STAGE_TIMINGS_FLUSH_INTERVAL):
+        self.flush_interval = flush_interval
+        self._current = {}
+        self._previous = {}
+        self._window_start = time.time()
+
+    def record(self, stage, policy, seconds):
+        self._maybe_flush()
+        key = (stage, policy)
+        histogram = self._current.get(key)
+        if histogram is None:
+            histogram = Histogram()
+            self._current[key] = histogram
+        histogram.add(seconds)
+
+    def _maybe_flush(self):
+        now = time.time()
+        if now - self._window_start < self.flush_interval:
+            return
+        self.flush()
+        self._window_start = now
+
+    def flush(self):
+        """Logs the current histograms and starts a new interval."""
+        for row in _summarize(self._current):
+            logging.info('Stage timings: %s', ', '.join(
+                '%s=%s' % (header, value)
+                for header, value in zip(SUMMARY_HEADERS, row)))
+        self._previous = self._current
+        self._current = {}
+
+    def get_summary(self):
+        """Summarizes the recorded durations.
+
+        Returns:
+            A list of rows, sorted by stage and policy. Each row is a list
+            of the SUMMARY_HEADERS values: the stage, the policy, the number
+            of samples and the mean, max and PERCENTILES durations in ms.
+        """
+        self._maybe_flush()
+        merged = {}
+        for histograms in [self._previous, self._current]:
+            for key, histogram in histograms.iteritems():
+                merged.setdefault(key, Histogram()).merge(histogram)
+        return _summarize(merged)
+
+    def reset(self):
+        self._current = {}
+        self._previous = {}
+        self._window_start = time.time()
+
+
+def _to_ms(seconds):
+    if seconds is None:
+        return None
+    return round(seconds * 1000, 3)
+
+
+def _summarize(histograms):
+    rows = []
+    for (stage, policy), histogram in sorted(histograms.iteritems()):
+        row = [stage, policy, histogram.count,
+               _to_ms(histogram.total / histogram.count),
+               _to_ms(histogram.max)]
+        for percent in PERCENTILES:
+            row.append(_to_ms(histogram.percentile(percent)))
+        rows.append(row)
+    return rows
+
+
+timings = StageTimings()
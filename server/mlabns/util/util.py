@@ -1,19 +1,51 @@
+from google.appengine.api import memcache
+
 import json
 import os
 
 import jinja2
 
+from mlabns.util import constants
 from mlabns.util import message
 
+_TEMPLATES_DIR = os.path.join(os.path.dirname(__file__), '../templates')
+
+# Compiled templates, keyed by file name. Each template is compiled once per
+# instance; the bytecode is shared between instances through memcache.
+_templates = {}
+
+
 def _get_jinja_environment():
-    current_dir = os.path.dirname(__file__)
-    templates_dir = os.path.join(current_dir, '../templates')
+    # Templates are deployed with the app, so there is no need to check
+    # whether they changed on disk (auto_reload).
     return jinja2.Environment(
-        loader=jinja2.FileSystemLoader(templates_dir),
-        extensions=['jinja2.ext.autoescape'], autoescape=True)
+        loader=jinja2.FileSystemLoader(_TEMPLATES_DIR),
+        extensions=['jinja2.ext.autoescape'], autoescape=True,
+        auto_reload=False,
+        bytecode_cache=jinja2.MemcachedBytecodeCache(
+            memcache, constants.MEMCACHE_PREFIX_TEMPLATES))
+
+_jinja_environment = _get_jinja_environment()
 
 def _get_jinja_template(template_filename):
-    return _get_jinja_environment().get_template(template_filename)
+    template = _templates.get(template_filename)
+    if template is None:
+        template = _jinja_environment.get_template(template_filename)
+        _templates[template_filename] = template
+    return template
+
+def render_template(template_filename, values=None):
+    """Renders a template of mlabns/templates.
+
+    Args:
+        template_filename: A string representing the template file name,
+            e.g. 'lookup_map.html'.
+        values: A dict of the values used in the template.
+
+    Returns:
+        A unicode string representing the rendered template.
+    """
+    return _get_jinja_template(template_filename).render(values or {})
 
 def send_not_found(request, output_type=message.FORMAT_HTML):
     request.error(404)